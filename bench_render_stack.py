@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+
+# measures the Master's loop overhead per metatile. first the RenderStack on its own:
+# the initial seeding plus the pop()/confirm()/push() dance for every metatile and its children.
+# then the whole Master.loop(): bbox checks, single_step(), handle_new_work() and the progress
+# accounting, with renderers that return each metatile as soon as it's sent.
+# no rendering, no backend, just the bookkeeping.
+
+from argparse import ArgumentParser
+import time
+
+from generate_tiles import RenderStack
+import map_utils
+from test_generate_tiles import FakeMaster, fake_master_opts
+import utils
+
+
+class ListRenderStack:
+    '''The RenderStack as it was before, insert(0)/pop(0) on a list, with all
+    the initial metatiles pushed before starting.'''
+    def __init__(self, max_zoom):
+        self.first = None
+        self.ready = []
+        self.max_zoom = max_zoom
+
+
+    def push(self, metatile):
+        if self.first is not None:
+            self.ready.insert(0, self.first)
+
+        self.first = metatile
+
+
+    def pop(self):
+        return self.first
+
+
+    def confirm(self):
+        t = None
+        if len(self.ready) > 0:
+            t = self.ready.pop(0)
+
+        self.first = t
+
+
+    def size(self):
+        return int(self.first is not None) + len(self.ready)
+
+
+def children(metatile):
+    z, x, y = metatile
+    return [ (z + 1, 2 * x + i, 2 * y + j) for i in range(2) for j in range(2) ]
+
+
+def run(stack, side, depth, order=None):
+    initial = ( (10, x, y) for x in range(side) for y in range(side) )
+
+    start = time.perf_counter()
+
+    if isinstance(stack, ListRenderStack):
+        for metatile in initial:
+            stack.push(metatile)
+    else:
+        stack.extend(initial, side**2)
+
+    count = 0
+    while stack.size() > 0:
+        metatile = stack.pop()
+        stack.confirm()
+        count += 1
+
+        if metatile[0] < 10 + depth:
+            siblings = children(metatile)
+            if order is not None:
+                key = utils.curves[order]
+                siblings = sorted(siblings, key=lambda child: key(*child))
+
+            for child in reversed(siblings):
+                stack.push(child)
+
+    end = time.perf_counter()
+
+    return count, end - start
+
+
+def run_master(bbox, min_zoom, max_zoom, order):
+    master = FakeMaster(fake_master_opts(bbox, min_zoom, max_zoom, order))
+
+    count, initial_metatiles = master.metatiles_for_bbox()
+
+    start = time.perf_counter()
+    master.loop(initial_metatiles, count)
+    end = time.perf_counter()
+
+    return master.came_back, end - start
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('-s', '--side',  dest='side',  default=200, type=int,
+                        help='The initial metatiles are a SIDE x SIDE square.')
+    parser.add_argument('-d', '--depth', dest='depth', default=1, type=int,
+                        help='How many ZLs to go down from the initial metatiles.')
+    parser.add_argument('-b', '--bbox',  dest='bbox',  default='-10,35,30,60', metavar='W,S,E,N',
+                        help='For the Master.loop() benchmark.')
+    parser.add_argument('-n', '--min-zoom', dest='min_zoom', default=4,  type=int)
+    parser.add_argument('-x', '--max-zoom', dest='max_zoom', default=12, type=int)
+    opts = parser.parse_args()
+
+    for name, stack, order in ( ('list',          ListRenderStack(18), None),
+                                ('deque',         RenderStack(18),     None),
+                                ('deque+morton',  RenderStack(18),     'morton'),
+                                ('deque+hilbert', RenderStack(18),     'hilbert') ):
+        count, total = run(stack, opts.side, opts.depth, order)
+        print(f"{name:>14}: {count:8d} metatiles in {total:8.3f}s, {total / count * 1e6:10.3f}µs/metatile")
+
+    bbox = map_utils.BBox([ float(coord) for coord in opts.bbox.split(',') ], opts.max_zoom)
+    for order in (None, 'morton', 'hilbert'):
+        count, total = run_master(bbox, opts.min_zoom, opts.max_zoom, order)
+        name = f"master+{order}" if order is not None else 'master'
+        print(f"{name:>14}: {count:8d} metatiles in {total:8.3f}s, {total / count * 1e6:10.3f}µs/metatile")
+
+
+if __name__ == '__main__':
+    main()
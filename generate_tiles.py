@@ -2,6 +2,10 @@
 
 # https://github.com/openstreetmap/mapnik-stylesheets/blob/master/generate_tiles.py with *LOTS* of enhancements
 
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import itertools
+import json
 from subprocess import call
 import sys, os, os.path
 import queue
@@ -12,6 +16,7 @@ import threading
 import datetime
 import errno
 import multiprocessing
+import multiprocessing.pool
 from random import randint, random
 from os import getpid
 import math
@@ -31,7 +36,7 @@ import tiles
 
 
 import logging
-from logging import debug, info, exception, warning
+from logging import debug, info, error, exception, warning
 long_format = "%(asctime)s %(name)16s:%(lineno)-4d (%(funcName)-21s) %(levelname)-8s %(message)s"
 short_format = "%(asctime)s %(message)s"
 
@@ -39,24 +44,24 @@ short_format = "%(asctime)s %(message)s"
 WebMerc = 3857
 LonLat = 4326
 
-from typing import Optional, List, Set, Dict, Any
+from typing import Optional, List, Set, Dict, Any, Iterable, Iterator, Deque, Tuple
 
-
-# TODO: this gives very bad numbers because if we start from a low enough ZL many tiles will be discarded
-# replace it with an algorithm that precounts all the tiles that are really going to be rendered
-# down there there m,ust be a part of the algo that gets all the tiles for ZL x that match the original bbox
-# TODO: check whether if it's a generator
-# TODO: or replace with something that simultaes going down the pyramid; in fact, it could be a dry run version
-# of the actual rendering algo
+OUT_OF_BBOX = "out of bbox"
+# how many metatiles ahead of the top of the stack each checker thread checks
+CHECKS_PER_CHECKER = 8
+# more than enough for the header of an uncompressed TIFF
+TIFF_HEADER_SIZE = 64 * 1024
+# how often the RenderJournal is fsync()'ed
+JOURNAL_SYNC_SECONDS = 10
 
 
 class RenderStack:
     '''
-    A render stack implemented with a list... and more.
+    A render stack implemented with a deque... and more.
 
-    Although this is implemented with a list, I prefer the semantic of these
-    methods and the str() representation given by the list being pop from/push
-    into the left.
+    Although this is implemented with a deque, I prefer the semantic of these
+    methods and the str() representation given by the deque being pop from/push
+    into the left. Both ends of a deque are O(1), so that's fine.
 
     The stack has a first element, which is the one ready to be pop()'ed.
     Because this element might need to be returned into the stack, there's the confirm()
@@ -66,27 +71,53 @@ class RenderStack:
     these children might not be needed to be rendered, they're stored in
     another list, to_validate.
 
+    The stack has two sections: at the bottom there is an iterator over the
+    initial metatiles, which is consumed lazily; on top of it, a list with the
+    children pushed while rendering. This way we don't have to create all the
+    initial metatiles before we start rendering.
+
+    The metatiles about to be pop()'ed can be seen with peek(), so they can be
+    checked ahead of time. The initial metatiles it has to pull for that are kept
+    in the lookahead deque.
+
+    stack.extend(metatiles, count)
     stack.push(e)
     e = stack.pop()
     stack.confirm()
+    es = stack.peek(n)
     '''
     def __init__(self, max_zoom:int) -> None:
         # I don't need order here, it's (probably) better if I validate tiles
         # as soon as possible
         self.first:Optional[tiles.MetaTile] = None
-        self.ready:List[tiles.MetaTile] = []
+        self.ready:Deque[tiles.MetaTile] = deque()
+        self.initial:Iterator[tiles.MetaTile] = iter(())
+        self.lookahead:Deque[tiles.MetaTile] = deque()
+        # this includes the ones in lookahead
+        self.initial_left = 0
         self.max_zoom = max_zoom
 
 
+    def extend(self, metatiles:Iterable[tiles.MetaTile], count:int) -> None:
+        '''Set the bottom section of the stack to the count metatiles in metatiles.'''
+        self.initial = iter(metatiles)
+        self.lookahead.clear()
+        self.initial_left = count
+
+
     def push(self, metatile:tiles.MetaTile) -> None:
         # debug("%s, %s, %s", self.first, self.ready, self.to_validate)
         if self.first is not None:
-            self.ready.insert(0, self.first)
+            self.ready.appendleft(self.first)
 
         self.first = metatile
 
 
     def pop(self) -> Optional[tiles.MetaTile]:
+        if self.first is None:
+            # all the pushed children are gone, go for the next initial metatile
+            self.first = self.next_initial()
+
         return self.first
 
 
@@ -99,22 +130,235 @@ class RenderStack:
         # t:Optional[tiles.Tile] = None
         t = None
         if len(self.ready) > 0:
-            t = self.ready.pop(0)
+            t = self.ready.popleft()
 
+        # if it's None, pop() will pick the next initial metatile
         self.first = t
         # debug("%s, %s, %s", self.first, self.ready, self.to_validate)
 
 
+    def peek(self, count:int) -> List[tiles.MetaTile]:
+        '''Returns up to count metatiles from the top of the stack, in the order
+        they would be pop()'ed, without removing them.'''
+        ans = []
+        if self.first is not None:
+            ans.append(self.first)
+
+        ans.extend(itertools.islice(self.ready, count - len(ans)))
+
+        # pull the initial ones we haven't seen yet
+        while len(self.lookahead) < count - len(ans):
+            try:
+                self.lookahead.append(next(self.initial))
+            except StopIteration:
+                break
+
+        ans.extend(itertools.islice(self.lookahead, count - len(ans)))
+
+        return ans
+
+
+    def next_initial(self) -> Optional[tiles.MetaTile]:
+        if len(self.lookahead) > 0:
+            metatile = self.lookahead.popleft()
+        else:
+            try:
+                metatile = next(self.initial)
+            except StopIteration:
+                self.initial_left = 0
+                return None
+
+        self.initial_left -= 1
+
+        return metatile
+
+
     def size(self) -> int:
         # debug("%s, %s, %s", self.first, self.ready, self.to_validate)
         # HACK: int(bool) ∈ (0, 1)
         # ans:int = int(self.first is not None) + len(self.ready)
-        ans = int(self.first is not None) + len(self.ready)
+        ans = int(self.first is not None) + len(self.ready) + self.initial_left
         # debug(ans)
         return ans
 
 
+class PyramidPlan:
+    '''
+    Counts the metatiles and tiles that are going to be rendered for each ZL,
+    without rendering anything.
+
+    It walks down the metatile pyramid in integer tile space, the same way the
+    Master does: it starts with the initial metatiles of min_zoom and on each ZL
+    it keeps only the metatiles that touch the bbox. Empty metatiles can't be
+    known in advance, so the Master discounts them with subtree_tiles() when
+    they're pruned.
+    '''
+    def __init__(self, bbox:map_utils.BBox, min_zoom:int, max_zoom:int, metatile_size:int,
+                 tile_size:int) -> None:
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.metatile_size = metatile_size
+
+        # ZL -> ((x0, y0), (x1, y1)), in tiles, both ends included
+        self.levels = { z: bbox.tile_range(z, tile_size) for z in range(min_zoom, max_zoom + 1) }
+        # ZL -> (metatiles, tiles)
+        self.counts:Dict[int, Tuple[int, int]] = {}
+
+        for z in range(min_zoom, max_zoom + 1):
+            (x0, y0), (x1, y1) = self.levels[z]
+            self.counts[z] = self.count(z, x0, y0, x1, y1)
+
+        self.metatiles = sum( metatiles for metatiles, _ in self.counts.values() )
+        self.tiles = sum( tile_count for _, tile_count in self.counts.values() )
+
+
+    def count(self, z:int, x0:int, y0:int, x1:int, y1:int) -> Tuple[int, int]:
+        '''Returns the amount of metatiles of ZL z that touch the [x0, x1]x[y0, y1]
+        range of tiles, and their amount of tiles.'''
+        if x0 > x1 or y0 > y1:
+            return (0, 0)
+
+        # if the ZL is too low, the metatiles shrink
+        size = min(self.metatile_size, 2**z)
+        metatiles = (x1 // size - x0 // size + 1) * (y1 // size - y0 // size + 1)
+
+        return (metatiles, metatiles * size**2)
+
+
+    def subtree_tiles(self, metatile:tiles.MetaTile) -> int:
+        '''Returns the amount of tiles of metatile and all its descendants inside the bbox.'''
+        ans = 0
+
+        for z in range(metatile.z, self.max_zoom + 1):
+            # the metatile's footprint at this ZL, last tiles included
+            scale = 2**(z - metatile.z)
+            x0 = metatile.x * scale
+            y0 = metatile.y * scale
+            x1 = (metatile.x + metatile.size) * scale - 1
+            y1 = (metatile.y + metatile.size) * scale - 1
+
+            (bbox_x0, bbox_y0), (bbox_x1, bbox_y1) = self.levels[z]
+            _, tile_count = self.count(z, max(x0, bbox_x0), max(y0, bbox_y0),
+                                          min(x1, bbox_x1), min(y1, bbox_y1))
+            ans += tile_count
+
+        return ans
+
+
+    def report(self) -> None:
+        print(f"{'ZL':>3} {'metatiles':>14} {'tiles':>16}")
+        for z, (metatiles, tile_count) in self.counts.items():
+            print(f"{z:3d} {metatiles:14d} {tile_count:16d}")
+        print(f"{'all':>3} {self.metatiles:14d} {self.tiles:16d}")
+
+
 RenderChildren = Dict[tiles.Tile, bool]
+class RenderJournal:
+    '''
+    An append-only log of what the Master did with each metatile, so an interrupted
+    run can be resumed without checking the tiles in the backend again. After a line
+    with the run's parameters, there's one line per metatile:
+
+    R z x y pushed empty    rendered; pushed and empty are bitmasks over its children(),
+                            the ones pushed to be rendered and the ones pruned as empty
+    S z x y                 skipped by -X/-N; all its children were pushed
+    O z x y                 out of the bbox, with all its descendants
+
+    The R lines are written only once the backend says the metatile's tiles are
+    durable, see durable(). The metatiles that were being rendered or stored when
+    it was interrupted are not in it, so they're rendered again.
+    '''
+    def __init__(self, path:str, params:Dict[str, Any], resume:bool) -> None:
+        self.path = path
+        # (z, x, y) -> (kind, pushed, empty)
+        self.entries:Dict[Tuple[int, int, int], Tuple[str, int, int]] = {}
+        # the rendered metatiles waiting for their tiles to be durable; (z, x, y) -> line
+        self.pending:Dict[Tuple[int, int, int], str] = {}
+
+        if resume:
+            complete = self.load(params)
+            self.file = open(path, 'a')
+
+            if not complete:
+                # do not append to the half written line
+                self.file.write('\n')
+        else:
+            self.file = open(path, 'w')
+            self.file.write(json.dumps(params) + '\n')
+
+        self.last_sync = time.monotonic()
+
+
+    def load(self, params:Dict[str, Any]) -> bool:
+        '''Reads the entries. Returns whether the last line was complete.'''
+        line = ''
+
+        with open(self.path) as f:
+            if json.loads(f.readline()) != params:
+                raise ValueError(f"{self.path} is the journal of a run with other parameters.")
+
+            for line in f:
+                fields = line.split()
+
+                try:
+                    kind = fields[0]
+                    z, x, y = ( int(field) for field in fields[1:4] )
+                    if kind == 'R':
+                        pushed, empty = int(fields[4]), int(fields[5])
+                    else:
+                        pushed = empty = 0
+                except (IndexError, ValueError):
+                    # the last line could be half written
+                    continue
+
+                self.entries[(z, x, y)] = (kind, pushed, empty)
+
+        info("%s: %d metatiles already done.", self.path, len(self.entries))
+
+        return line.endswith('\n')
+
+
+    def write(self, line:str) -> None:
+        self.file.write(line)
+
+        if time.monotonic() - self.last_sync > JOURNAL_SYNC_SECONDS:
+            self.sync()
+
+
+    def rendered(self, metatile:tiles.MetaTile, pushed:int, empty:int) -> None:
+        self.pending[(metatile.z, metatile.x, metatile.y)] = f"R {metatile.z} {metatile.x} {metatile.y} {pushed} {empty}\n"
+
+
+    def durable(self, keys:Iterable[Tuple[int, int, int]]) -> None:
+        '''The tiles of these rendered metatiles are in the backend for good.'''
+        for key in keys:
+            line = self.pending.pop(key, None)
+            if line is not None:
+                self.write(line)
+
+
+    def skipped(self, metatile:tiles.MetaTile) -> None:
+        self.write(f"S {metatile.z} {metatile.x} {metatile.y}\n")
+
+
+    def out_of_bbox(self, metatile:tiles.MetaTile) -> None:
+        self.write(f"O {metatile.z} {metatile.x} {metatile.y}\n")
+
+
+    def sync(self) -> None:
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.monotonic()
+
+
+    def close(self) -> None:
+        '''Call it only once the backends are closed, as it considers all the pending
+        metatiles durable.'''
+        self.durable(list(self.pending.keys()))
+        self.sync()
+        self.file.close()
+
+
 class RenderThread:
     def __init__(self, opts, input, output) -> None:
         self.opts = opts
@@ -126,6 +370,8 @@ class RenderThread:
         self.metatile_size = opts.metatile_size
 
         self.store_thread = None
+        # set by the Master if the metatiles are sent to the store via shared memory
+        self.ring:Optional[utils.SharedMemoryRing] = None
 
 
     def render(self, metatile:tiles.MetaTile) -> Dict[tiles.Tile, bool]:
@@ -200,10 +446,14 @@ class RenderThread:
             # TODO:
             # but bz2 compresses the best, 52714 png vs 49876 bzip vs 70828 gzip vs 53032 lzma
 
-            if not self.opts.store_thread:
-                # if there is not a separate store thread, the metatile will go in a non-marshaling queue,
+            if not self.opts.store_thread or self.opts.parallel == 'threads':
+                # if there is not a separate store process, the metatile will go in a non-marshaling queue,
                 # so no need tostring() it
                 metatile.im = im
+            elif self.ring is not None:
+                # an uncompressed TIFF is just a header and the raw pixels, so this is
+                # mostly a memcpy(), and the only thing that goes through the queue is the handle
+                metatile.im = self.ring.put(im.tostring('tiff:compression=none'))
             else:
                 metatile.im = im.tostring('png256')  # here it's converted only for serialization reasons
 
@@ -269,6 +519,10 @@ class RenderThread:
         while self.single_step():
             pass
 
+        if not self.opts.store_thread:
+            # flush the embedded store
+            self.store_thread.close()
+
         info("[%s] finished", self.name)
 
 
@@ -294,6 +548,7 @@ class RenderThread:
 backends = dict(
     tiles=   map_utils.DiskBackend,
     mbtiles= map_utils.MBTilesBackend,
+    pmtiles= map_utils.PMTilesBackend,
     mod_tile=map_utils.ModTileBackend,
     test=    map_utils.TestBackend,
     # SVGs and PDFs are saved by the renderer itself
@@ -308,6 +563,73 @@ default_options = dict(
 )
 
 
+# what encode_tiles() returns for each tile: its color if it's empty, and its data
+Encoded = Tuple[Optional[int], Optional[bytes]]
+
+
+def encode_tiles(image, meta_indexes, tile_size:int, tile_file_format:str,
+                 empty_colors:List[int], encode_empty:bool) -> List[Encoded]:
+    '''Cuts the tiles at meta_indexes out of the metatile's image and encodes them.
+    Empty tiles are detected on the raw pixels, and they're encoded only if encode_empty.'''
+    ans = []
+
+    for i, j in meta_indexes:
+        # TODO: Tile.meta_pixel_coords
+        # TODO: pass tile_size to MetaTile and Tile
+        img = image.view(i*tile_size, j*tile_size, tile_size, tile_size)
+
+        # no format means the raw pixels
+        color = utils.uniform_color(img.tostring(), empty_colors)
+
+        if color is None:
+            data = img.tostring(tile_file_format)
+        elif encode_empty:
+            key = (color, tile_size, tile_file_format)
+            data = empty_datas.get(key, None)
+
+            if data is None:
+                data = empty_datas[key] = img.tostring(tile_file_format)
+        else:
+            data = None
+
+        ans.append( (color, data) )
+
+    return ans
+
+
+# the encoded data of the empty tiles for each (color, tile_size, tile_file_format)
+# they're all the same, so we encode them only once per process
+empty_datas:Dict[Tuple[int, int, str], bytes] = {}
+
+# lossless and cheap to (de)serialize, so it's just the raw pixels with a header
+raw_format = 'tiff:compression=none'
+
+
+def init_encoder():
+    # disable SIGINT so C-c/KeyboardInterrupt is handled by Master
+    signal(SIGINT, SIG_IGN)
+
+
+def cut_tiles(image, meta_indexes, tile_size:int) -> List[bytes]:
+    '''Cuts the tiles at meta_indexes out of the metatile's image, in raw_format.'''
+    return [ image.view(i*tile_size, j*tile_size, tile_size, tile_size).tostring(raw_format)
+             for i, j in meta_indexes ]
+
+
+def encode_tiles_from(datas:List[bytes], tile_size:int, tile_file_format:str,
+                      empty_colors:List[int], encode_empty:bool) -> List[Encoded]:
+    '''Same as encode_tiles(), but run in the encoder processes on the tiles already
+    cut by cut_tiles(), so each process gets only the pixels of its own tiles.'''
+    ans = []
+
+    for data in datas:
+        image = mapnik.Image.frombuffer(data)
+        ans.extend(encode_tiles(image, [ (0, 0) ], tile_size, tile_file_format, empty_colors,
+                                encode_empty))
+
+    return ans
+
+
 class StormBringer:
     def __init__(self, opts, backend, input, output):
         self.opts = opts
@@ -318,6 +640,14 @@ class StormBringer:
         # this is needed so we can stop only after all the writers sent their last jobs
         self.writers = self.opts.threads
         self.done_writers = 0
+        # set by the Master if the metatiles come via shared memory
+        self.ring:Optional[utils.SharedMemoryRing] = None
+        # see start_encoders()
+        self.encoders:Optional[multiprocessing.pool.Pool] = None
+        # the stored metatiles whose tiles might not be durable yet; (generation, (z, x, y))
+        # several render threads can share this object, see Master.__init__()
+        self.stored:Deque[Tuple[int, Tuple[int, int, int]]] = deque()
+        self.stored_lock = threading.Lock()
 
         if   self.opts.tile_file_format == 'png':
             self.tile_file_format = 'png256'
@@ -336,13 +666,23 @@ class StormBringer:
         sig = signal(SIGINT, SIG_IGN)
 
         debug('[%s] curling the curl', self.name)
+        self.start_encoders()
 
         while self.single_step():
             pass
 
+        self.stop_encoders()
+        self.close()
         debug('[%s] done', self.name)
 
 
+    def close(self):
+        # in fork mode each process has its own copy of the backend, and
+        # the Master closes its own; threads share it
+        if self.opts.parallel == 'fork' and self.backend is not None:
+            self.backend.close()
+
+
     def single_step(self):
         debug('[%s] >... (%d)', self.name, self.input.qsize())
         metatile = self.input.get()
@@ -350,11 +690,13 @@ class StormBringer:
 
         if metatile is not None:
             debug('[%s] sto...', self.name)
-            self.store_metatile(metatile)
+            generation = self.store_metatile(metatile)
             debug('[%s] ...red!', self.name)
             # we don't need it anymore and *.Queue complains that
             # mapnik._mapnik.Image is not pickle()'able
             metatile.im = None
+            # the Master journals them, so they go with the metatile
+            metatile.durable = self.durable_metatiles(metatile, generation)
             self.output.put(metatile)
         else:
             # this writer finished
@@ -364,18 +706,98 @@ class StormBringer:
         return self.done_writers != self.writers
 
 
-    def store_metatile(self, metatile):
+    def durable_metatiles(self, metatile, generation:int) -> List[Tuple[int, int, int]]:
+        '''Returns the stored metatiles whose tiles are durable now.'''
+        # 0 means nothing was stored
+        durable = self.backend.durable() if generation > 0 else 0
+
+        with self.stored_lock:
+            self.stored.append((generation, (metatile.z, metatile.x, metatile.y)))
+
+            keys = []
+            while len(self.stored) > 0 and self.stored[0][0] <= durable:
+                keys.append(self.stored.popleft()[1])
+
+        return keys
+
+
+    def start_encoders(self):
+        '''Start the encoder processes. It must be called from the store process.'''
+        if self.opts.encoders > 0:
+            self.encoders = multiprocessing.Pool(self.opts.encoders, initializer=init_encoder)
+
+
+    def stop_encoders(self):
+        if self.encoders is not None:
+            self.encoders.close()
+            self.encoders.join()
+
+
+    def decode_metatile(self, metatile):
+        '''Returns the metatile's image as sent by the renderer.'''
+        if not self.opts.store_thread or self.opts.parallel == 'threads':
+            return metatile.im
+
+        if self.ring is not None:
+            view = self.ring.view(metatile.im)
+            try:
+                # this reads straight from the shared memory
+                return mapnik.Image.frombuffer(view)
+            finally:
+                view.release()
+                self.ring.release(metatile.im)
+
+        return mapnik.Image.frombuffer(metatile.im)
+
+
+    def encode_metatile(self, image, metatile_tiles):
+        '''Encode the metatile's tiles in the encoder processes, one chunk of tiles per
+        process. The image is decoded only once, here, and each process gets only its
+        chunk's pixels.'''
+        chunks = [ metatile_tiles[index::self.opts.encoders]
+                   for index in range(self.opts.encoders) ]
+
+        results = self.encoders.starmap(encode_tiles_from,
+                                        [ (cut_tiles(image, [ tile.meta_index for tile in chunk ],
+                                                     self.opts.tile_size),
+                                           self.opts.tile_size, self.tile_file_format,
+                                           self.opts.empty_color, self.opts.empty != 'skip')
+                                          for chunk in chunks ])
+
+        for chunk, encoded in zip(chunks, results):
+            for tile, (color, data) in zip(chunk, encoded):
+                tile.is_empty = color is not None
+                tile.data = data
+
+
+    def store_metatile(self, metatile) -> int:
+        '''Returns the backend's generation for the metatile's tiles, or 0 if nothing
+        was stored.'''
+        generation = 0
+
         # save the image, splitting it in the right amount of tiles
         if not self.opts.dry_run:
             start = time.perf_counter()
-            if not self.opts.store_thread:
-                image = metatile.im
+            # the Tiles are created on the fly, so keep them between encoding and storing
+            metatile_tiles = list(metatile.tiles)
+
+            if self.opts.format in ('svg', 'pdf'):
+                # SVG and PDF are stored by the renderer
+                pass
             else:
-                image = mapnik.Image.frombuffer(metatile.im)
+                image = self.decode_metatile(metatile)
+
+                if self.encoders is not None:
+                    self.encode_metatile(image, metatile_tiles)
+                else:
+                    for tile in metatile_tiles:
+                        self.encode_tile(tile, image)
             mid = time.perf_counter()
 
-            for tile in metatile.tiles:
-                self.store_tile(tile, image)
+            for tile in metatile_tiles:
+                # SVG and PDF are stored by the renderer
+                if self.opts.format not in ('svg', 'pdf'):
+                    self.store_tile(tile)
 
                 # do not try to compute this for tiles outside the asked range
                 if metatile.z < self.opts.max_zoom:
@@ -384,6 +806,10 @@ class StormBringer:
                     if child is not None:
                         child.is_empty = child.is_empty and tile.is_empty
 
+            if self.opts.format not in ('svg', 'pdf'):
+                # once per metatile; batching backends decide whether it's time to write
+                generation = self.backend.commit()
+
             end = time.perf_counter()
 
             for child in metatile.children():
@@ -403,34 +829,26 @@ class StormBringer:
                     child.is_empty = (rand <= 0.05 and 2**metatile.z >= self.opts.metatile_size)
                     child.render = not (child.is_empty or self.opts.single_tiles or metatile.z == self.opts.max_zoom)
 
+        return generation
 
-    def store_tile(self, tile, image):
-        # SVG and PDF are stored by the renderer
-        if self.opts.format not in ('svg', 'pdf'):
-            i, j = tile.meta_index
-
-            # TODO: Tile.meta_pixel_coords
-            # TODO: pass tile_size to MetaTile and Tile
-            img = image.view(i*self.opts.tile_size, j*self.opts.tile_size,
-                               self.opts.tile_size,   self.opts.tile_size)
-
-            # this seems like duplicated work, but we need one looseless format for serializing
-            # and another format for the final tile
-            tile.data = img.tostring(self.tile_file_format)
 
-            # debug((len(tile.data), tile.data[41:44]))
-            tile.is_empty = len(tile.data) == self.opts.empty_size and tile.data[41:44] == self.opts.empty_color
+    def encode_tile(self, tile, image):
+        # this seems like duplicated work, but we need one looseless format for serializing
+        # and another format for the final tile
+        color, tile.data = encode_tiles(image, [ tile.meta_index ], self.opts.tile_size,
+                                        self.tile_file_format, self.opts.empty_color,
+                                        self.opts.empty != 'skip')[0]
+        tile.is_empty = color is not None
 
-            if tile.is_empty:
-                debug('Skipping empty tile')
 
-            if not tile.is_empty or self.opts.empty == 'write':
-                self.backend.store(tile)
-            elif tile.is_empty and self.opts.empty == 'link':
-                # TODO
-                pass
+    def store_tile(self, tile):
+        if tile.is_empty:
+            debug('Skipping empty tile')
 
-            self.backend.commit()
+        if not tile.is_empty or self.opts.empty == 'write':
+            self.backend.store(tile)
+        elif tile.is_empty and self.opts.empty == 'link':
+            self.backend.link(tile)
 
 
 class Master:
@@ -445,6 +863,17 @@ class Master:
         # counters
         self.went_out = self.came_back = 0
         self.tiles_to_render = self.tiles_rendered = self.tiles_skipped = 0
+        self.plan:Optional[PyramidPlan] = None
+        self.ring:Optional[utils.SharedMemoryRing] = None
+        self.writer:Optional[map_utils.MBTilesWriter] = None
+        self.journal:Optional[RenderJournal] = None
+
+        # the checks for the metatiles near the top of the stack
+        # are done ahead of time by these threads, see prefetch_checks()
+        self.checkers:Optional[ThreadPoolExecutor] = None
+        self.checks:Dict[tiles.MetaTile, Future] = {}
+        if self.opts.checkers > 0:
+            self.checkers = ThreadPoolExecutor(self.opts.checkers, thread_name_prefix='Checker')
 
         # statistics
         self.median = utils.MedianTracker()
@@ -470,6 +899,13 @@ class Master:
                 self.store_queue = utils.SimpleQueue(5*self.opts.threads)
             else:
                 self.store_queue = multiprocessing.Queue(5*self.opts.threads)
+
+                if self.opts.store_transport == 'shm':
+                    # test's metatile_size is already normalized
+                    image_size = self.opts.tile_size * self.opts.metatile_size
+                    # a couple more slots so the renderers don't wait while the store is busy
+                    self.ring = utils.SharedMemoryRing(self.opts.threads + 2,
+                                                       image_size**2 * 4 + TIFF_HEADER_SIZE)
             self.info = multiprocessing.Queue(5*self.opts.threads)
         elif self.opts.parallel == 'threads':
             debug('threads, using queue.Queue()')
@@ -490,12 +926,22 @@ class Master:
                 self.store_queue = queue.Queue(1)
             self.info = queue.Queue(1)
 
+        more_opts = self.opts.more_opts
+        if self.opts.format == 'mbtiles' and self.opts.parallel != 'single':
+            # SQLite can't have concurrent writers, so all the writing is done by
+            # this process; the stores just send it the tiles
+            self.writer = map_utils.MBTilesWriter(self.opts.tile_dir, self.opts.bbox,
+                                                  self.opts.mbtiles_queue_size, **more_opts)
+            self.writer.start()
+            more_opts = dict(more_opts, writer=self.writer)
+
         self.backend = backends[self.opts.format](self.opts.tile_dir, self.opts.bbox,
-                                                  **self.opts.more_opts)
+                                                  **more_opts)
 
         # Launch rendering threads
         if self.opts.parallel != 'single':
             sb = StormBringer(self.opts, self.backend, self.store_queue, self.info)
+            sb.ring = self.ring
             if self.opts.store_thread:
                 self.store_thread = self.opts.parallel_factory(target=sb.loop)
                 sb.name = self.store_thread.name
@@ -507,6 +953,7 @@ class Master:
 
             for i in range(self.opts.threads):
                 renderer = RenderThread(self.opts, self.new_work, self.store_queue)
+                renderer.ring = self.ring
 
                 render_thread = self.opts.parallel_factory(target=renderer.loop, name=f"Renderer-{i + 1:03d}")
                 renderer.name = render_thread.name
@@ -531,7 +978,7 @@ class Master:
             self.renderer.store_thread = self.store_thread
             debug("Renderer object created, not threaded")
 
-        if not os.path.isdir(self.opts.tile_dir) and not self.opts.format == 'mbtiles':
+        if not os.path.isdir(self.opts.tile_dir) and self.opts.format not in ('mbtiles', 'pmtiles'):
             debug("creating dir %s", self.opts.tile_dir)
             os.makedirs(self.opts.tile_dir, exist_ok=True)
 
@@ -571,8 +1018,7 @@ class Master:
 
 
     def metatiles_for_bbox(self):
-        result = []
-
+        '''Returns the amount of initial metatiles and a generator that creates them.'''
         # attributes used a lot, so hold them in local vars
         bbox = self.opts.bbox
         min_zoom = self.opts.min_zoom
@@ -584,8 +1030,8 @@ class Master:
         debug('rendering bbox %s: %s', self.opts.bbox_name, bbox)
         # debug(bbox.lower_left)
         # debug(bbox.upper_right)
-        w, s = tiles.tileproj.lon_lat2pixel(bbox.lower_left, min_zoom)
-        e, n = tiles.tileproj.lon_lat2pixel(bbox.upper_right, min_zoom)
+        (w, s), (e, n) = tiles.tileproj.lon_lat2pixels((bbox.lower_left, bbox.upper_right),
+                                                       min_zoom).tolist()
         # debug("pixel ZL%r: %r, %r, %r, %r", min_zoom, w, s, e, n)
         # debug("%d", 2**min_zoom)
 
@@ -596,40 +1042,59 @@ class Master:
         # debug("tiles: %r, %r, %r, %r", w, s, e, n)
         # debug("%sx%s", list(range(w, e, metatile_size)), list(range(n, s, metatile_size)))
 
-        count = 0
-        info('Creating initial metatiles...')
-        for x in range(w, e, metatile_size):
-            for y in range(n, s, metatile_size):
-                metatile = tiles.MetaTile(min_zoom, x, y, self.opts.metatile_size,
-                                          tile_size)
-                # TODO: convert this into a generator
-                # for that we will need to modify the RenderStack so we have 2 sections, one the generator,
-                # another for the chidren stacked on top
-                result.append(metatile)
-                count += 1
-                if count % 1000 == 0:
-                    info('%d...' % count)
+        # do not go out of the world
+        e = min(e, 2**min_zoom)
+        s = min(s, 2**min_zoom)
+
+        xs = range(w, e, metatile_size)
+        ys = range(n, s, metatile_size)
+        count = len(xs) * len(ys)
+        info("%d initial metatiles.", count)
+
+        if self.opts.order is not None:
+            origins = utils.curve_walk(min_zoom, w, n, e, s, metatile_size,
+                                       utils.curves[self.opts.order])
+        else:
+            origins = ( (x, y) for x in xs for y in ys )
 
-        info("%d initial metatiles created." % count)
+        def metatiles():
+            # this is consumed by the RenderStack as it needs them,
+            # so we don't have to keep them all in memory
+            for x, y in origins:
+                yield tiles.MetaTile(min_zoom, x, y, self.opts.metatile_size, tile_size)
 
-        return result
+        return count, metatiles()
 
 
     def render_tiles(self) -> None:
         debug("render_tiles(%s)", self.opts)
 
-        initial_metatiles = []
         if not self.opts.single_tiles:
-            initial_metatiles = self.metatiles_for_bbox()
+            count, initial_metatiles = self.metatiles_for_bbox()
         else:
             # TODO: if possible, order them in depth first/proximity? fashion.
             debug('rendering individual tiles')
             initial_metatiles = self.opts.tiles
+            count = len(initial_metatiles)
+
+        if self.opts.journal is not None:
+            params = dict(bbox=str(self.opts.bbox), tiles=[ repr(metatile) for metatile in self.opts.tiles or [] ],
+                          min_zoom=self.opts.min_zoom, max_zoom=self.opts.max_zoom,
+                          metatile_size=self.opts.metatile_size, tile_size=self.opts.tile_size,
+                          order=self.opts.order)
+            try:
+                self.journal = RenderJournal(self.opts.journal, params, self.opts.resume)
+            except ValueError as e:
+                error(str(e))
+                self.finish()
+                return
 
         try:
-            self.loop(initial_metatiles)
+            self.loop(initial_metatiles, count)
         except KeyboardInterrupt as e:
             info("Ctrl-c detected, exiting...")
+            # let the metatiles being rendered come back, so they're in the journal
+            signal(SIGINT, SIG_IGN)
         except Exception as e:
             info('unknown exception caught!')
             exception(str(e))
@@ -638,75 +1103,172 @@ class Master:
             self.finish()
 
 
+    def resume(self, initial_metatiles, count):
+        '''Replays the journal over the initial metatiles, accounting the tiles that were
+        already rendered or skipped. Returns the amount of metatiles left to process
+        and a generator for them, in the order they would have been pop()'ed.'''
+        assert self.journal is not None
+        entries = self.journal.entries
+        # the metatiles from the journal, and below them, that still have to be processed
+        frontier:List[tiles.MetaTile] = []
+        visited = 0
+
+        def walk(metatile):
+            nonlocal visited
+
+            try:
+                kind, pushed, empty = entries[(metatile.z, metatile.x, metatile.y)]
+            except KeyError:
+                frontier.append(metatile)
+                return
+
+            visited += 1
+
+            if kind == 'O':
+                self.tiles_skipped += self.subtree_tiles(metatile)
+            elif kind == 'S':
+                self.tiles_skipped += len(metatile.tiles)
+
+                if metatile.z < self.opts.max_zoom and self.opts.push_children:
+                    for child in self.ordered_children(metatile):
+                        walk(child)
+            else:
+                self.tiles_rendered += len(metatile.tiles)
+
+                # the bits are in children() order, but we walk them in the pushing order
+                indexes = { id(child): index for index, child in enumerate(metatile.children()) }
+                for child in self.ordered_children(metatile):
+                    bit = 1 << indexes[id(child)]
+                    if pushed & bit:
+                        walk(child)
+                    elif empty & bit:
+                        self.tiles_skipped += self.subtree_tiles(child)
+
+        # the journal covers the first initial metatiles, so we only walk until we
+        # find all of its entries; the rest of the initial metatiles are left as they are
+        initial = iter(initial_metatiles)
+        walked = 0
+        while visited < len(entries):
+            try:
+                metatile = next(initial)
+            except StopIteration:
+                break
+
+            walk(metatile)
+            walked += 1
+
+        info("resuming: %d metatiles to go back to, %d tiles already done.",
+             len(frontier), self.tiles_rendered + self.tiles_skipped)
+
+        return len(frontier) + count - walked, itertools.chain(frontier, initial)
+
+
+    def ordered_children(self, metatile):
+        '''Returns metatile's children, following the space filling curve if asked to.'''
+        children = metatile.children()
+
+        if self.opts.order is not None:
+            key = utils.curves[self.opts.order]
+            children = sorted(children, key=lambda child: key(child.z, child.x, child.y))
+
+        return children
+
+
     def push_all_children(self, metatile):
         if metatile.z < self.opts.max_zoom and self.opts.push_children:
-            for child in metatile.children():
+            # reversed so they're pop()'ed in order
+            for child in reversed(self.ordered_children(metatile)):
                 # we have no other info about whether they should be
                 # rendered or not, so render them just in case. at worst,
                 # they could either be empty tiles or too new too
                 self.work_stack.push(child)
 
 
+    def subtree_tiles(self, metatile):
+        '''Returns the amount of tiles of metatile and its descendants that are accounted
+        in tiles_to_render.'''
+        if self.plan is None:
+            # single tiles mode, children are never rendered
+            return len(metatile.tiles)
+
+        return self.plan.subtree_tiles(metatile)
+
+
+    def check(self, metatile) -> Optional[str]:
+        '''Returns why metatile should be skipped, or None if it has to be rendered.
+        It has no side effects, so it can run in the checker threads.'''
+        if metatile not in self.opts.bbox:
+            return OUT_OF_BBOX
+
+        debug('skip test existing: %s; newer: %s', self.opts.skip_existing,
+              self.opts.skip_newer)
+        if self.opts.skip_existing:
+            # TODO: missing as present?
+            # NOTE: it's called missing_as_new
+            if self.backend.all_exist(metatile):
+                return "present, skipping"
+        elif self.opts.skip_newer is not None:
+            if self.backend.all_newer_than(metatile, self.opts.skip_newer,
+                                           self.opts.missing_as_new):
+                return "too new, skipping"
+
+        return None
+
+
+    def prefetch_checks(self):
+        '''Hands the checks for the metatiles at the top of the stack to the checker threads.'''
+        for metatile in self.work_stack.peek(self.opts.checkers * CHECKS_PER_CHECKER):
+            if metatile not in self.checks:
+                self.checks[metatile] = self.checkers.submit(self.check, metatile)
+
+
     def should_render(self, metatile):
-        # TODO: move all these checks to another thread/process.
-        # skip:bool
-        if metatile in self.opts.bbox:
-            if self.opts.skip_existing or self.opts.skip_newer is not None:
-                debug('skip test existing: %s; newer: %s', self.opts.skip_existing,
-                    self.opts.skip_newer)
-                skip = True
-
-                for tile in metatile.tiles: # type: tiles.Tile
-                    if self.opts.skip_existing:
-                        # TODO: missing as present?
-                        # NOTE: it's called missing_as_new
-                        skip = skip and self.backend.exists(tile)
-                        # debug('skip: %s', skip)
-                        message = "present, skipping"
-                    else:
-                        skip = ( skip and
-                                 self.backend.newer_than(tile, self.opts.skip_newer,
-                                                         self.opts.missing_as_new) )
-                        # debug('skip: %s', skip)
-                        message = "too new, skipping"
-
-                if skip:
-                    self.work_stack.confirm()
-                    self.tiles_skipped += len(metatile.tiles)
-                    self.progress(metatile, message)
-
-                    # notify the children, so they get a chance to be rendered
-                    self.push_all_children(metatile)
-            else:
-                skip = False
-                # debug('skip: %s', skip)
+        if self.checkers is not None:
+            self.prefetch_checks()
+            # this only blocks if the checkers are lagging behind
+            reason = self.checks.pop(metatile).result()
         else:
-            # do not render tiles out of the bbox
-            skip = True
-            self.work_stack.confirm()
+            reason = self.check(metatile)
+
+        if reason is None:
+            return True
+
+        self.work_stack.confirm()
 
+        if reason == OUT_OF_BBOX:
             # we count this one and all it descendents as skipped
-            self.tiles_skipped += ( len(metatile.tiles) *
-                                    utils.pyramid_count(metatile.z, opts.max_zoom) )
-            self.progress(metatile, "out of bbox")
+            self.tiles_skipped += self.subtree_tiles(metatile)
+            self.progress(metatile, reason)
 
-        return not skip
+            if self.journal is not None:
+                self.journal.out_of_bbox(metatile)
+        else:
+            self.tiles_skipped += len(metatile.tiles)
+            self.progress(metatile, reason)
 
+            # notify the children, so they get a chance to be rendered
+            self.push_all_children(metatile)
 
-    def loop(self, initial_metatiles) -> None:
-        self.start = time.perf_counter()
+            if self.journal is not None:
+                self.journal.skipped(metatile)
 
-        for metatile in initial_metatiles:
-            debug("... %r", (metatile, ))
-            self.work_stack.push(metatile)
+        return False
+
+
+    def loop(self, initial_metatiles, count) -> None:
+        self.start = time.perf_counter()
 
-        first_tiles = len(initial_metatiles)
         if self.opts.single_tiles:
-            self.tiles_to_render = first_tiles * len(metatile.tiles)
+            self.tiles_to_render = sum( len(metatile.tiles) for metatile in initial_metatiles )
         else:
-            # all initial_metatiles are from the same zoom level
-            self.tiles_to_render = ( first_tiles * len(metatile.tiles) *
-                                     utils.pyramid_count(opts.min_zoom, opts.max_zoom) )
+            self.plan = PyramidPlan(self.opts.bbox, self.opts.min_zoom, self.opts.max_zoom,
+                                    self.opts.metatile_size, self.opts.tile_size)
+            self.tiles_to_render = self.plan.tiles
+
+        if self.journal is not None and self.opts.resume:
+            count, initial_metatiles = self.resume(initial_metatiles, count)
+
+        self.work_stack.extend(initial_metatiles, count)
 
         while ( self.work_stack.size() > 0 or
                 self.went_out > self.came_back or
@@ -726,9 +1288,9 @@ class Master:
 
         if metatiles_rendered != 0:
             info("%8.3f s/metatile", total_time / metatiles_rendered)
-            info("%8.3f metatile/s", metatiles_rendered / total_time * opts.threads)
+            info("%8.3f metatile/s", metatiles_rendered / total_time * self.opts.threads)
             info("%8.3f s/tile", total_time / self.tiles_rendered)
-            info("%8.3f tile/s", self.tiles_rendered / total_time * opts.threads)
+            info("%8.3f tile/s", self.tiles_rendered / total_time * self.opts.threads)
 
         debug('loop() out!')
 
@@ -757,7 +1319,6 @@ class Master:
 
             metatile = self.work_stack.pop()  # tiles.MetaTile
             if metatile is not None:
-                # TODO: move to another thread
                 if not self.should_render(metatile):
                     continue
 
@@ -794,23 +1355,36 @@ class Master:
         # an empty metatile will be accounted as rendered,
         # but the children can be pruned
         if self.opts.push_children and metatile.z < self.opts.max_zoom:
-            # TODO: why reversed?
-            for child in reversed(metatile.children()):
+            # reversed so they're pop()'ed in order
+            for child in reversed(self.ordered_children(metatile)):
                 debug("%r: %s, %s", child, child.render, child.is_empty)
                 if child.render:
                     self.work_stack.push(child)
                 elif child.is_empty:
-                    self.tiles_skipped += ( len(child.tiles) *
-                                            utils.pyramid_count(child.z, opts.max_zoom) )
+                    self.tiles_skipped += self.subtree_tiles(child)
                     self.progress(child, format="empty")
 
         self.tiles_rendered += len(metatile.tiles)
         self.came_back += 1
 
+        if self.journal is not None:
+            pushed = empty = 0
+            if self.opts.push_children and metatile.z < self.opts.max_zoom:
+                for index, child in enumerate(metatile.children()):
+                    pushed |= child.render << index
+                    empty |= (not child.render and child.is_empty) << index
+
+            self.journal.rendered(metatile, pushed, empty)
+            self.journal.durable(metatile.durable)
+
         self.progress(metatile, *metatile.times(),  format="%8.3f, %8.3f, %8.3f, %8.3f")
 
 
     def finish(self):
+        if self.checkers is not None:
+            # the pending checks are for metatiles we're not going to render anymore
+            self.checkers.shutdown(wait=False, cancel_futures=True)
+
         if self.opts.parallel != 'single':
             info('stopping threads/procs')
             # signal render threads to exit by sending empty request to queue
@@ -836,6 +1410,27 @@ class Master:
             for i in range(self.opts.threads):
                 self.renderers[i].join()
 
+            if self.opts.parallel == 'fork' and self.opts.store_thread:
+                # so anything it sent to the MBTiles writer is already in the queue
+                self.store_thread.join()
+
+        if self.ring is not None:
+            # all the metatiles came back, so nobody is using it anymore
+            self.ring.close()
+
+        if self.backend is not None:
+            self.backend.close()
+
+        if self.writer is not None:
+            # all the stores finished, so everything was sent already
+            info('waiting for the MBTiles writer, %d batches left', self.writer.backlog())
+            self.writer.stop()
+
+        if self.journal is not None:
+            # everything in it is stored by now
+            self.journal.close()
+            info("journal %s checkpointed.", self.journal.path)
+
 
 def parse_args():
     parser = ArgumentParser()
@@ -858,7 +1453,7 @@ def parse_args():
     parser.add_argument('-i', '--input-file',       dest='mapfile',          default='osm.xml',
                         help="MapnikXML format.")
     parser.add_argument('-f', '--format',           dest='format',           default='tiles',
-                        choices=('tiles', 'mbtiles', 'mod_tile', 'test', 'svg', 'pdf'))
+                        choices=('tiles', 'mbtiles', 'pmtiles', 'mod_tile', 'test', 'svg', 'pdf'))
     parser.add_argument('-F', '--tile-file-format', dest='tile_file_format', default='png',
                         choices=('png', 'jpeg', 'svg', 'pdf'))
     parser.add_argument('-O', '--tile-file-format-options', dest='tile_file_format_options', default='',
@@ -866,6 +1461,17 @@ def parse_args():
     parser.add_argument('-o', '--output-dir',       dest='tile_dir',         default='tiles/')
     parser.add_argument(      '--filename-pattern', dest='filename_pattern', default=None,
                         help="Pattern may include {base_dir}, {x}, {y} and {z}.")
+    parser.add_argument(      '--mbtiles-batch-size',    dest='mbtiles_batch_size',    default=1000, type=int,
+                        help="Write the tiles to the MBTiles file in transactions of this many tiles...")
+    parser.add_argument(      '--mbtiles-batch-seconds', dest='mbtiles_batch_seconds', default=10.0, type=float,
+                        help="... or every this many seconds.")
+    parser.add_argument(      '--mbtiles-synchronous',   dest='mbtiles_synchronous',   default='NORMAL',
+                        choices=('OFF', 'NORMAL', 'FULL'),
+                        help="SQLite's synchronous PRAGMA for the MBTiles file.")
+    parser.add_argument(      '--mbtiles-queue-size',    dest='mbtiles_queue_size',    default=16, type=int,
+                        help="How many metatiles can be waiting for the MBTiles writer before the stores block.")
+    parser.add_argument(      '--mbtiles-page-size',     dest='mbtiles_page_size',     default=None, type=int,
+                        help="SQLite's page size for new MBTiles files.")
 
     # TODO: check it's a power of 2
     parser.add_argument('-m', '--metatile-size', dest='metatile_size', default=1, type=int,
@@ -875,8 +1481,22 @@ def parse_args():
                         type=int)
     parser.add_argument('-p', '--parallel-method', dest='parallel', default='fork',
                         choices=('threads', 'fork', 'single'))
+    parser.add_argument(      '--order',         dest='order',     default=None,
+                        choices=tuple(utils.curves.keys()),
+                        help="Render initial and sibling metatiles following this space filling curve, "
+                             "so consecutive renders hit neighbouring areas.")
     parser.add_argument(      '--store-thread', dest='store_thread', default=False,
                         action='store_true', help="Have a separate process/thread for storing the tiles.")
+    parser.add_argument(      '--store-transport', dest='store_transport', default='pickle',
+                        choices=('pickle', 'shm'),
+                        help="How the rendered metatiles are sent to the --store-thread in fork mode: "
+                             "encoded as PNG in the queue, or raw in shared memory.")
+    parser.add_argument(      '--encoders',     dest='encoders',     default=0, type=int,
+                        help="Amount of processes encoding the tiles for the --store-thread in fork mode. "
+                             "0 means the store encodes them itself.")
+    parser.add_argument(      '--checkers',     dest='checkers',     default=0, type=int,
+                        help="Amount of threads checking the metatiles about to be rendered "
+                             "(bbox, -X, -N) ahead of time. 0 means check them in the main loop.")
 
     parser.add_argument('-X', '--skip-existing', dest='skip_existing', default=False,
                         action='store_true')
@@ -885,18 +1505,40 @@ def parse_args():
                         type=float, metavar='DAYS')
     parser.add_argument('-M', '--missing-as-new',  dest='missing_as_new', default=False,
                         action='store_true', help="missing tiles in a meta tile count as newer, so we don't re-render metatiles with empty tiles.")
-    parser.add_argument('-e', '--empty-color',     dest='empty_color', metavar='[#]RRGGBB', required=True,
-                        help='Define the color of empty space (usually sea/ocean color) for empty tile detection.')
-    parser.add_argument('-s', '--empty-size',      dest='empty_size', type=int, default=103,
-                        help='The byte size of empty tiles.')
+    parser.add_argument(      '--journal',         dest='journal',   default=None, metavar='FILE',
+                        help="Log the metatiles done to FILE, so an interrupted run can be --resume'd.")
+    parser.add_argument(      '--resume',          dest='resume',    default=False, action='store_true',
+                        help="Continue the run logged in the --journal. The tiles it logged as done "
+                             "are not checked again. Not supported by the PMTiles format.")
+    parser.add_argument('-e', '--empty-color',     dest='empty_color', metavar='[#]RRGGBB[AA]|transparent',
+                        required=True, action='append',
+                        help='Define the color of empty space (usually sea/ocean color) for empty tile detection. '
+                             'Can be given several times.')
+    parser.add_argument('-s', '--empty-size',      dest='empty_size', type=int, default=None,
+                        help='Deprecated and ignored; empty tiles are detected on their pixels.')
     parser.add_argument('-E', '--empty',           dest='empty',     default='skip',
-                        choices=('skip', 'link', 'write'))
+                        choices=('skip', 'link', 'write'),
+                        help="link stores only one copy of each empty tile and links the rest to it.")
+    parser.add_argument(      '--blob-dir',        dest='blob_dir',  default=None,
+                        help="Where --empty link keeps the empty tiles' copies. "
+                             "Defaults to OUTPUT_DIR/.blobs. If it's in another filesystem, symlinks are used.")
+    parser.add_argument(      '--write-threads',   dest='write_threads', default=0, type=int,
+                        help="For -f tiles, write the files in the background with these many threads. "
+                             "Helps with network filesystems and spinning disks.")
+    parser.add_argument(      '--skip-unchanged',  dest='skip_unchanged', default=False, action='store_true',
+                        help="Do not rewrite tiles identical to the stored ones. For -f tiles the digests "
+                             "of the written tiles are kept in OUTPUT_DIR/.digests.sqlite.")
+    parser.add_argument(      '--changed-manifest', dest='changed_manifest', default=None, metavar='FILE',
+                        help="Append the Z/X/Y of the tiles actually written to FILE, for purging caches.")
 
     parser.add_argument(      '--debug',    dest='debug',    default=False,
                         action='store_true')
     parser.add_argument('-l', '--log-file', dest='log_file', default=None)
     parser.add_argument(      '--dry-run',  dest='dry_run',  default=False,
                         action='store_true')
+    parser.add_argument(      '--plan',     dest='plan',     default=False,
+                        action='store_true',
+                        help="Print the amount of metatiles and tiles to render per ZL and exit.")
 
     parser.add_argument(      '--mapnik-debug',  dest='mapnik_debug',  default=False,
                         action='store_true', help='''Turn on mapnik's debug logs.''')
@@ -959,8 +1601,26 @@ def parse_args():
         opts.tile_file_format = 'png'
 
     ## misc stuff for certain formats
-    if opts.format in ('mod_tile', 'test'):
-        # mod_tile's tiles are really metatiles, 8x8
+    if opts.format == 'mod_tile':
+        # renderd's .meta files are always 8x8 tiles
+        opts.tile_size = 256
+        opts.metatile_size = map_utils.METATILE
+
+        if opts.empty == 'skip':
+            # mod_tile expects all the tiles of a metatile in its file
+            info('mod_tile format. Storing empty tiles too.')
+            opts.empty = 'write'
+
+        if opts.tiles is not None:
+            metatiles = []
+
+            for tile_spec in opts.tiles:
+                z, x, y = tiles.tile_spec2zxy(tile_spec)
+                metatiles.append(tiles.MetaTile.from_tile(tiles.Tile(z, x, y), opts.metatile_size))
+
+            opts.tiles = metatiles
+    elif opts.format == 'test':
+        # test's tiles are really metatiles, 8x8
         # so we make the tile size 8 times a tile, and the metatile size is divided by 8
         opts.tile_size = 8 * 256
 
@@ -1075,23 +1735,58 @@ def parse_args():
         debug('th.Thread()')
         opts.parallel_factory = threading.Thread
 
+    if opts.encoders > 0 and not (opts.parallel == 'fork' and opts.store_thread):
+        # mapnik holds the GIL while encoding, so threads would not help,
+        # and without a store process the renderers already encode in parallel
+        warning('--encoders only works with --store-thread in fork mode. Ignoring.')
+        opts.encoders = 0
+
+    if opts.format == 'pmtiles' and opts.parallel == 'fork' and not opts.store_thread:
+        # the archive is written by only one process
+        warning('PMTiles format. Forcing store thread.')
+        opts.store_thread = True
+
+    if opts.resume and opts.journal is None:
+        error('--resume needs a --journal.')
+        sys.exit(1)
+
+    if opts.resume and opts.format == 'pmtiles':
+        # the archive is written from scratch on close(), so the tiles from the interrupted run would be lost
+        error("--resume can't be used with the PMTiles format.")
+        sys.exit(1)
+
     ## empty_color
-    # TODO: accept other formats
     try:
-        # cut the leading #
-        if len(opts.empty_color) == 7 and opts.empty_color[0] == '#':
-            opts.empty_color = opts.empty_color[1:]
-
-        opts.empty_color = bytes([ int(opts.empty_color[index:index + 2], 16)
-                                   for index in (0, 2, 4) ])
+        opts.empty_color = [ utils.parse_color(spec) for spec in opts.empty_color ]
     except ValueError:
         parser.print_help()
         sys.exit(1)
 
+    if opts.empty_size is not None:
+        warning('--empty-size is deprecated and ignored.')
+
     ## more_opts, for tile backends
     opts.more_opts = {}
+    if opts.format == 'mbtiles':
+        opts.more_opts.update(batch_size=opts.mbtiles_batch_size,
+                              batch_seconds=opts.mbtiles_batch_seconds,
+                              synchronous=opts.mbtiles_synchronous,
+                              page_size=opts.mbtiles_page_size)
+    if opts.format == 'pmtiles':
+        opts.more_opts['tile_format'] = opts.tile_file_format
     if opts.filename_pattern is not None:
         opts.more_opts['filename_pattern'] = opts.filename_pattern
+    if opts.blob_dir is not None:
+        opts.more_opts['blob_dir'] = os.path.abspath(opts.blob_dir)
+    if opts.write_threads > 0:
+        opts.more_opts['write_threads'] = opts.write_threads
+    if opts.skip_unchanged:
+        if opts.format not in ('tiles', 'mbtiles', 'test'):
+            warning(f"--skip-unchanged does not work with {opts.format} format. Ignoring.")
+        else:
+            opts.more_opts['skip_unchanged'] = True
+    if opts.changed_manifest is not None:
+        opts.more_opts['manifest'] = os.path.abspath(opts.changed_manifest)
 
     # semantic opts
     opts.single_tiles = opts.tiles is not None
@@ -1106,6 +1801,15 @@ def parse_args():
 if __name__  ==  "__main__":
     opts = parse_args()
 
+    if opts.plan:
+        if opts.single_tiles:
+            print(f"{len(opts.tiles)} metatiles, {sum( len(metatile.tiles) for metatile in opts.tiles )} tiles.")
+        else:
+            PyramidPlan(opts.bbox, opts.min_zoom, opts.max_zoom, opts.metatile_size,
+                        opts.tile_size).report()
+
+        sys.exit(0)
+
     master = Master(opts)
 
     # fixes for locally installed mapnik
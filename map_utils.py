@@ -2,30 +2,193 @@
 
 from math import pi, cos, sin, log, exp, atan
 from configparser import ConfigParser
+from concurrent.futures import Future, ThreadPoolExecutor
 import os.path
 from os.path import dirname, basename, join as path_join
 from os import listdir, unlink, mkdir, walk, makedirs
 import os
 from errno import ENOENT, EEXIST
 from shutil import copy, rmtree
+import array
+from collections import defaultdict, deque
 import datetime
 import errno
+import gzip
 import hashlib
+import json
+import mmap
+import multiprocessing
+import queue
+import signal
 import sqlite3
-import stat
+import struct
+import threading
+import time
 
+import numpy
 from shapely.geometry import Polygon
+from shapely.geometry.base import BaseGeometry
 from shapely import wkt
 
-from tiles import GoogleProjection, Tile, MetaTile, PixelTile
+from tiles import GoogleProjection, Tile, MetaTile, PixelTile, tileproj
+import utils
 
-from logging import debug
-from typing import List, Tuple, Dict, Optional, Any, Union
+from logging import debug, info
+from typing import List, Tuple, Deque, Dict, Optional, Any, Set, Union
 
 
 # helper types
 TileOrTuple = Union[Tile, Tuple[int, int, int]]
 
+
+def tile_digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class Generations:
+    '''Numbers a backend's commit()s and keeps track of which ones are written, so the
+    callers can tell when what they stored is durable. With threads they can finish
+    out of order; durable is the last generation such that all the ones up to it are written.'''
+    def __init__(self):
+        self.last = 0
+        self.durable = 0
+        # finished, but after one that isn't
+        self.done:Set[int] = set()
+        self.lock = threading.Lock()
+
+
+    def next(self) -> int:
+        with self.lock:
+            self.last += 1
+            return self.last
+
+
+    def finish(self, generation: int):
+        with self.lock:
+            if generation > self.durable:
+                self.done.add(generation)
+
+            while self.durable + 1 in self.done:
+                self.durable += 1
+                self.done.remove(self.durable)
+
+
+    def finish_upto(self, generation: int):
+        '''All the generations up to this one are written.'''
+        with self.lock:
+            if generation > self.durable:
+                self.durable = generation
+                self.done = { done for done in self.done if done > generation }
+
+            while self.durable + 1 in self.done:
+                self.durable += 1
+                self.done.remove(self.durable)
+
+
+    def finish_all(self):
+        self.finish_upto(self.last)
+
+
+class TileDigests:
+    '''A sidecar SQLite db with the digest and mtime of each tile as it was written,
+    and when it was last rendered. With it, DiskBackend can tell that a tile didn't
+    change without reading it back. New rows are kept until flush().'''
+    def __init__(self, path: str):
+        self.path = path
+        # (z, x, y, digest, mtime_ns, rendered_at)
+        self.pending:List[Tuple[int, int, int, bytes, int, float]] = []
+        self.lock = threading.Lock()
+        # connections can't be shared between threads nor fork()s
+        self.local = threading.local()
+
+
+    def connection(self) -> sqlite3.Connection:
+        if getattr(self.local, 'pid', None) != os.getpid():
+            makedirs(os.path.dirname(self.path), exist_ok=True)
+            # several processes might be writing, wait for each other
+            session = sqlite3.connect(self.path, timeout=60)
+            session.execute('PRAGMA journal_mode = WAL;')
+            session.execute('''CREATE TABLE IF NOT EXISTS digests(
+                zoom_level   INTEGER NOT NULL,
+                tile_column  INTEGER NOT NULL,
+                tile_row     INTEGER NOT NULL,
+                digest       BLOB NOT NULL,
+                mtime_ns     INTEGER NOT NULL,
+                rendered_at  REAL NOT NULL,
+                PRIMARY KEY (zoom_level, tile_column, tile_row)
+            );''')
+            session.commit()
+
+            self.local.session = session
+            self.local.pid = os.getpid()
+
+        return self.local.session
+
+
+    def get(self, z: int, x: int, y: int) -> Optional[Tuple[bytes, int, float]]:
+        '''Returns the digest, mtime and rendering time of the tile, if known.'''
+        return self.connection().execute('''SELECT digest, mtime_ns, rendered_at FROM digests
+                                            WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;''',
+                                         (z, x, y)).fetchone()
+
+
+    def get_range(self, z: int, x0: int, x1: int, y0: int, y1: int) -> Dict[Tuple[int, int], Tuple[bytes, int, float]]:
+        '''Bulk version of get() for the tiles in [x0, x1] x [y0, y1], in one query.
+        Returns { (x, y): (digest, mtime_ns, rendered_at) }.'''
+        rows = self.connection().execute('''SELECT tile_column, tile_row, digest, mtime_ns, rendered_at
+                                            FROM digests
+                                            WHERE zoom_level = ?
+                                              AND tile_column BETWEEN ? AND ?
+                                              AND tile_row BETWEEN ? AND ?;''',
+                                         (z, x0, x1, y0, y1))
+
+        return { (x, y): (digest, mtime_ns, rendered_at) for x, y, digest, mtime_ns, rendered_at in rows }
+
+
+    def record(self, z: int, x: int, y: int, digest: bytes, mtime_ns: int, rendered_at: float):
+        with self.lock:
+            self.pending.append( (z, x, y, digest, mtime_ns, rendered_at) )
+
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+
+        if len(batch) > 0:
+            session = self.connection()
+            session.executemany('''INSERT OR REPLACE INTO digests
+                                   (zoom_level, tile_column, tile_row, digest, mtime_ns, rendered_at)
+                                   VALUES (?, ?, ?, ?, ?, ?);''', batch)
+            session.commit()
+
+
+class ChangeManifest:
+    '''Appends z/x/y lines for the tiles that were written to a file,
+    so the caches downstream know what to purge. The lines are kept until flush().'''
+    def __init__(self, path: str):
+        self.path = path
+        self.pending:List[str] = []
+        self.lock = threading.Lock()
+
+
+    def add(self, z: int, x: int, y: int):
+        with self.lock:
+            self.pending.append(f"{z}/{x}/{y}\n")
+
+
+    def flush(self):
+        with self.lock:
+            lines, self.pending = self.pending, []
+
+        if len(lines) > 0:
+            # appending with one write(), so several processes can share it
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, ''.join(lines).encode('ascii'))
+            finally:
+                os.close(fd)
+
+
 class DiskBackend:
     fs_based = True
 
@@ -34,6 +197,49 @@ class DiskBackend:
         self.filename_pattern = even_more.get('filename_pattern',
                                               '{base_dir}/{z}/{x}/{y}.png')
 
+        # dir -> { name: os.DirEntry }, see scan()
+        self.dir_cache = utils.LRUCache(256)
+        # the checker threads use it concurrently
+        self.dir_cache_lock = threading.Lock()
+
+        # content addressed store for link(); we remember the blobs we know exist
+        self.blob_dir = even_more.get('blob_dir', None) or os.path.join(base, '.blobs')
+        self.known_blobs = utils.LRUCache(1024)
+
+        # the dirs we know exist, so we don't makedirs() for every tile
+        self.made_dirs = utils.LRUCache(1024)
+        self.made_dirs_lock = threading.Lock()
+
+        # write-behind: if > 0, the files are written by these many threads, see store()
+        self.write_threads = even_more.get('write_threads', 0)
+        # created on the first store(), so it's in the process that writes
+        self.writers:Optional[ThreadPoolExecutor] = None
+        # the writes since the last commit(), and the ones before that
+        self.writing:List[Future] = []
+        self.committed:List[Future] = []
+        self.committed_generation = 0
+        self.writing_lock = threading.Lock()
+        # see commit() and durable()
+        self.generations = Generations()
+
+        # stats
+        self.writes = 0
+        self.write_time = 0.0
+        self.max_write_time = 0.0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.total_queue_depth = 0
+
+        # compare-before-write, see store()
+        self.digests:Optional[TileDigests] = None
+        if even_more.get('skip_unchanged', False):
+            self.digests = TileDigests(os.path.join(base, '.digests.sqlite'))
+        self.skipped = 0
+
+        self.manifest:Optional[ChangeManifest] = None
+        if even_more.get('manifest', None) is not None:
+            self.manifest = ChangeManifest(even_more['manifest'])
+
 
     def tile_uri(self, tile: TileOrTuple) -> str:
         # this works because I made Tile iterable
@@ -43,14 +249,164 @@ class DiskBackend:
         return self.filename_pattern.format(**locals())
 
 
+    def makedirs(self, dir_name: str):
+        '''makedirs() but only for the dirs we don't know exist.'''
+        if dir_name in self.made_dirs:
+            return
+
+        makedirs(dir_name, exist_ok=True)
+
+        with self.made_dirs_lock:
+            self.made_dirs[dir_name] = True
+
+
+    def unchanged(self, tile_uri: str, digest: bytes, known: Optional[Tuple[bytes, int, float]]) -> bool:
+        '''Whether the stored tile has the same digest, according to what the digests
+        db knows. The mtime must match too, in case the file was replaced behind our back.'''
+        if known is None or known[0] != digest:
+            return False
+
+        try:
+            return os.stat(tile_uri).st_mtime_ns == known[1]
+        except FileNotFoundError:
+            return False
+
+
     def store(self, tile: Tile):
         assert tile.data is not None
 
         tile_uri = self.tile_uri(tile)
-        makedirs(os.path.dirname(tile_uri), exist_ok=True)
-        f = open(tile_uri, 'wb+')
-        f.write(tile.data)
-        f.close()
+
+        digest = None
+        if self.digests is not None:
+            digest = tile_digest(tile.data)
+            known = self.digests.get(tile.z, tile.x, tile.y)
+
+            if self.unchanged(tile_uri, digest, known):
+                # do not write it, but remember it was rendered, for -N
+                assert known is not None
+                self.digests.record(tile.z, tile.x, tile.y, digest, known[1], time.time())
+                self.skipped += 1
+                return
+
+        self.makedirs(os.path.dirname(tile_uri))
+
+        if self.write_threads == 0:
+            self.write(tile_uri, tile.data, (tile.z, tile.x, tile.y), digest)
+            return
+
+        with self.writing_lock:
+            if self.writers is None:
+                self.writers = ThreadPoolExecutor(self.write_threads, thread_name_prefix='writer')
+
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            self.total_queue_depth += self.queue_depth
+
+            self.writing.append(self.writers.submit(self.write, tile_uri, tile.data,
+                                                    (tile.z, tile.x, tile.y), digest))
+
+
+    def write(self, tile_uri: str, data: bytes, tile: Tuple[int, int, int],
+              digest: Optional[bytes]):
+        start = time.perf_counter()
+
+        # write to a temp file and rename it, so we never write through a link into a
+        # blob shared with other tiles (see link()), and readers never see half written tiles;
+        # the thread id is there because with write-behind several threads write at the same time
+        temp_uri = f"{tile_uri}.{os.getpid()}.{threading.get_ident()}"
+
+        try:
+            try:
+                with open(temp_uri, 'wb') as f:
+                    f.write(data)
+
+                os.replace(temp_uri, tile_uri)
+            except OSError:
+                if os.path.exists(temp_uri):
+                    os.unlink(temp_uri)
+                raise
+
+            if digest is not None:
+                assert self.digests is not None
+                self.digests.record(*tile, digest, os.stat(tile_uri).st_mtime_ns, time.time())
+
+            if self.manifest is not None:
+                self.manifest.add(*tile)
+        finally:
+            elapsed = time.perf_counter() - start
+
+            with self.writing_lock:
+                self.writes += 1
+                self.write_time += elapsed
+                self.max_write_time = max(self.max_write_time, elapsed)
+                if self.write_threads > 0:
+                    self.queue_depth -= 1
+
+
+    def blob_uri(self, data: bytes, extension: str) -> str:
+        digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+
+        # fan out so no dir gets too big
+        return os.path.join(self.blob_dir, digest[:2], digest + extension)
+
+
+    def write_blob(self, blob_uri: str, data: bytes):
+        makedirs(os.path.dirname(blob_uri), exist_ok=True)
+
+        # other processes might be linking to it, so it must appear complete
+        temp_uri = f"{blob_uri}.{os.getpid()}"
+        with open(temp_uri, 'wb') as f:
+            f.write(data)
+
+        os.replace(temp_uri, blob_uri)
+
+
+    def link(self, tile: Tile):
+        '''Stores the tile as a link to a blob with its data, so identical tiles
+        (sea, land fill...) are written only once.'''
+        assert tile.data is not None
+
+        tile_uri = self.tile_uri(tile)
+        blob_uri = self.blob_uri(tile.data, os.path.splitext(tile_uri)[1])
+
+        if self.digests is not None:
+            try:
+                if os.path.samefile(tile_uri, blob_uri):
+                    # already linked to the same data
+                    self.skipped += 1
+                    return
+            except FileNotFoundError:
+                pass
+
+        if blob_uri not in self.known_blobs:
+            if not os.path.isfile(blob_uri):
+                self.write_blob(blob_uri, tile.data)
+
+            self.known_blobs[blob_uri] = True
+
+        self.makedirs(os.path.dirname(tile_uri))
+
+        # link to a temp name and rename, so we replace the tile atomically
+        temp_uri = f"{tile_uri}.{os.getpid()}"
+        try:
+            os.link(blob_uri, temp_uri)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                # the blobs are in another fs
+                os.symlink(blob_uri, temp_uri)
+            elif e.errno == errno.EMLINK:
+                # the blob has as many links as the fs allows, start a new one;
+                # the old links keep pointing to the old one
+                self.write_blob(blob_uri, tile.data)
+                os.link(blob_uri, temp_uri)
+            else:
+                raise
+
+        os.replace(temp_uri, tile_uri)
+
+        if self.manifest is not None:
+            self.manifest.add(tile.z, tile.x, tile.y)
 
 
     def exists(self, tile: TileOrTuple):
@@ -73,7 +429,24 @@ class DiskBackend:
             return True
 
 
+    def rendered_at(self, tile: TileOrTuple) -> Optional[float]:
+        '''When the tile was last rendered, even if it was not written because it
+        didn't change. Only known with the digests db.'''
+        if self.digests is None:
+            return None
+
+        known = self.digests.get(*tile)
+        if known is None:
+            return None
+
+        return known[2]
+
+
     def newer_than(self, tile: TileOrTuple, date, missing_as_new):
+        rendered_at = self.rendered_at(tile)
+        if rendered_at is not None:
+            return rendered_at > date.timestamp()
+
         tile_uri = self.tile_uri(tile)
         try:
             file_date = datetime.datetime.fromtimestamp(os.stat(tile_uri).st_mtime)
@@ -88,20 +461,219 @@ class DiskBackend:
                 raise
 
 
-    def commit(self):
-        # TODO: flush?
-        pass
+    def scan(self, dir_name:str) -> Dict[str, os.DirEntry]:
+        '''Returns the entries in dir_name. Directories are scanned only once, and
+        the results are kept for the most recently used ones. This is meant for
+        checking tiles before rendering them, so it doesn't see tiles stored later.'''
+        with self.dir_cache_lock:
+            try:
+                return self.dir_cache[dir_name]
+            except KeyError:
+                pass
+
+        entries = {}
+        try:
+            with os.scandir(dir_name) as dir_entries:
+                for entry in dir_entries:
+                    entries[entry.name] = entry
+        except FileNotFoundError:
+            pass
+
+        with self.dir_cache_lock:
+            self.dir_cache[dir_name] = entries
+
+        return entries
+
+
+    def entries(self, metatile):
+        '''Yields the os.DirEntry of each of the metatile's tiles, or None for missing ones.'''
+        for tile in metatile.tiles:
+            dir_name, file_name = os.path.split(self.tile_uri(tile))
+            yield self.scan(dir_name).get(file_name, None)
+
+
+    def all_exist(self, metatile) -> bool:
+        '''Bulk version of exists() for all the tiles of a metatile.'''
+        return all( entry is not None for entry in self.entries(metatile) )
+
+
+    def all_newer_than(self, metatile, date, missing_as_new) -> bool:
+        '''Bulk version of newer_than() for all the tiles of a metatile.'''
+        timestamp = date.timestamp()
+
+        # the rendering times of all the tiles in one query
+        known:Dict[Tuple[int, int], Tuple[bytes, int, float]] = {}
+        if self.digests is not None:
+            if isinstance(metatile, MetaTile):
+                known = self.digests.get_range(metatile.z, metatile.x, metatile.x + metatile.size - 1,
+                                               metatile.y, metatile.y + metatile.size - 1)
+            else:
+                # PixelTile
+                for tile in metatile.tiles:
+                    found = self.digests.get(*tile)
+                    if found is not None:
+                        known[(tile.x, tile.y)] = found
+
+        for tile, entry in zip(metatile.tiles, self.entries(metatile)):
+            if entry is None:
+                if not missing_as_new:
+                    return False
+                continue
+
+            if (tile.x, tile.y) in known:
+                rendered_at = known[(tile.x, tile.y)][2]
+            else:
+                # getdents() does not return mtimes, so this stat()s,
+                # but only the present tiles, and we stop at the first old one
+                rendered_at = entry.stat().st_mtime
+
+            if not rendered_at > timestamp:
+                return False
+
+        return True
+
+
+    def commit(self) -> int:
+        '''With write-behind, waits for the writes from the previous commit(),
+        so the current ones overlap with the next metatile, but no more than
+        two metatiles are in flight. Write errors are raised here.
+        Returns the generation of the tiles stored so far, see durable().'''
+        with self.writing_lock:
+            previous, self.committed, self.writing = self.committed, self.writing, []
+            previous_generation = self.committed_generation
+            self.committed_generation = generation = self.generations.next()
+
+        for future in previous:
+            future.result()
+
+        if self.digests is not None:
+            self.digests.flush()
+
+        if self.manifest is not None:
+            self.manifest.flush()
+
+        if self.write_threads == 0:
+            # store() already wrote them
+            self.generations.finish_upto(generation)
+        elif previous_generation > 0:
+            self.generations.finish(previous_generation)
+
+        return generation
+
+
+    def durable(self) -> int:
+        '''The last generation returned by commit() whose tiles are all written.'''
+        return self.generations.durable
+
+
+    def flush(self):
+        '''Waits for all the writes.'''
+        self.commit()
+        self.commit()
+
+
+    def close(self):
+        if self.writers is not None:
+            self.flush()
+            self.writers.shutdown()
+            self.writers = None
+        else:
+            self.commit()
+
+        self.generations.finish_all()
+
+        if self.skipped > 0:
+            info("%s: %d tiles unchanged, not written", self.base_dir, self.skipped)
+
+        if self.writes > 0:
+            info("%s: %d tiles written, %.3fms avg, %.3fms max; queue depth %.1f avg, %d max",
+                 self.base_dir, self.writes, self.write_time / self.writes * 1000,
+                 self.max_write_time * 1000, self.total_queue_depth / self.writes,
+                 self.max_queue_depth)
 
 
     def __contains__(self, tile: TileOrTuple):
         return self.exists(tile)
 
 
+# see mod_tile's includes/store_file.h
+METATILE = 8
+# magic, count, x, y, z; then count (offset, size) entries
+META_HEADER = struct.Struct('<4s4i')
+META_ENTRY = struct.Struct('<2i')
+META_MAGIC = b'META'
+
+
+def meta_offset(x: int, y: int) -> int:
+    '''The position of tile (x, y)'s entry in its metatile's index.'''
+    mask = METATILE - 1
+    return (x & mask) * METATILE + (y & mask)
+
+
+def write_meta(path: str, z: int, x: int, y: int, datas: Dict[int, bytes]):
+    '''Writes a mod_tile .meta file for the metatile with origin (x, y) with the data
+    of its tiles, indexed by meta_offset(). Missing tiles get an empty entry.
+    It's written in one go to a temp file that is then renamed, so mod_tile never
+    sees a half written metatile.'''
+    count = METATILE * METATILE
+    header = bytearray(META_HEADER.pack(META_MAGIC, count, x, y, z))
+
+    offset = META_HEADER.size + count * META_ENTRY.size
+    for index in range(count):
+        size = len(datas.get(index, b''))
+        header.extend(META_ENTRY.pack(offset, size))
+        offset += size
+
+    makedirs(os.path.dirname(path), exist_ok=True)
+
+    temp_path = f"{path}.{os.getpid()}"
+    with open(temp_path, 'wb') as f:
+        f.write(b''.join([ header ] + [ datas.get(index, b'') for index in range(count) ]))
+
+    os.replace(temp_path, path)
+
+
+def read_meta(path: str, x: int, y: int) -> Optional[bytes]:
+    '''Returns the data of tile (x, y) from the .meta file, or None if it's not there.'''
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return None
+
+    with f:
+        magic, count, _, _, _ = META_HEADER.unpack(f.read(META_HEADER.size))
+        index = meta_offset(x, y)
+        if magic != META_MAGIC or index >= count:
+            return None
+
+        f.seek(META_HEADER.size + index * META_ENTRY.size)
+        offset, size = META_ENTRY.unpack(f.read(META_ENTRY.size))
+        if size == 0:
+            return None
+
+        f.seek(offset)
+        return f.read(size)
+
+
 class ModTileBackend(DiskBackend):
+    '''Writes renderd's .meta files: the tiles of each 8x8 metatile go into one file
+    with an index. The tiles are kept in memory until all of the metatile's are
+    stored, and then it's written at once. Needs metatiles of size 8.'''
+    # the tiles are inside the .meta files, they can't be served as files
+    fs_based = False
+
+    def __init__(self, base:str, *more, **even_more):
+        super().__init__(base, *more, **even_more)
+
+        # meta path -> (z, x, y, { meta_offset: data })
+        self.metatiles:Dict[str, Tuple[int, int, int, Dict[int, bytes]]] = {}
+        self.metatiles_lock = threading.Lock()
+
+
     def tile_uri(self, tile: TileOrTuple):
         # The metatiles are then stored
         # in the following directory structure:
-        # /[base_dir]/[TileSetName]/[Z]/[xxxxyyyy]/[xxxxyyyy]/[xxxxyyyy]/[xxxxyyyy]/[xxxxyyyy].png
+        # /[base_dir]/[TileSetName]/[Z]/[xxxxyyyy]/[xxxxyyyy]/[xxxxyyyy]/[xxxxyyyy]/[xxxxyyyy].meta
         # Where base_dir is a configurable base path for all tiles. TileSetName
         # is the name of the style sheet rendered. Z is the zoom level.
         # [xxxxyyyy] is an 8 bit number, with the first 4 bits taken from the x
@@ -109,24 +681,84 @@ class ModTileBackend(DiskBackend):
         # attempts to cluster 16x16 square of tiles together into a single sub
         # directory for more efficient access patterns.
         z, x, y = tile
+        # all the tiles of a metatile go to its file
+        x &= ~(METATILE - 1)
+        y &= ~(METATILE - 1)
 
         crumbs: List[str] = []
         for crumb_index in range(5):
             x, x_bits = divmod(x, 16)
             y, y_bits = divmod(y, 16)
-            debug((x, x_bits, y, y_bits))
 
             crumb = (x_bits << 4) + y_bits
             crumbs.insert(0, str(crumb))
 
-        return os.path.join(self.base_dir, str(z), *crumbs[:-1], crumbs[-1] + '.png')
+        return os.path.join(self.base_dir, str(z), *crumbs[:-1], crumbs[-1] + '.meta')
+
+
+    def store(self, tile: Tile):
+        assert tile.data is not None
+
+        meta_uri = self.tile_uri(tile)
+        mask = ~(METATILE - 1)
+
+        with self.metatiles_lock:
+            z, x, y, datas = self.metatiles.setdefault(meta_uri,
+                                                       (tile.z, tile.x & mask, tile.y & mask, {}))
+            datas[meta_offset(tile.x, tile.y)] = tile.data
+
+
+    # the empty tiles also go inside the metatile
+    link = store
+
+
+    def write(self, complete_only: bool):
+        with self.metatiles_lock:
+            ready = []
+
+            for meta_uri, (z, x, y, datas) in list(self.metatiles.items()):
+                # the low ZLs have less than 8x8 tiles
+                size = min(METATILE, 2**z)
+                if not complete_only or len(datas) == size**2:
+                    ready.append( (meta_uri, z, x, y, datas) )
+                    del self.metatiles[meta_uri]
+
+        for meta_uri, z, x, y, datas in ready:
+            write_meta(meta_uri, z, x, y, datas)
+
+
+    def commit(self) -> int:
+        generation = self.generations.next()
+
+        # in threads mode other stores could be halfway through theirs
+        self.write(complete_only=True)
+
+        with self.metatiles_lock:
+            if len(self.metatiles) == 0:
+                self.generations.finish_upto(generation)
+
+        return generation
+
+
+    def close(self):
+        self.write(complete_only=False)
+        self.generations.finish_all()
+
+
+    def fetch(self, tile: Tile):
+        data = read_meta(self.tile_uri(tile), tile.x, tile.y)
+        if data is None:
+            return False
+
+        tile.data = data
+
+        return True
 
 
 class TestBackend(DiskBackend):
     def __init__(self, base:str, *more, **even_more):
-        self.base_dir = base
-        self.filename_pattern = even_more.get('filename_pattern',
-                                              '{base_dir}/{z}-{x}-{y}.png')
+        even_more.setdefault('filename_pattern', '{base_dir}/{z}-{x}-{y}.png')
+        super().__init__(base, *more, **even_more)
 
 
 # https://github.com/mapbox/node-mbtiles/blob/master/lib/schema.sql
@@ -141,27 +773,79 @@ class TestBackend(DiskBackend):
 # it's implemented as a (read only) view on top of map an images
 # but internally we fill them separately
 
+# blake2b's 16 bytes digest of the data, as a BLOB
+TILE_ID_FORMAT = 'blake2b-16'
+
+
 class MBTilesBackend:
     fs_based = False
 
     # .sqlitedb 'cause I'll use it primarily for OsmAnd
-    def __init__(self, path, bounds, min_zoom=0, max_zoom=18, center=None, ro=False):
+    def __init__(self, path, bounds, min_zoom=0, max_zoom=18, center=None, ro=False,
+                 batch_size=1, batch_seconds=60.0, synchronous='NORMAL', page_size=None,
+                 writer=None, skip_unchanged=False, manifest=None, **even_more):
         self.path = path
 
+        # tiles are buffered and written in one transaction every batch_size tiles
+        # or batch_seconds seconds, whatever comes first; see commit()
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        # (z, x, y, tile_id, data, rendered_at); data is None if the tile_id was already stored
+        self.pending:List[Tuple[int, int, int, Union[bytes, str], Optional[bytes], int]] = []
+        self.pending_lock = threading.Lock()
+        self.last_flush = time.monotonic()
+
+        # if there's a writer, the pending tiles are sent to it instead, see flush()
+        self.writer:Optional[MBTilesWriter] = writer
+        # see commit() and durable(); with a writer, the generation and the writer's ticket of each batch
+        self.generations = Generations()
+        self.tickets:Deque[Tuple[int, int]] = deque()
+        self.last_ticket = 0
+
+        # do not update the tiles that did not change, see flush()
+        self.skip_unchanged = skip_unchanged
+        self.manifest:Optional[ChangeManifest] = None
+        if manifest is not None:
+            self.manifest = ChangeManifest(manifest)
+
         if ro:
             spec = 'file:' + self.path + '?mode=ro'
             # print(spec)
             self.session = sqlite3.connect(spec, uri=True)
         else:
+            new = not os.path.exists(self.path)
             self.session = sqlite3.connect(self.path)
-        self.session.set_trace_callback(print)
 
-        if not stat.S_ISREG(os.stat(self.path).st_mode):
-            # create the db
-            self.init()
+            if new and page_size is not None:
+                # it only works before creating the tables
+                self.session.execute(f"PRAGMA page_size = {int(page_size)};")
 
+            # readers (like the checks for -X) don't block the writer, and commits are cheaper
+            self.session.execute('PRAGMA journal_mode = WAL;')
+            # NORMAL is still safe with WAL, it just might lose the last transactions
+            self.session.execute(f"PRAGMA synchronous = {synchronous};")
+
+            if new:
+                # create the db
+                self.init(bounds, min_zoom, max_zoom)
+            else:
+                self.migrate()
+
+        # files from before it was recorded use md5 hexdigests
+        self.tile_id_format = self.get_metadata('tile_id_format', 'md5-hex')
+        # the ids we stored recently; duplicated tiles skip the images INSERT
+        self.seen_ids = utils.LRUCache(4096)
+
+        # sqlite3 connections can't be shared between threads,
+        # so other threads get their own read only one, see reader()
+        self.owner = threading.get_ident()
+        self.local = threading.local()
+
+
+    def init(self, bounds, min_zoom, max_zoom):
+        if isinstance(bounds, BBox):
+            bounds = (bounds.w, bounds.s, bounds.e, bounds.n)
 
-    def init(self):
         cursor = self.session.cursor()
         # mbtiles
         cursor.execute('''CREATE TABLE IF NOT EXISTS metadata(
@@ -193,35 +877,29 @@ class MBTilesBackend:
             zoom_level   INTEGER NOT NULL,
             tile_column  INTEGER NOT NULL,
             tile_row     INTEGER NOT NULL,
-            tile_id      VARCHAR(32),
+            tile_id      BLOB,
+            -- seconds since the epoch, for newer_than()
+            rendered_at  INTEGER,
             CONSTRAINT map_index PRIMARY KEY (zoom_level, tile_column, tile_row)
         );''')
 
+        # covers the ranged queries of all_newer_than()
+        cursor.execute('''CREATE INDEX IF NOT EXISTS map_rendered_at
+            ON map (zoom_level, tile_column, tile_row, rendered_at);''')
+
         cursor.execute('''CREATE TABLE IF NOT EXISTS images(
-            tile_id    VARCHAR(32) NOT NULL,
+            tile_id    BLOB NOT NULL,
             tile_data  BLOB,
             PRIMARY KEY (tile_id)
         );''')
 
-        # see https://gist.github.com/rzymek/034ef469fa01fdd592a6aadde76e95fa
-        # just ignore the info about inverted y/tile_row
-        cursor.execute('''CREATE VIEW IF NOT EXISTS tiles AS
-            SELECT
-                -- mbtiles
-                map.zoom_level    AS zoom_level,
-                map.tile_column   AS tile_column,
-                map.tile_row      AS tile_row,
-                images.tile_data  AS tile_data,
+        cursor.execute('''CREATE TABLE IF NOT EXISTS max_y(
+            z  INTEGER NOT NULL,
+            y  INTEGER NOT NULL,
+            PRIMARY KEY (z)
+        );''')
 
-                -- OsmAnd
-                map.zoom_level    AS z,
-                map.tile_column   AS x,
-                map.tile_row      AS y,
-                0                 AS s,  -- TODO: check where does this 's' come from
-                images.tile_data  AS image
-            FROM
-                map JOIN images
-                    ON images.tile_id = map.tile_id;''')
+        self.create_views(cursor)
 
         self.session.commit()
 
@@ -239,6 +917,8 @@ class MBTilesBackend:
             format ='png',
             bounds =','.join([ str(i) for i in bounds ]),
             attribution ='Map data © OpenStreetMap CC-BY-SA; NASA SRTM',
+            # not in the spec, see tile_id()
+            tile_id_format=TILE_ID_FORMAT,
         )
 
         for k, v in metadata.items():
@@ -259,59 +939,273 @@ class MBTilesBackend:
             cursor.execute('''INSERT INTO max_y(z, y) VALUES (?, ?);''', (z, 2**z - 1))
 
         self.session.commit()
-        self.session.set_trace_callback(None)
 
         cursor.close()
 
 
+    def create_views(self, cursor):
+        # see https://gist.github.com/rzymek/034ef469fa01fdd592a6aadde76e95fa
+        # just ignore the info about inverted y/tile_row
+        cursor.execute('''CREATE VIEW IF NOT EXISTS tiles AS
+            SELECT
+                -- mbtiles
+                map.zoom_level    AS zoom_level,
+                map.tile_column   AS tile_column,
+                map.tile_row      AS tile_row,
+                images.tile_data  AS tile_data,
+
+                -- OsmAnd
+                map.zoom_level    AS z,
+                map.tile_column   AS x,
+                map.tile_row      AS y,
+                0                 AS s,  -- TODO: check where does this 's' come from
+                images.tile_data  AS image
+            FROM
+                map JOIN images
+                    ON images.tile_id = map.tile_id;''')
+
+
+    def get_metadata(self, name: str, default: Optional[str]=None) -> Optional[str]:
+        cursor = self.session.cursor()
+        data = cursor.execute('''SELECT value FROM metadata WHERE name = ?;''', (name, )).fetchall()
+        cursor.close()
+
+        if len(data) == 0:
+            return default
+
+        return data[0][0]
+
+
+    def migrate(self):
+        '''Bring files created by older versions up to date.'''
+        cursor = self.session.cursor()
+        columns = [ column[1] for column in cursor.execute('PRAGMA table_info(map);') ]
+
+        if 'rendered_at' not in columns:
+            # the existing tiles' timestamps are NULL, which newer_than() considers old
+            cursor.execute('ALTER TABLE map ADD COLUMN rendered_at INTEGER;')
+            cursor.execute('''CREATE INDEX IF NOT EXISTS map_rendered_at
+                ON map (zoom_level, tile_column, tile_row, rendered_at);''')
+            self.session.commit()
+
+        cursor.close()
+
+
+    def migrate_tile_ids(self):
+        '''Convert the tile_ids of files from before TILE_ID_FORMAT. It rewrites
+        the images table, so it takes a while and needs as much free space.'''
+        if self.tile_id_format == TILE_ID_FORMAT:
+            return
+
+        self.flush()
+        cursor = self.session.cursor()
+        # all or nothing
+        cursor.execute('''BEGIN;''')
+
+        # leftovers from an interrupted migration
+        cursor.execute('''DROP TABLE IF EXISTS images_new;''')
+        cursor.execute('''CREATE TABLE images_new(
+            tile_id    BLOB NOT NULL,
+            tile_data  BLOB,
+            PRIMARY KEY (tile_id)
+        );''')
+        cursor.execute('''CREATE TEMPORARY TABLE tile_ids(
+            old_id  VARCHAR(32) NOT NULL,
+            new_id  BLOB NOT NULL,
+            PRIMARY KEY (old_id)
+        );''')
+
+        writer = self.session.cursor()
+        for old_id, image in cursor.execute('''SELECT tile_id, tile_data FROM images;'''):
+            new_id = hashlib.blake2b(image, digest_size=16).digest()
+
+            writer.execute('''INSERT OR IGNORE INTO images_new (tile_id, tile_data) VALUES (?, ?);''',
+                           (new_id, image))
+            writer.execute('''INSERT INTO tile_ids (old_id, new_id) VALUES (?, ?);''',
+                           (old_id, new_id))
+        writer.close()
+
+        cursor.execute('''UPDATE map
+                          SET tile_id = (SELECT new_id FROM tile_ids WHERE old_id = map.tile_id);''')
+
+        cursor.execute('''DROP VIEW IF EXISTS tiles;''')
+        cursor.execute('''DROP TABLE images;''')
+        cursor.execute('''ALTER TABLE images_new RENAME TO images;''')
+        cursor.execute('''DROP TABLE tile_ids;''')
+        self.create_views(cursor)
+
+        cursor.execute('''INSERT OR REPLACE INTO metadata (name, value) VALUES ('tile_id_format', ?);''',
+                       (TILE_ID_FORMAT, ))
+        self.session.commit()
+        cursor.close()
+
+        self.tile_id_format = TILE_ID_FORMAT
+        self.seen_ids.clear()
+
+
     def store (self, tile: Tile):
         assert tile.data is not None
 
         self.store_raw(tile.z, tile.x, tile.y, tile.data)
 
 
+    # the images are already deduplicated by their tile_id
+    link = store
+
+
+    def tile_id (self, image: bytes) -> Union[bytes, str]:
+        if self.tile_id_format == 'md5-hex':
+            # create one of these each time because there's no way to reset them
+            # and barely takes any time
+            hasher = hashlib.md5()
+
+            # md5 gives 340282366920938463463374607431768211456 possible values
+            # and is *fast*
+            hasher.update(image)
+
+            # thanks Pablo Carranza for pointing out possible collisions
+            # further deduplicate with file length
+            hasher.update(str(len(image)).encode('ascii'))
+
+            return hasher.hexdigest()
+
+        # faster than md5, and the 16 raw bytes are half the size of the hexdigest
+        return hashlib.blake2b(image, digest_size=16).digest()
+
+
     def store_raw (self, z: int, x: int, y: int, image: bytes):
-        # create one of these each time because there's no way to reset them
-        # and barely takes any time
-        hasher = hashlib.md5()
+        img_id = self.tile_id(image)
 
-        # md5 gives 340282366920938463463374607431768211456 possible values
-        # and is *fast*
-        hasher.update(image)
+        debug(((z, x, y), img_id))
 
-        # thanks Pablo Carranza for pointing out possible collisions
-        # further deduplicate with file length
-        hasher.update(str(len(image)).encode('ascii'))
-        img_id = hasher.hexdigest()
+        with self.pending_lock:
+            if img_id in self.seen_ids:
+                # it's already stored, or about to be
+                image = None
+            else:
+                self.seen_ids[img_id] = True
 
-        debug((tile, img_id))
+            self.pending.append( (z, x, y, img_id, image, int(time.time())) )
+
+
+    def store_batch (self, batch: List[Tuple[int, int, int, Union[bytes, str], Optional[bytes], int]]):
+        '''Store tiles already processed by store_raw(); used by the MBTilesWriter.'''
+        self.pending.extend(batch)
+        self.commit()
+
+
+    def flush (self):
+        '''Write all the pending tiles in one transaction, or send them to the writer.'''
+        # the tiles of this generation and the previous ones are all pending or already written
+        generation = self.generations.last
+
+        if self.writer is not None:
+            # the renderers share this object in threads mode
+            with self.pending_lock:
+                batch, self.pending = self.pending, []
+
+                if len(batch) > 0:
+                    # this blocks if the writer is lagging behind; it's done with
+                    # the lock held so the tickets follow the order of the tiles
+                    self.last_ticket = self.writer.put(batch)
+
+                self.tickets.append( (generation, self.last_ticket) )
+
+            self.last_flush = time.monotonic()
+
+            return
+
+        if len(self.pending) > 0:
+            cursor = self.session.cursor ()
+            changed = self.pending
+
+            if self.skip_unchanged:
+                # the tile_ids are digests of the data, so we just compare them;
+                # the stored ones are read one METATILE x METATILE block at a time
+                blocks = defaultdict(list)
+                for tile in self.pending:
+                    z, x, y = tile[:3]
+                    blocks[(z, x & ~(METATILE - 1), y & ~(METATILE - 1))].append(tile)
+
+                changed = []
+                unchanged = []
+                for (z, block_x, block_y), tiles in blocks.items():
+                    stored = dict( ((x, y), tile_id) for x, y, tile_id in
+                                   cursor.execute ('''SELECT tile_column, tile_row, tile_id FROM map
+                                                      WHERE zoom_level = ?
+                                                        AND tile_column BETWEEN ? AND ?
+                                                        AND tile_row BETWEEN ? AND ?;''',
+                                                   (z, block_x, block_x + METATILE - 1,
+                                                    block_y, block_y + METATILE - 1)) )
+
+                    for tile in tiles:
+                        _, x, y, img_id, _, rendered_at = tile
+                        if stored.get((x, y), None) == img_id:
+                            unchanged.append( (rendered_at, z, x, y) )
+                        else:
+                            changed.append(tile)
+
+                # only remember they were rendered, for -N
+                cursor.executemany ('''UPDATE map SET rendered_at = ?
+                                       WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?;''',
+                                    unchanged)
 
-        cursor = self.session.cursor ()
-        try:
-            cursor.execute ('''INSERT INTO images (tile_id, tile_data) VALUES (?, ?);''',
-                            (img_id, image))
-        except sqlite3.IntegrityError:
             # it already exists and there's no reason to try to update anything
-            pass
+            cursor.executemany ('''INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?);''',
+                                ( (img_id, image) for _, _, _, img_id, image, _ in changed
+                                  if image is not None ))
+            cursor.executemany ('''INSERT INTO map (zoom_level, tile_column, tile_row, tile_id, rendered_at)
+                                    VALUES (?, ?, ?, ?, ?)
+                                    ON CONFLICT (zoom_level, tile_column, tile_row)
+                                    DO UPDATE SET tile_id = excluded.tile_id,
+                                                  rendered_at = excluded.rendered_at;''',
+                                ( (z, x, y, img_id, rendered_at)
+                                  for z, x, y, img_id, _, rendered_at in changed ))
+            cursor.close ()
+
+            if self.manifest is not None:
+                for z, x, y, _, _, _ in changed:
+                    self.manifest.add(z, x, y)
+
+            self.pending.clear()
 
-        try:
-            cursor.execute ('''INSERT INTO map (zoom_level, tile_column, tile_row, tile_id)
-                                VALUES (?, ?, ?, ?);''',
-                            (z, x, y, img_id))
-        except sqlite3.IntegrityError:
-            cursor.execute ('''UPDATE map
-                                SET tile_id = ?
-                                WHERE zoom_level = ?
-                                  AND tile_column = ?
-                                  AND tile_row = ?;''',
-                            (img_id, z, x, y))
-        cursor.close ()
-
-
-    def commit (self):
         if self.session.in_transaction:
             self.session.commit ()
 
+        if self.manifest is not None:
+            # only once they're committed
+            self.manifest.flush()
+
+        self.generations.finish_upto(generation)
+        self.last_flush = time.monotonic()
+
+
+    def commit (self) -> int:
+        '''flush() if there are enough pending tiles or they have been waiting for too long.
+        With a writer, the tiles are always sent, and it's the writer who batches them.
+        Returns the generation of the tiles stored so far, see durable().'''
+        generation = self.generations.next()
+
+        if ( self.writer is not None or
+             len(self.pending) >= self.batch_size or
+             time.monotonic() - self.last_flush >= self.batch_seconds ):
+            self.flush()
+
+        return generation
+
+
+    def durable (self) -> int:
+        '''The last generation returned by commit() whose tiles are all committed to the file.'''
+        if self.writer is not None:
+            committed = self.writer.committed.value
+
+            with self.pending_lock:
+                while len(self.tickets) > 0 and self.tickets[0][1] <= committed:
+                    generation, _ = self.tickets.popleft()
+                    self.generations.finish_upto(generation)
+
+        return self.generations.durable
+
 
     def exists (self, tile: TileOrTuple):
         cursor= self.session.cursor ()
@@ -325,6 +1219,36 @@ class MBTilesBackend:
         return data[0][0] == 1
 
 
+    def all_exist(self, metatile) -> bool:
+        '''Bulk version of exists() for all the tiles of a metatile, in one query.'''
+        if not isinstance(metatile, MetaTile):
+            # PixelTile
+            return all( self.exists(tile) for tile in metatile.tiles )
+
+        cursor = self.reader().cursor()
+        data = cursor.execute('''SELECT count(map.zoom_level)
+                                 FROM map
+                                 WHERE map.zoom_level = ?
+                                   AND map.tile_column BETWEEN ? AND ?
+                                   AND map.tile_row BETWEEN ? AND ?;''',
+                              (metatile.z, metatile.x, metatile.x + metatile.size - 1,
+                               metatile.y, metatile.y + metatile.size - 1)).fetchall()
+
+        return data[0][0] == len(metatile.tiles)
+
+
+    def reader(self) -> sqlite3.Connection:
+        '''Returns a connection the current thread can read from.'''
+        if threading.get_ident() == self.owner:
+            return self.session
+
+        try:
+            return self.local.session
+        except AttributeError:
+            self.local.session = sqlite3.connect('file:' + self.path + '?mode=ro', uri=True)
+            return self.local.session
+
+
     def fetch(self, tile: Tile):
         print(tile)
         cursor = self.session.cursor()
@@ -342,17 +1266,602 @@ class MBTilesBackend:
         return True
 
 
-    # TODO: newer_than()
+    def newer_than(self, tile: TileOrTuple, date, missing_as_new):
+        cursor = self.reader().cursor()
+        data = cursor.execute('''SELECT map.rendered_at
+                                 FROM map
+                                 WHERE map.zoom_level = ?
+                                   AND map.tile_column = ?
+                                   AND map.tile_row = ?;''',
+                              tuple(tile)).fetchall()
+
+        if len(data) == 0:
+            return missing_as_new
+
+        rendered_at = data[0][0]
+
+        # tiles from before we had timestamps are old
+        return rendered_at is not None and rendered_at > date.timestamp()
+
+
+    def all_newer_than(self, metatile, date, missing_as_new) -> bool:
+        '''Bulk version of newer_than() for all the tiles of a metatile, in one query.'''
+        if not isinstance(metatile, MetaTile):
+            # PixelTile
+            return all( self.newer_than(tile, date, missing_as_new) for tile in metatile.tiles )
+
+        cursor = self.reader().cursor()
+        data = cursor.execute('''SELECT count(map.zoom_level), total(map.rendered_at > ?)
+                                 FROM map
+                                 WHERE map.zoom_level = ?
+                                   AND map.tile_column BETWEEN ? AND ?
+                                   AND map.tile_row BETWEEN ? AND ?;''',
+                              (date.timestamp(), metatile.z,
+                               metatile.x, metatile.x + metatile.size - 1,
+                               metatile.y, metatile.y + metatile.size - 1)).fetchall()
+
+        present, newer = data[0]
+
+        if newer < present:
+            # some are too old
+            return False
+
+        return present == len(metatile.tiles) or missing_as_new
 
 
     def close (self):
-        self.session.close ()
+        # it can be called more than once
+        if self.session is not None:
+            self.flush()
+            self.session.close ()
+            self.session = None
 
 
     def __contains__(self, tile: TileOrTuple):
         return self.exists(tile)
 
 
+class MBTilesWriter:
+    '''A process that does all the writing to an MBTiles file, as SQLite can't have
+    concurrent writers. MBTilesBackends created with writer=it send it their tiles
+    in batches through a bounded queue, so they block if it falls behind. The
+    writer coalesces them in bigger transactions, following its own MBTilesBackend's
+    batch_size and batch_seconds.'''
+
+    # how often it logs its progress and backlog, in seconds
+    report_seconds = 10.0
+
+    def __init__(self, path, bounds, queue_size=16, **even_more):
+        self.path = path
+        self.bounds = bounds
+        self.even_more = even_more
+        # in batches, not tiles
+        self.queue = multiprocessing.Queue(queue_size)
+        self.process:Optional[multiprocessing.Process] = None
+        # each batch gets a ticket; committed is the last one such that it and all
+        # the previous ones are committed, see MBTilesBackend.durable()
+        self.sent = multiprocessing.Value('q', 0)
+        self.committed = multiprocessing.Value('q', 0)
+
+        # create the file now, so the clients can open it
+        MBTilesBackend(self.path, self.bounds, **self.even_more).close()
+
+
+    def start(self):
+        self.process = multiprocessing.Process(target=self.loop, name='MBTilesWriter')
+        self.process.start()
+
+
+    def put(self, batch: List[Tuple[int, int, int, Union[bytes, str], Optional[bytes], int]]) -> int:
+        '''Returns the batch's ticket.'''
+        with self.sent.get_lock():
+            self.sent.value += 1
+            ticket = self.sent.value
+            self.queue.put( (ticket, batch) )
+
+        return ticket
+
+
+    def backlog(self) -> int:
+        '''The amount of batches waiting to be written.'''
+        return self.queue.qsize()
+
+
+    def loop(self):
+        # C-c/KeyboardInterrupt is handled by the Master, which stop()s us
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        # our own connection, created after fork()ing
+        backend = MBTilesBackend(self.path, self.bounds, **self.even_more)
+        written = 0
+        last_report = time.monotonic()
+        # the batches from several processes can come out of order
+        tickets = Generations()
+        taken:List[int] = []
+
+        def committed():
+            for ticket in taken:
+                tickets.finish(ticket)
+
+            taken.clear()
+            self.committed.value = tickets.durable
+
+        while True:
+            try:
+                item = self.queue.get(timeout=backend.batch_seconds)
+            except queue.Empty:
+                # nobody is sending anything, write what we have
+                backend.flush()
+                committed()
+                continue
+
+            if item is None:
+                break
+
+            ticket, batch = item
+            backend.store_batch(batch)
+            taken.append(ticket)
+            written += len(batch)
+
+            if len(backend.pending) == 0:
+                # it was written
+                committed()
+
+            now = time.monotonic()
+            if now - last_report >= self.report_seconds:
+                info('[%s] %d tiles written, %d batches waiting', self.process.name, written,
+                     self.backlog())
+                last_report = now
+
+        backend.close()
+        committed()
+        info('[%s] %d tiles written, finished', self.process.name, written)
+
+
+    def stop(self):
+        '''Write everything sent so far and finish.'''
+        self.queue.put(None)
+        self.process.join()
+
+
+# see https://github.com/protomaps/PMTiles/blob/main/spec/v3/spec.md
+
+# magic, version, root dir, metadata, leaf dirs and tile data offsets and lengths,
+# addressed tiles, tile entries, tile contents, clustered, internal compression,
+# tile compression, tile type, min and max zoom, bounds, center zoom and center
+PMTILES_HEADER = struct.Struct('<7sBQQQQQQQQQQQBBBBBBiiiiBii')
+# readers fetch this much first, so the header and the root directory must fit in it
+PMTILES_ROOT_SIZE = 16384
+PMTILES_GZIP = 2
+PMTILES_TILE_TYPES = dict(png=2, jpeg=3, jpg=3)
+# while writing, the entries are appended to their side file in batches of this many tiles
+PMTILES_ENTRIES_BATCH = 65536
+
+
+def pmtiles_tile_id(z: int, x: int, y: int) -> int:
+    '''The position of the tile in the Hilbert curves of all the ZLs up to z.'''
+    # the ZLs before z have 4**i tiles each
+    return (4**z - 1) // 3 + utils.hilbert_key(z, x, y)
+
+
+def write_varint(buffer: bytearray, value: int):
+    while value >= 0x80:
+        buffer.append((value & 0x7f) | 0x80)
+        value >>= 7
+
+    buffer.append(value)
+
+
+def read_varint(buffer: bytes, position: int) -> Tuple[int, int]:
+    '''Returns the value and the position after it.'''
+    value = shift = 0
+
+    while True:
+        byte = buffer[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+
+        if byte < 0x80:
+            return value, position
+
+        shift += 7
+
+
+def serialize_directory(tile_ids: List[int], run_lengths: List[int], lengths: List[int],
+                        offsets: List[int]) -> bytes:
+    buffer = bytearray()
+    write_varint(buffer, len(tile_ids))
+
+    last_id = 0
+    for tile_id in tile_ids:
+        write_varint(buffer, tile_id - last_id)
+        last_id = tile_id
+
+    for run_length in run_lengths:
+        write_varint(buffer, run_length)
+
+    for length in lengths:
+        write_varint(buffer, length)
+
+    for index, offset in enumerate(offsets):
+        if index > 0 and offset == offsets[index - 1] + lengths[index - 1]:
+            # right after the previous one
+            write_varint(buffer, 0)
+        else:
+            write_varint(buffer, offset + 1)
+
+    return gzip.compress(bytes(buffer))
+
+
+def deserialize_directory(data: bytes) -> Tuple[numpy.ndarray, numpy.ndarray, numpy.ndarray, numpy.ndarray]:
+    '''Returns the tile_ids, run_lengths, lengths and offsets.'''
+    buffer = gzip.decompress(data)
+    count, position = read_varint(buffer, 0)
+    columns = numpy.zeros((4, count), dtype=numpy.uint64)
+
+    for column in range(3):
+        for index in range(count):
+            columns[column, index], position = read_varint(buffer, position)
+
+    # ids are deltas
+    tile_ids = numpy.cumsum(columns[0], dtype=numpy.uint64)
+
+    for index in range(count):
+        offset, position = read_varint(buffer, position)
+
+        if offset == 0 and index > 0:
+            columns[3, index] = columns[3, index - 1] + columns[2, index - 1]
+        else:
+            columns[3, index] = offset - 1
+
+    return tile_ids, columns[1], columns[2], columns[3]
+
+
+class PMTilesBackend:
+    '''A PMTiles v3 archive, a single file with all the tiles. While generating,
+    the tiles are appended to a side file, deduplicated by content; when
+    close()'d, it writes the archive with the tiles in tile_id order and
+    the directories, and removes the side files.
+
+    While generating, the memory used does not grow with the amount of tiles:
+    the content digests are kept in a side SQLite db and the entries in
+    another side file. Sorting them when close()'d does need memory in
+    proportion, up to a few hundred bytes per stored tile.
+
+    It can only be written by one process, and it can't be updated: writing
+    again starts a new archive. For reading it mmap()s the file.'''
+    fs_based = False
+
+    def __init__(self, path, bounds, min_zoom=0, max_zoom=18, ro=False, tile_format='png',
+                 **even_more):
+        self.path = path
+        self.ro = ro
+
+        if ro:
+            self.open()
+        else:
+            if isinstance(bounds, BBox):
+                bounds = (bounds.w, bounds.s, bounds.e, bounds.n)
+            self.bounds = bounds
+            self.tile_type = PMTILES_TILE_TYPES.get(tile_format, 0)
+
+            # the side files are opened on the first store(), so if we're fork()ed
+            # only the process that writes has them
+            self.data_path = self.path + '.data'
+            self.data = None
+            self.data_size = 0
+            # content digest -> (offset, length)
+            self.contents_path = self.path + '.contents'
+            self.contents:Optional[sqlite3.Connection] = None
+            # the most used ones, mostly the empty tiles
+            self.recent_contents = utils.LRUCache(1024)
+            # (tile_id, offset, length) for each stored tile
+            self.entries_path = self.path + '.entries'
+            self.entries = None
+            self.pending = array.array('Q')
+            self.min_zoom = max_zoom
+            self.max_zoom = min_zoom
+            # for threads mode
+            self.lock = threading.Lock()
+            # nothing is durable until the archive is written, see close()
+            self.generations = Generations()
+
+
+    def store(self, tile: Tile):
+        assert tile.data is not None
+
+        self.store_raw(tile.z, tile.x, tile.y, tile.data)
+
+
+    # the data is already deduplicated
+    link = store
+
+
+    def store_raw(self, z: int, x: int, y: int, image: bytes):
+        digest = hashlib.blake2b(image, digest_size=16).digest()
+
+        with self.lock:
+            if self.data is None:
+                self.open_side_files()
+
+            try:
+                offset, length = self.recent_contents[digest]
+            except KeyError:
+                row = self.contents.execute('''SELECT data_offset, data_length FROM contents
+                                               WHERE digest = ?;''', (digest, )).fetchone()
+                if row is None:
+                    offset, length = self.data_size, len(image)
+                    self.data.write(image)
+                    self.data_size += length
+                    self.contents.execute('INSERT INTO contents VALUES (?, ?, ?);',
+                                          (digest, offset, length))
+                else:
+                    offset, length = row
+
+                self.recent_contents[digest] = (offset, length)
+
+            self.pending.extend( (pmtiles_tile_id(z, x, y), offset, length) )
+            if len(self.pending) >= 3 * PMTILES_ENTRIES_BATCH:
+                self.pending.tofile(self.entries)
+                self.pending = array.array('Q')
+
+            self.min_zoom = min(self.min_zoom, z)
+            self.max_zoom = max(self.max_zoom, z)
+
+
+    def open_side_files(self):
+        self.data = open(self.data_path, 'wb')
+        self.entries = open(self.entries_path, 'wb')
+
+        # leftovers from an interrupted run
+        if os.path.exists(self.contents_path):
+            unlink(self.contents_path)
+
+        # the archive is written from scratch anyway, so no need for it to survive crashes;
+        # with threads, the lock serializes its use
+        self.contents = sqlite3.connect(self.contents_path, check_same_thread=False)
+        self.contents.execute('PRAGMA journal_mode = OFF;')
+        self.contents.execute('PRAGMA synchronous = OFF;')
+        self.contents.execute('''CREATE TABLE contents(
+            digest       BLOB PRIMARY KEY,
+            data_offset  INTEGER NOT NULL,
+            data_length  INTEGER NOT NULL
+        ) WITHOUT ROWID;''')
+
+
+    def commit(self) -> int:
+        with self.lock:
+            if self.contents is not None:
+                self.contents.commit()
+
+        return self.generations.next()
+
+
+    def durable(self) -> int:
+        return self.generations.durable
+
+
+    def exists(self, tile: TileOrTuple):
+        if not self.ro:
+            # the archive is written from scratch
+            return False
+
+        return self.find(pmtiles_tile_id(*tile)) is not None
+
+
+    def __contains__(self, tile: TileOrTuple):
+        return self.exists(tile)
+
+
+    def all_exist(self, metatile) -> bool:
+        return all( self.exists(tile) for tile in metatile.tiles )
+
+
+    def all_newer_than(self, metatile, date, missing_as_new) -> bool:
+        # there are no timestamps, and the archive is written from scratch anyway
+        return False
+
+
+    def close(self):
+        if not self.ro and self.data is not None:
+            self.data.close()
+            self.data = None
+            self.pending.tofile(self.entries)
+            self.entries.close()
+            self.contents.close()
+            unlink(self.contents_path)
+
+            self.finalize()
+            self.generations.finish_all()
+        elif self.ro:
+            self.mmap.close()
+
+
+    def clustered_entries(self):
+        '''Returns the tile_ids, sorted, the offsets the tile data will have
+        when written in that order, and their lengths. Tiles stored more than once
+        keep the last data. Also returns the offsets and lengths in the data file
+        of each of the new ones, in the order they're written.'''
+        # the file is not read as a whole, only the parts needed for sorting
+        entries = numpy.memmap(self.entries_path, dtype=numpy.uint64, mode='r').reshape(-1, 3)
+
+        # stable, so of the repeated ones the last stored is the last one
+        order = numpy.argsort(entries[:, 0], kind='stable')
+        tile_ids = entries[order, 0]
+        last = numpy.ones(len(tile_ids), dtype=bool)
+        last[:-1] = tile_ids[1:] != tile_ids[:-1]
+
+        order = order[last]
+        tile_ids = tile_ids[last]
+        offsets = entries[order, 1]
+        lengths = entries[order, 2]
+        del entries
+
+        # the data is written in the order it's first used by the tile_ids
+        sources, first, inverse = numpy.unique(offsets, return_index=True, return_inverse=True)
+        by_use = numpy.argsort(first, kind='stable')
+        source_offsets = sources[by_use]
+        source_lengths = lengths[first][by_use]
+
+        moved = numpy.zeros(len(sources), dtype=numpy.uint64)
+        moved[by_use] = numpy.cumsum(source_lengths) - source_lengths
+        new_offsets = moved[inverse.reshape(-1)]
+
+        return tile_ids, new_offsets, lengths, source_offsets, source_lengths
+
+
+    def finalize(self):
+        tile_ids, offsets, lengths, source_offsets, source_lengths = self.clustered_entries()
+
+        # run lengths: consecutive tiles with the same data are one entry
+        new_run = numpy.ones(len(tile_ids), dtype=bool)
+        new_run[1:] = ~( (tile_ids[1:] == tile_ids[:-1] + 1) &
+                         (offsets[1:] == offsets[:-1]) )
+        starts = numpy.flatnonzero(new_run)
+        run_lengths = numpy.diff(numpy.append(starts, len(tile_ids)))
+
+        entries = ( tile_ids[starts].tolist(), run_lengths.tolist(),
+                    lengths[starts].tolist(), offsets[starts].tolist() )
+        root, leaves = self.directories(entries)
+
+        if self.bounds is not None:
+            w, s, e, n = self.bounds
+        else:
+            w, s, e, n = -180, -85.05112878, 180, 85.05112878
+
+        metadata = gzip.compress(json.dumps(dict(
+            name=os.path.splitext(os.path.basename(self.path))[0],
+            format={ 2: 'png', 3: 'jpg' }.get(self.tile_type, ''),
+            bounds=f"{w},{s},{e},{n}",
+        )).encode('utf-8'))
+
+        root_offset = PMTILES_HEADER.size
+        metadata_offset = root_offset + len(root)
+        leaves_offset = metadata_offset + len(metadata)
+        data_offset = leaves_offset + len(leaves)
+        data_size = int(source_lengths.sum())
+
+        header = PMTILES_HEADER.pack(b'PMTiles', 3, root_offset, len(root),
+                                     metadata_offset, len(metadata), leaves_offset, len(leaves),
+                                     data_offset, data_size,
+                                     len(tile_ids), len(starts), len(source_offsets),
+                                     # clustered, gzip'ed directories, tiles not compressed
+                                     1, PMTILES_GZIP, 1, self.tile_type,
+                                     self.min_zoom, self.max_zoom,
+                                     int(w * 1e7), int(s * 1e7), int(e * 1e7), int(n * 1e7),
+                                     self.min_zoom, int((w + e) / 2 * 1e7), int((s + n) / 2 * 1e7))
+
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as archive, open(self.data_path, 'rb') as data:
+            archive.write(header)
+            archive.write(root)
+            archive.write(metadata)
+            archive.write(leaves)
+
+            # the tile data, in tile_id order
+            for start in range(0, len(source_offsets), PMTILES_ENTRIES_BATCH):
+                end = start + PMTILES_ENTRIES_BATCH
+                for offset, length in zip(source_offsets[start:end].tolist(),
+                                          source_lengths[start:end].tolist()):
+                    archive.write(os.pread(data.fileno(), length, offset))
+
+        os.replace(temp_path, self.path)
+        os.unlink(self.data_path)
+        os.unlink(self.entries_path)
+
+
+    def directories(self, entries) -> Tuple[bytes, bytes]:
+        '''Returns the root directory and the leaf directories, if the entries
+        don't fit in the root directory.'''
+        root = serialize_directory(*entries)
+        if PMTILES_HEADER.size + len(root) <= PMTILES_ROOT_SIZE:
+            return root, b''
+
+        tile_ids, run_lengths, lengths, offsets = entries
+        leaf_size = max(4096, len(tile_ids) // 3500)
+
+        while True:
+            root_entries:Tuple[List[int], List[int], List[int], List[int]] = ([], [], [], [])
+            leaves = bytearray()
+
+            for start in range(0, len(tile_ids), leaf_size):
+                end = start + leaf_size
+                leaf = serialize_directory(tile_ids[start:end], run_lengths[start:end],
+                                           lengths[start:end], offsets[start:end])
+
+                # run_length 0 means it points to a leaf directory
+                root_entries[0].append(tile_ids[start])
+                root_entries[1].append(0)
+                root_entries[2].append(len(leaf))
+                root_entries[3].append(len(leaves))
+
+                leaves.extend(leaf)
+
+            root = serialize_directory(*root_entries)
+            if PMTILES_HEADER.size + len(root) <= PMTILES_ROOT_SIZE:
+                return root, bytes(leaves)
+
+            leaf_size *= 2
+
+
+    def open(self):
+        with open(self.path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        fields = PMTILES_HEADER.unpack_from(self.mmap, 0)
+        if fields[0] != b'PMTiles' or fields[1] != 3:
+            raise ValueError(f"{self.path} is not a PMTiles v3 archive.")
+
+        ( root_offset, root_length, _, _, self.leaves_offset, _,
+          self.data_offset, _ ) = fields[2:10]
+
+        self.root = deserialize_directory(self.mmap[root_offset:root_offset + root_length])
+        self.leaves = utils.LRUCache(64)
+
+
+    def find(self, tile_id: int) -> Optional[Tuple[int, int]]:
+        '''Returns the offset and length of the tile's data in the file, or None.'''
+        directory = self.root
+
+        # root -> leaf, but leaves can point to leaves too
+        for _ in range(4):
+            tile_ids, run_lengths, lengths, offsets = directory
+
+            index = numpy.searchsorted(tile_ids, tile_id, side='right') - 1
+            if index < 0:
+                return None
+
+            run_length = int(run_lengths[index])
+            offset = int(offsets[index])
+            length = int(lengths[index])
+
+            if run_length == 0:
+                # a leaf directory
+                try:
+                    directory = self.leaves[offset]
+                except KeyError:
+                    start = self.leaves_offset + offset
+                    directory = deserialize_directory(self.mmap[start:start + length])
+                    self.leaves[offset] = directory
+            elif tile_id < int(tile_ids[index]) + run_length:
+                return (self.data_offset + offset, length)
+            else:
+                return None
+
+        return None
+
+
+    def fetch(self, tile: Tile):
+        found = self.find(pmtiles_tile_id(*tile))
+        if found is None:
+            return False
+
+        offset, length = found
+        tile.data = self.mmap[offset:offset + length]
+
+        return True
+
+
 def coord_range(mn, mx, zoom):
     return ( coord for coord in range(mn, mx + 1)
                    if coord >= 0 and coord < 2**zoom )
@@ -377,8 +1886,28 @@ def bbox(value):
     return data
 
 
+def tile_levels(upper_left, lower_right, max_z, tile_size=256):
+    '''Returns, for each ZL from 0 to max_z, the ((x0, y0), (x1, y1)) range of tiles
+    touched by the box between the upper_left and lower_right LonLat corners.
+    Both ends are included and they're not clipped to the world.'''
+    # all the ZLs in one go
+    zooms = numpy.arange(max_z + 1)
+    px0s = tileproj.lon_lat2pixels([ upper_left ]  * len(zooms), zooms) // tile_size
+    px1s = tileproj.lon_lat2pixels([ lower_right ] * len(zooms), zooms) // tile_size
+
+    return [ (tuple(px0), tuple(px1)) for px0, px1 in zip(px0s.tolist(), px1s.tolist()) ]
+
+
 class BBox:
     def __init__(self, bbox, max_z):
+        '''bbox is either (w, s, e, n) or, for non rectangular areas, a shapely
+        geometry in LonLat.'''
+        if isinstance(bbox, BaseGeometry):
+            self.area = bbox
+            bbox = bbox.bounds
+        else:
+            self.area = None
+
         self.w, self.s, self.e, self.n = bbox
         self.max_z = max_z
         self.proj = GoogleProjection(self.max_z+1)  # +1
@@ -394,12 +1923,50 @@ class BBox:
                                   self.upper_right, self.upper_left,
                                   self.lower_left ])
 
+        # see tile_range()
+        self.levels:List[Tuple[Tuple[int, int], Tuple[int, int]]] = []
+        self.compute_levels(max_z)
+
+
+    def compute_levels(self, max_z):
+        '''Computes the range of 256px tiles the bbox touches in each ZL up to max_z,
+        clipped to the world.'''
+        self.levels = [ ( (max(x0, 0), max(y0, 0)), (min(x1, 2**z - 1), min(y1, 2**z - 1)) )
+                        for z, ((x0, y0), (x1, y1)) in enumerate(tile_levels(self.upper_left,
+                                                                             self.lower_right,
+                                                                             max_z)) ]
+
 
     def __contains__(self, tile):
-        other = tile.polygon
+        # tile can be a Tile, a MetaTile or a PixelTile; all of them have corners in pixels
+        (px0, py0), (px1, py1) = tile.corners
+        (x0, y0), (x1, y1) = self.tile_range(tile.z)
+
+        # compare the range of 256px tiles that tile covers with the bbox's
+        inside = ( px0 // 256 <= x1 and x0 <= (px1 - 1) // 256 and
+                   py0 // 256 <= y1 and y0 <= (py1 - 1) // 256 )
+
+        if inside and self.area is not None:
+            # the ranges only cover the area's bounds, do the real check
+            return tile.polygon.intersects(self.area)
+
+        return inside
 
-        debug((other.wkt, self.boundary.wkt))
-        return other.intersects(self.boundary)
+
+    def tile_range(self, z, tile_size=256):
+        '''Returns the ((x0, y0), (x1, y1)) range of tiles of ZL z that the bbox
+        touches. Both ends are included.'''
+        if z >= len(self.levels):
+            self.compute_levels(z)
+
+        (x0, y0), (x1, y1) = self.levels[z]
+
+        if tile_size != 256:
+            # it's all powers of 2, so this rounds as if we had computed it with the pixels
+            (x0, y0), (x1, y1) = ( ( x0 * 256 // tile_size, y0 * 256 // tile_size ),
+                                   ( x1 * 256 // tile_size, y1 * 256 // tile_size ) )
+
+        return ( (x0, y0), (x1, y1) )
 
 
     def __repr__(self):
@@ -419,15 +1986,8 @@ class Map:
 
         ll0 = (bbox[0],bbox[3])
         ll1 = (bbox[2],bbox[1])
-        gprj = GoogleProjection(max_z+1)
 
-        self.levels = []
-        for z in range (0, max_z+1):
-            px0 = gprj.lon_lat2pixel(ll0,z)
-            px1 = gprj.lon_lat2pixel(ll1,z)
-            # print px0, px1
-            self.levels.append (( (int (px0[0]/self.tile_size), int (px0[1]/self.tile_size)),
-                                  (int (px1[0]/self.tile_size), int (px1[1]/self.tile_size)) ))
+        self.levels = tile_levels(ll0, ll1, max_z, self.tile_size)
 
 
     def __contains__ (self, t):
@@ -564,6 +2124,17 @@ def test_all():
         assert lon == 0
         assert lat == 0
 
+    # batch versions give the same results
+    lon_lats = [ (-10, 35), (30, 60), (7.5, 43.7), (-179.9, -84.9) ]
+    for z in range(19):
+        pxs = g.lon_lat2pixels(lon_lats, z).tolist()
+        assert pxs == [ list(g.lon_lat2pixel(lon_lat, z)) for lon_lat in lon_lats ]
+
+        for (lon0, lat0), (lon1, lat1) in zip(g.pixels2lon_lats(pxs, z).tolist(),
+                                              [ g.pixel2lon_lat(px, z) for px in pxs ]):
+            assert abs(lon0 - lon1) < 1e-9
+            assert abs(lat0 - lat1) < 1e-9
+
 
     tile = Tile(0, 0, 0)
     assert MetaTile.from_tile(tile, 8) == MetaTile(0, 0, 0, 8, 256)
@@ -0,0 +1,28 @@
+#! /usr/bin/env python3
+
+# brings MBTiles files created by older versions up to date:
+# adds the rendered_at timestamps and converts the tile_ids to blake2b BLOBs
+
+import os.path
+import sys
+
+import map_utils
+
+missing = 0
+
+for path in sys.argv[1:]:
+    # otherwise it would create a new, empty one
+    if not os.path.exists(path):
+        print(f"{path}: not found, skipping.", file=sys.stderr)
+        missing += 1
+        continue
+
+    # opening it for writing already adds the timestamps
+    backend = map_utils.MBTilesBackend(path, None)
+
+    print(f"{path}: {backend.tile_id_format} -> {map_utils.TILE_ID_FORMAT}")
+    backend.migrate_tile_ids()
+    backend.close()
+
+if missing > 0:
+    sys.exit(1)
@@ -1,6 +1,8 @@
 #! /usr/bin/env python3
 
 from collections import defaultdict, deque
+import heapq
+import itertools
 import multiprocessing
 import os
 import os.path
@@ -24,6 +26,12 @@ short_format = "%(asctime)s %(message)s"
 
 logging.basicConfig(level=logging.DEBUG, format=long_format)
 
+# seconds an idle connection is kept open
+KEEP_ALIVE_TIMEOUT = 15
+# unanswered requests per connection before we stop reading more
+MAX_PIPELINED = 64
+MAX_REQUEST_SIZE = 16 * 1024
+
 
 # fake multiprocessing for testing
 class FakeRenderThread:
@@ -73,8 +81,16 @@ class Master:
         self.clients_for_metatile = defaultdict(set)
         # metatile_for_client maps Clients to MetaTiles, so we can remove the Client from the MT's client list
         self.metatile_for_client = {}
-        # the MetaTile queue
-        self.work_stack = deque(maxlen=4096)
+        # the MetaTile queue, a heap of [ -clients, z, -seq, metatile ] entries, so the MetaTiles
+        # with more Clients go first, then the lower ZLs, then the most recently asked for,
+        # which are more likely to be still visible after a pan
+        self.work_heap = []
+        # the current entry for each queued MetaTile; entries are canceled by setting their MetaTile
+        # to None, and dropped when they reach the top of the heap, see push_work() and pop_work()
+        self.work_entries = {}
+        self.work_seq = itertools.count()
+        # the canceled entries still in the heap, see compact_work()
+        self.dead_entries = 0
         # the MetaTile being rendered
         self.in_flight = set()
 
@@ -95,28 +111,72 @@ class Master:
             render_thread.start()
             self.renderers[i] = render_thread
 
+    def push_work(self, metatile):
+        '''(Re)queue metatile with its current priority. O(log n).'''
+        self.cancel_work(metatile)
+
+        clients = len(self.clients_for_metatile[metatile])
+        entry = [ -clients, metatile.z, -next(self.work_seq), metatile ]
+        self.work_entries[metatile] = entry
+        heapq.heappush(self.work_heap, entry)
+
+    def cancel_work(self, metatile):
+        '''Take metatile out of the queue, if it's there. O(1).'''
+        entry = self.work_entries.pop(metatile, None)
+        if entry is not None:
+            entry[-1] = None
+            self.dead_entries += 1
+            self.compact_work()
+
+    def compact_work(self):
+        '''pop_work() only drops the canceled entries while there's room in new_work, so with busy
+        renderers they pile up. Rebuild the heap when they outnumber the live ones. O(n), amortized O(1).'''
+        if self.dead_entries > len(self.work_entries):
+            self.work_heap = list(self.work_entries.values())
+            heapq.heapify(self.work_heap)
+            self.dead_entries = 0
+
+    def pop_work(self):
+        '''Returns the queued MetaTile with the highest priority, or None.'''
+        while len(self.work_heap) > 0:
+            metatile = heapq.heappop(self.work_heap)[-1]
+            if metatile is not None:
+                del self.work_entries[metatile]
+                return metatile
+
+            self.dead_entries -= 1
+
+        return None
+
     def append(self, metatile, client):
         # if I move clients = self.clients_for_metatile[metatile] here, the entry is created
         # and we never enter the 'then' branch
         if metatile not in self.clients_for_metatile:
             debug(f"[Master]: first Client for {metatile!r}: {client}")
 
-            self.work_stack.append(metatile)
             self.clients_for_metatile[metatile].add(client)
             self.metatile_for_client[client] = metatile
+            self.push_work(metatile)
         else:
             clients = self.clients_for_metatile[metatile]
             clients.add(client)
             self.metatile_for_client[client] = metatile
             debug(f"[Master]: new Client for {metatile!r}: {clients}")
 
+            if metatile not in self.in_flight:
+                # one more Client, and a newer request, so it goes up
+                self.push_work(metatile)
+
     def remove(self, client_to_remove):
-        metatile = self.metatile_for_client[client_to_remove]
+        metatile = self.metatile_for_client.pop(client_to_remove, None)
+        if metatile is None:
+            # it was already answered
+            return
 
         # now, this might seem dangerous, but all these structures are handled on the main thread
         # so there is no danger of race conditions
         clients = self.clients_for_metatile[metatile]
-        clients.remove(client)
+        clients.discard(client_to_remove)
 
         # if this metatile ends without clients, remove it
         if len(clients) == 0:
@@ -124,9 +184,8 @@ class Master:
             # TODO: explain why
             if metatile not in self.in_flight:
                 debug(f"clients for {metatile!r} empty, removing before it's sent for rendering")
-                self.work_stack.remove(metatile)
+                self.cancel_work(metatile)
                 del self.clients_for_metatile[metatile]
-                del self.metatile_for_client[client_to_remove]
 
     def render_tiles(self):
         try:
@@ -163,10 +222,10 @@ class Master:
         # full() can be inconsistent only if when we test is false
         # and when we put() is true, but only the master is writing
         # so no other thread can fill the queue
-        while not self.new_work.full() and len(self.work_stack) > 0:
+        while not self.new_work.full() and len(self.work_entries) > 0:
             tight_loop = False
 
-            metatile = self.work_stack.popleft()  # tiles.MetaTile
+            metatile = self.pop_work()  # tiles.MetaTile
 
             if metatile is not None:
                 # because we're the only writer, and it's not full, this can't block
@@ -199,7 +258,7 @@ class Master:
             self.in_flight.remove(metatile)
             del self.clients_for_metatile[metatile]
             for client in clients:
-                del self.metatile_for_client[client]
+                self.metatile_for_client.pop(client, None)
 
             result.append(metatile)
 
@@ -219,101 +278,131 @@ class Master:
         debug('finished')
 
 
-class DoubleDict:
-    def __init__(self):
-        self.forward = {}
-        self.backward = {}
+class Response:
+    '''A response to one request. A Client keeps them in the same order as its requests, so
+    they're sent in that order even if they're ready out of order (a rendered tile after a cached one).'''
+    def __init__(self, client, keep_alive):
+        self.client = client
+        self.keep_alive = keep_alive
+        self.ready = False
+
+        # what's left to send
+        self.head = memoryview(b'')
+        self.file = None
+        self.file_offset = 0
+        self.file_size = 0
 
-    def __getitem__(self, key):
-        if key in self.forward:
-            return self.forward[key]
+        # for tiles that have to be rendered first
+        self.tile_path = None
+        self.metatile = None
 
-        return self.backward[key]
+    def finish(self, status, headers=(), file=None, size=0):
+        lines = [ f"HTTP/1.1 {status}", *headers, f"Content-Length: {size}" ]
+        if self.keep_alive:
+            lines.append('Connection: keep-alive')
+            lines.append(f"Keep-Alive: timeout={KEEP_ALIVE_TIMEOUT}")
+        else:
+            lines.append('Connection: close')
 
-    def __setitem__(self, key, value):
-        self.forward[key] = value
-        self.backward[value] = key
+        self.head = memoryview(('\r\n'.join(lines) + '\r\n\r\n').encode())
+        self.file = file
+        self.file_size = size
+        self.ready = True
 
-    def __delitem__(self, key):
-        if key not in self.forward and key not in self.backward:
-            raise KeyError
+    def send(self, socket):
+        '''Sends as much as possible. Raises BlockingIOError if the socket can't take more yet.'''
+        while len(self.head) > 0:
+            sent = socket.send(self.head)
+            self.head = self.head[sent:]
 
-        if key in self.forward:
-            value = self.forward.pop(key)
-        else:
-            value = self.backward.pop(key)
+        if self.file is not None:
+            while self.file_offset < self.file_size:
+                sent = os.sendfile(socket.fileno(), self.file.fileno(), self.file_offset,
+                                   self.file_size - self.file_offset)
+                if sent == 0:
+                    # the file was truncated under our feet; the client will notice the short body
+                    break
 
-        if value in self.forward:
-            del self.forward[value]
-        else:
-            del self.backward[value]
+                self.file_offset += sent
 
-    def __contains__(self, key):
-        return key in self.forward or key in self.backward
+            self.close()
 
-    def get(self, key, default=None):
-        if key in self.forward:
-            value = self.forward.pop(key)
-        elif key in self.backward:
-            value = self.backward.pop(key)
-        else:
-            value = default
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
 
-        return value
+    def __repr__(self):
+        return f"Response({self.client.getpeername()}, {self.tile_path})"
 
 
 class Client:
     def __init__(self, socket):
         self.socket = socket
 
-        # to support short reads we will be using a buffer and an offset that will point to the first free byte
-        self.read_buffer = memoryview(bytearray(4096))  # we really don't need much, since requests are quite small
-        self.read_buffer_offset = 0
-        self.request_read = False
+        # to support short and pipelined reads we keep whatever is after the last complete request
+        self.read_buffer = bytearray()
+        # no more requests will be read, see Server.handle_request()
+        self.closing = False
 
-        self.write_data = []
-        self.write_file = None
+        # the Responses in the same order as the requests
+        self.responses = deque()
+        self.last_active = time.monotonic()
 
-        self.tile_path = None
+        # what is this Client registered in the selector for
+        self.events = 0
+        self.client_name = None
 
     def recv(self):
-        # if the last time we finished reading the request, we have to start from 0
-        if self.request_read:
-            self.request_read = False
-            self.read_buffer_offset = 0
+        '''Returns the complete requests read so far, None if the peer closed the connection.'''
+        data = self.socket.recv(4096)
+        if len(data) == 0:
+            return None
 
-        read = self.socket.recv_into(self.read_buffer[self.read_buffer_offset:])  # the size is automatic
-        if read > 0:
-            self.read_buffer_offset += read
+        self.last_active = time.monotonic()
+        self.read_buffer += data
 
-        # ugh that bytes(), I hope it's cheap
-        if b'\r\n\r\n' in bytes(self.read_buffer[:self.read_buffer_offset]):
-            self.request_read = True
+        requests = []
+        while True:
+            end = self.read_buffer.find(b'\r\n\r\n')
+            if end == -1:
+                break
 
-        return self.read_buffer[:self.read_buffer_offset]
+            requests.append(bytes(self.read_buffer[:end]))
+            del self.read_buffer[:end + 4]
 
-    def send(self, data):
-        if isinstance(data, bytes):
-            # textual data
-            self.write_data.append(data)
-        else:
-            self.write_file = data
+        return requests
+
+    def wants_write(self):
+        return len(self.responses) > 0 and self.responses[0].ready
 
     def flush(self):
+        '''Sends the ready Responses in order, stopping at the first one that isn't.
+        Returns False if the connection has to be closed.'''
         try:
-            for data in self.write_data:
-                sent = self.socket.send(data)
-                # TODO implement handling of short writes
-                assert sent == len(data)
-
-            if self.write_file is not None:
-                self.socket.sendfile(open(self.write_file, 'br'))
-        except BrokenPipeError:
+            while self.wants_write():
+                response = self.responses[0]
+                response.send(self.socket)
+
+                self.responses.popleft()
+                self.last_active = time.monotonic()
+
+                if not response.keep_alive:
+                    return False
+        except BlockingIOError:
+            # short write, we'll continue when the socket is writable again
+            pass
+        except (BrokenPipeError, ConnectionResetError):
             # the client died, close it.
             warning(f"{self.getpeername()} died, closing")
-            self.close()
+            return False
+
+        return True
 
     def close(self):
+        for response in self.responses:
+            response.close()
+
         self.socket.close()
 
     def fileno(self):
@@ -355,18 +444,19 @@ class Server:
         self.selector.register(self.listener, EVENT_READ)
 
         self.clients = set()
-        self.queries_clients = DoubleDict()
-        self.client_for_peer = {}
+        self.last_reap = time.monotonic()
 
         # this looks like dupe'd from Master, but they have slightly different life cycles
-        self.clients_for_metatile = defaultdict(set)
+        # not a defaultdict, so looking up a canceled metatile doesn't bring its entry back
+        self.responses_for_metatile = {}
 
         # canonicalize
         # root = os.path.abspath(root)
 
         # b'GET /12/2111/1500.png HTTP/1.1\r\nHost: ioniq:8080\r\nConnection: Keep-Alive\r\nAccept-Encoding: gzip\r\nUser-Agent: okhttp/3.12.2\r\n\r\n'
-        # but we only care about the first line, so
+        # we care about the first line, so
         # GET /12/2111/1500.png HTTP/1.1
+        # and the Connection header
         self.request_re = re.compile(r'(?P<method>[A-Z]+) (?P<url>.*) (?P<version>.*)')
 
         self.master = Master(self.opts)
@@ -378,104 +468,168 @@ class Server:
         # debug('...ed!')
         debug(f"connection from {addr}")
 
+        # whether it inherits this from the listener is OS dependent
+        client_socket.setblocking(False)
         client = Client(client_socket)
 
         self.clients.add(client)
-        self.client_for_peer[client.getpeername()] = client
-        self.selector.register(client, EVENT_READ)
+        self.update(client)
+
+    def update(self, client):
+        '''(Re)register client for the events it needs now.'''
+        events = 0
+        # stop reading if it pipelines too much, TCP will slow it down
+        if not client.closing and len(client.responses) < MAX_PIPELINED:
+            events |= EVENT_READ
+        if client.wants_write():
+            events |= EVENT_WRITE
+
+        if events != client.events:
+            if client.events == 0:
+                self.selector.register(client, events)
+            elif events == 0:
+                self.selector.unregister(client)
+            else:
+                self.selector.modify(client, events)
 
-    def client_read(self, client):
-        data = bytes(client.recv())
-        debug(f"read from {client.getpeername()}: {data}")
+            client.events = events
 
-        if len(data) == 0:
-            debug(f"client {client.getpeername()} disconnected")
+    def close(self, client):
+        debug(f"closing {client.getpeername()}")
+
+        # cancel what it's still waiting for
+        for response in client.responses:
+            if response.metatile is not None and not response.ready:
+                self.master.remove(response)
+                responses = self.responses_for_metatile.get(response.metatile, None)
+                if responses is not None:
+                    responses.discard(response)
+                    if len(responses) == 0:
+                        del self.responses_for_metatile[response.metatile]
+
+        if client.events != 0:
+            self.selector.unregister(client)
+            client.events = 0
 
-            # clean up trailing queries from the work_stack
-            query = self.queries_clients.get(client, None)
-            if query is not None:
-                try:
-                    self.master.work_stack.remove(query)
-                except ValueError:
-                    # already being rendered, ignore
-                    pass
+        self.clients.remove(client)
+        client.close()
 
-                # debug(f"client {client.getpeername()} disconnected, was waiting for {query}")
-            else:
-                # debug(f"client {client.getpeername()} disconnected, didn't made any query yet.")
-                pass
+    def client_read(self, client):
+        try:
+            requests = client.recv()
+        except BlockingIOError:
+            return
+        except ConnectionResetError:
+            requests = None
 
-            # TODO:
-            # self.responses[client] = []
+        if requests is None:
+            debug(f"client {client.getpeername()} disconnected")
+            self.close(client)
+            return
 
-            # now we need to wait for client to be ready to write
-            self.selector.unregister(client)
-            self.selector.register(client, EVENT_WRITE)
-        elif client.request_read:
-            # we finish reading from this one for now
-            self.selector.unregister(client)
+        for request in requests:
+            debug(f"read from {client.getpeername()}: {request}")
+            self.handle_request(client, request)
 
-            # splitlines() already handles any type of separators
-            lines = data.decode().splitlines()
-            request_line = lines[0]
-            match = self.request_re.match(request_line)
+            if client.closing:
+                # anything after a 'Connection: close' is ignored
+                break
 
-            debug(match)
-            if match is None:
-                client.send(b'HTTP/1.1 400 KO\r\n\r\n')
+        if not client.closing and len(client.read_buffer) > MAX_REQUEST_SIZE:
+            warning(f"{client.getpeername()}: request too big, closing")
+            response = Response(client, keep_alive=False)
+            response.finish('431 request too big')
+            client.responses.append(response)
+            client.closing = True
+
+        self.update(client)
+
+    def handle_request(self, client, data):
+        # splitlines() already handles any type of separators
+        lines = data.decode('latin-1').splitlines()
+        match = self.request_re.match(lines[0]) if len(lines) > 0 else None
+
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip().lower()
+
+        connection = headers.get('connection', '')
+        if match is None:
+            keep_alive = False
+        elif match['version'] == 'HTTP/1.1':
+            keep_alive = connection != 'close'
+        else:
+            keep_alive = connection == 'keep-alive'
+
+        response = Response(client, keep_alive)
+        client.responses.append(response)
+        if not keep_alive:
+            client.closing = True
+
+        debug(match)
+        if match is None:
+            response.finish('400 KO')
+        elif match['method'] != 'GET':
+            debug(f"404: bad method {match['method']}")
+            response.finish('405 only GETs')
+        else:
+            path = match['url']
+
+            # TODO: similar code is in tile_server. try to refactor
+            try:
+                # _ gets '' because path is absolute
+                _, z, x, y_ext = path.split('/')
+            except ValueError:
+                # not a tile, try to serve the file
+                # but remove the leading / so o.p.join() does not use it as an abs path
+                self.answer(response, os.path.join(self.opts.tile_dir, path[1:]))
             else:
-                if match['method'] != 'GET':
-                    debug(f"404: bad method {match['method']}")
-                    client.send(b'HTTP/1.1 405 only GETs\r\n\r\n')
-                else:
-                    path = match['url']
+                # TODO: make sure ext matches the file type we return
+                y, ext = os.path.splitext(y_ext)
+
+                # o.p.join() considers path to be absolute, so it ignores root
+                tile_path = os.path.join(self.opts.tile_dir, z, x, y_ext)
 
-                    # TODO: similar code is in tile_server. try to refactor
+                # try to send the tile first, but do not send 404s
+                if not self.answer(response, tile_path, send_404=False):
                     try:
-                        # _ gets '' because path is absolute
-                        _, z, x, y_ext = path.split('/')
+                        tile = Tile(*[ int(coord) for coord in (z, x, y) ])
                     except ValueError:
-                        # not a tile, try to serve the file
-                        # but remove the leading / so o.p.join() does not use it as an abs path
-                        self.answer(client, os.path.join(self.opts.tile_dir, path[1:]))
-                    else:
-                        # TODO: make sure ext matches the file type we return
-                        y, ext = os.path.splitext(y_ext)
-
-                        # o.p.join() considers path to be absolute, so it ignores root
-                        tile_path = os.path.join(self.opts.tile_dir, z, x, y_ext)
-
-                        # try to send the tile first, but do not send 404s
-                        if not self.answer(client, tile_path, send_404=False):
-                            tile = Tile(*[ int(coord) for coord in (z, x, y) ])
-                            metatile = MetaTile.from_tile(tile, self.opts.metatile_size)
-                            debug(f"{client.getpeername()}: {metatile!r}")
-
-                            client.metatile = metatile
-                            client.tile_path = tile_path
-
-                            self.clients_for_metatile[metatile].add(client)
-                            self.master.append(metatile, client.getpeername())
-                            self.queries_clients[client] = tile_path
-        else:
-            debug(f"short read from {client.getpeername()}")
+                        response.finish(f"404 not here {path}")
+                        return
+
+                    metatile = MetaTile.from_tile(tile, self.opts.metatile_size)
+                    debug(f"{client.getpeername()}: {metatile!r}")
+
+                    response.metatile = metatile
+                    response.tile_path = tile_path
+
+                    self.responses_for_metatile.setdefault(metatile, set()).add(response)
+                    self.master.append(metatile, response)
 
     def client_write(self, client):
-        client.flush()
-        # BUG: no keep alive support
-        debug(f"closing {client.getpeername()}")
-        client.close()
+        if client.flush():
+            self.update(client)
+        else:
+            self.close(client)
 
-        # bookkeeping
-        self.selector.unregister(client)
-        self.clients.remove(client)
-        if client in self.queries_clients:
-            del self.queries_clients[client]
+    def reap(self):
+        '''Close the idle connections.'''
+        now = time.monotonic()
+        if now - self.last_reap < 1:
+            return
+
+        self.last_reap = now
+
+        for client in list(self.clients):
+            if len(client.responses) == 0 and now - client.last_active > KEEP_ALIVE_TIMEOUT:
+                self.close(client)
 
     def loop(self):
         while True:
             try:
-                # debug(f"select... [{len(self.master.work_stack)=}; {self.master.new_work.qsize()=}; {self.master.store_queue.qsize()=}; {self.master.info.qsize()=}]")
+                # debug(f"select... [{len(self.master.work_entries)=}; {self.master.new_work.qsize()=}; {self.master.store_queue.qsize()=}; {self.master.info.qsize()=}]")
                 # debug(self.selector.get_map())
                 for key, events in self.selector.select(1):
                     # debug('...ed!')
@@ -489,7 +643,8 @@ class Server:
                         if events & EVENT_READ:
                             self.client_read(client)
 
-                        if events & EVENT_WRITE:
+                        # reading might have closed it
+                        if events & EVENT_WRITE and client in self.clients:
                             self.client_write(client)
 
                 # advance the queues
@@ -497,44 +652,40 @@ class Server:
 
                 for metatile in jobs:
                     debug(f"{metatile=}")
-                    # BUG: ugh, shouldn't be touching master's internals like this
-                    clients = self.clients_for_metatile[metatile]
-                    debug(f"{clients=}")
+                    responses = self.responses_for_metatile.pop(metatile, set())
+                    debug(f"{responses=}")
 
-                    for client in clients:
-                        self.answer(client, client.tile_path)
+                    for response in responses:
+                        self.answer(response, response.tile_path)
+                        self.update(response.client)
 
-                    # bookkeeping
-                    del self.clients_for_metatile[metatile]
+                self.reap()
             except Exception as e:
                 if isinstance(e, KeyboardInterrupt):
                     raise
                 else:
                     traceback.print_exc()
 
-    def answer(self, client, file_path, send_404=True):
-        # debug(f"answering {client.getpeername()} for {file_path} ")
+    def answer(self, response, file_path, send_404=True):
+        # debug(f"answering {response.client.getpeername()} for {file_path} ")
         try:
             # this could be considered 'blocking', but if the fs is slow, we have other problems
             # debug(f"find me {file_path}...")
-            file_attrs = os.stat(file_path)
-            # debug('... stat!')
-        except FileNotFoundError:
+            file = open(file_path, 'rb')
+            # debug('... open!')
+        except (FileNotFoundError, IsADirectoryError):
             if send_404:
                 info(f"404: not found {file_path}...")
-                client.send(f"HTTP/1.1 404 not here {file_path}\r\n\r\n".encode())
+                response.finish(f"404 not here {file_path}")
 
             return False
         else:
-            info(f"200: found {file_path} for {client.getpeername()}")
+            info(f"200: found {file_path} for {response.client.getpeername()}")
             ext = os.path.splitext(file_path)[1]
-            client.send(b'HTTP/1.1 200 OK\r\n')
-            client.send(f"Content-Type: {self.content_type[ext]}\r\n".encode())
-            client.send(f"Content-Length: {file_attrs.st_size}\r\n\r\n".encode())
-            client.send(file_path)
-
-            # now we need to wait for client to be ready to write
-            self.selector.register(client, EVENT_WRITE)
+            # fstat() so the length is the one of the file we're sending, even if it's replaced meanwhile
+            size = os.fstat(file.fileno()).st_size
+            content_type = self.content_type.get(ext, 'application/octet-stream')
+            response.finish('200 OK', [ f"Content-Type: {content_type}" ], file, size)
 
         return True
 
@@ -551,8 +702,7 @@ def main(root):
     opts.coords = None
     opts.dry_run = False
     opts.empty = 'skip'
-    opts.empty_color = '#aad3df'
-    opts.empty_size = 103
+    opts.empty_color = [ utils.parse_color('#aad3df') ]
     opts.format = 'tiles'  # TODO?
     opts.mapfile = 'Elevation.xml'
     opts.mapnik_strict = False
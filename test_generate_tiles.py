@@ -1,4 +1,70 @@
-from generate_tiles import time2hms
+from argparse import Namespace
+from collections import deque
+
+import pytest
+
+from generate_tiles import Master
+import tiles
+from utils import time2hms
+
+
+class FakeRenderers:
+    '''Stands in for both the new_work and info queues: put() 'renders' the metatile
+    right away and asks for its children, and get() returns it. is_empty(child) decides
+    which children come back empty, so they're pruned.'''
+    def __init__(self, size, is_empty=lambda child: False):
+        self.size = size
+        self.is_empty = is_empty
+        self.done = deque()
+
+
+    def full(self):
+        return len(self.done) >= self.size
+
+
+    def put(self, metatile):
+        for child in metatile.children():
+            child.is_empty = self.is_empty(child)
+            child.render = not child.is_empty
+
+        self.done.append(metatile)
+
+
+    def empty(self):
+        return len(self.done) == 0
+
+
+    def get(self):
+        return self.done.popleft()
+
+
+class FakeMaster(Master):
+    '''A Master with FakeRenderers and no backend, for measuring and testing the loop.'''
+    def __init__(self, opts, is_empty=lambda child: False):
+        self.is_empty = is_empty
+        super().__init__(opts)
+
+
+    def create_infra(self):
+        self.new_work = self.info = FakeRenderers(32, self.is_empty)
+        self.backend = None
+
+
+    def single_step(self):
+        tight_loop = super().single_step()
+
+        if tight_loop and self.work_stack.size() == 0 and self.went_out == self.came_back:
+            # nothing else can happen, loop() would wait forever
+            raise AssertionError(f"{self.tiles_rendered}+{self.tiles_skipped} != {self.tiles_to_render}")
+
+        return tight_loop
+
+
+def fake_master_opts(bbox, min_zoom, max_zoom, order=None):
+    return Namespace(bbox=bbox, bbox_name='fake', min_zoom=min_zoom, max_zoom=max_zoom,
+                     metatile_size=8, tile_size=256, order=order, parallel='threads', threads=1,
+                     checkers=0, single_tiles=False, push_children=True, skip_existing=False,
+                     skip_newer=None, missing_as_new=False, journal=None, resume=False)
 
 
 def test_time2hms():
@@ -6,3 +72,110 @@ def test_time2hms():
     assert time2hms  (59) == (0, 0, 59)
     assert time2hms  (60) == (0, 1,  0)
     assert time2hms(3600) == (1, 0,  0)
+
+
+def test_pyramid_plan():
+    import map_utils
+    from generate_tiles import PyramidPlan
+
+    # Europe
+    bbox = map_utils.BBox((-10, 35, 30, 60), 10)
+    plan = PyramidPlan(bbox, 3, 10, 8, 256)
+
+    # ZL3 is a single metatile covering the world
+    assert plan.counts[3] == (1, 64)
+    assert plan.counts[10] == (210, 13440)
+    assert plan.tiles == sum( tiles for _, tiles in plan.counts.values() )
+
+    # the whole pyramid hangs from the initial metatile
+    assert plan.subtree_tiles(tiles.MetaTile(3, 0, 0, 8, 256)) == plan.tiles
+    # and nothing hangs from one in the other side of the world
+    assert plan.subtree_tiles(tiles.MetaTile(10, 0, 0, 8, 256)) == 0
+
+
+def test_render_stack_peek():
+    from generate_tiles import RenderStack
+
+    stack = RenderStack(18)
+    stack.extend(iter(range(10)), 10)
+    stack.push('a')
+    stack.push('b')
+
+    assert stack.peek(4) == [ 'b', 'a', 0, 1 ]
+    # peek()ing does not change what's pop()'ed
+    assert stack.size() == 12
+
+    popped = []
+    while stack.size() > 0:
+        popped.append(stack.pop())
+        stack.confirm()
+
+    assert popped == [ 'b', 'a' ] + list(range(10))
+
+
+def test_render_journal(tmp_path):
+    from generate_tiles import RenderJournal
+
+    path = str(tmp_path / 'journal')
+    params = dict(min_zoom=0, max_zoom=18)
+
+    journal = RenderJournal(path, params, resume=False)
+    journal.rendered(tiles.MetaTile(0, 0, 0, 8, 256), 1, 0)
+    journal.skipped(tiles.MetaTile(1, 0, 0, 8, 256))
+    journal.close()
+
+    # a half written line
+    with open(path, 'a') as f:
+        f.write('R 2 0')
+
+    journal = RenderJournal(path, params, resume=True)
+    assert journal.entries == { (0, 0, 0): ('R', 1, 0), (1, 0, 0): ('S', 0, 0) }
+    journal.out_of_bbox(tiles.MetaTile(2, 0, 0, 8, 256))
+    journal.close()
+
+    journal = RenderJournal(path, params, resume=True)
+    assert journal.entries[(2, 0, 0)] == ('O', 0, 0)
+    journal.close()
+
+    with pytest.raises(ValueError):
+        RenderJournal(path, dict(min_zoom=1, max_zoom=18), resume=True)
+
+
+def test_render_journal_durable(tmp_path):
+    from generate_tiles import RenderJournal
+
+    path = str(tmp_path / 'journal')
+    params = dict(min_zoom=0, max_zoom=18, order=None)
+
+    journal = RenderJournal(path, params, resume=False)
+    journal.rendered(tiles.MetaTile(1, 0, 0, 8, 256), 0, 0)
+    journal.rendered(tiles.MetaTile(1, 1, 0, 8, 256), 0, 0)
+    journal.durable([ (1, 0, 0) ])
+    # killed before the other one's tiles were durable
+    journal.sync()
+    journal.file.close()
+
+    journal = RenderJournal(path, params, resume=True)
+    assert journal.entries == { (1, 0, 0): ('R', 0, 0) }
+    journal.close()
+
+    with pytest.raises(ValueError):
+        RenderJournal(path, dict(params, order='hilbert'), resume=True)
+
+
+@pytest.mark.parametrize('order', [ None, 'hilbert' ])
+def test_master_loop_totals(order):
+    import map_utils
+
+    # Europe; ZLs 0 to 2 have shrunk metatiles
+    bbox = map_utils.BBox((-10, 35, 30, 60), 8)
+    # some children come back empty, so their subtrees are pruned
+    master = FakeMaster(fake_master_opts(bbox, 0, 8, order),
+                        is_empty=lambda child: (child.x + child.y) % 3 == 0)
+
+    count, initial_metatiles = master.metatiles_for_bbox()
+    master.loop(initial_metatiles, count)
+
+    assert master.tiles_rendered > 0
+    assert master.tiles_skipped > 0
+    assert master.tiles_rendered + master.tiles_skipped == master.plan.tiles
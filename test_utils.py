@@ -0,0 +1,65 @@
+import utils
+
+
+def test_hilbert_key():
+    z = 4
+    side = 2**z
+    cells = { utils.hilbert_key(z, x, y): (x, y) for x in range(side) for y in range(side) }
+
+    assert sorted(cells.keys()) == list(range(side**2))
+
+    # consecutive cells are neighbours
+    for key in range(side**2 - 1):
+        (x0, y0), (x1, y1) = cells[key], cells[key + 1]
+        assert abs(x0 - x1) + abs(y0 - y1) == 1
+
+
+def test_morton_key():
+    assert [ utils.morton_key(1, x, y) for x, y in ((0, 0), (1, 0), (0, 1), (1, 1)) ] == [ 0, 1, 2, 3 ]
+    assert utils.morton_key(2, 3, 3) == 15
+
+
+def test_curve_walk():
+    blocks = list(utils.curve_walk(5, 3, 5, 20, 9, 2, utils.hilbert_key))
+    expected = { (x, y) for x in range(2, 20, 2) for y in range(4, 10, 2) }
+
+    assert len(blocks) == len(expected)
+    assert set(blocks) == expected
+
+
+def test_lru_cache():
+    cache = utils.LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    cache['a']
+    cache['c'] = 3
+
+    assert list(cache.keys()) == [ 'a', 'c' ]
+
+    # checking for it or get()ting it also counts as using it
+    assert 'a' in cache
+    cache['d'] = 4
+    assert list(cache.keys()) == [ 'a', 'd' ]
+
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    cache['e'] = 5
+    assert list(cache.keys()) == [ 'a', 'e' ]
+
+
+def test_parse_color():
+    # little endian RGBA
+    assert utils.parse_color('#aad3df') == 0xffdfd3aa
+    assert utils.parse_color('aad3df80') == 0x80dfd3aa
+    assert utils.parse_color('transparent') == utils.TRANSPARENT
+
+
+def test_uniform_color():
+    sea = utils.parse_color('#aad3df')
+    colors = [ sea, utils.TRANSPARENT ]
+
+    assert utils.uniform_color(bytes.fromhex('aad3dfff') * 256, colors) == sea
+    assert utils.uniform_color(bytes.fromhex('aad3dfff') * 255 + bytes.fromhex('aad3dffe'), colors) is None
+    # any fully transparent pixel will do
+    assert utils.uniform_color(bytes.fromhex('00000000') * 255 + bytes.fromhex('ffffff00'), colors) == utils.TRANSPARENT
+    assert utils.uniform_color(bytes.fromhex('ffffffff') * 256, colors) is None
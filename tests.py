@@ -3,32 +3,34 @@
 import unittest
 import os
 import sqlite3
+import datetime
+import shutil
 
 import map_utils
 
+# the data is not really important either, as long as they're different
+sea = b'\x89PNG sea'
+data1 = b'\x89PNG data1'
+data2 = b'\x89PNG data2'
+
 class TestMBTiles (unittest.TestCase):
 
     def setUp (self):
         # the bbox is not really important
-        self.backend= map_utils.MBTilesBackend ('TestMBTiles', [10, 20, 30, 40])
+        self.backend= map_utils.MBTilesBackend ('TestMBTiles.mbt', [10, 20, 30, 40])
         session= sqlite3.connect ('TestMBTiles.mbt')
-        self.session.set_trace_callback (print)
         self.db= session.cursor ()
 
 
     def test_single_tile (self):
-        data= open ('sea.png', 'rb').read ()
-
-        self.backend.store (0, 0, 0, data)
+        self.backend.store_raw (0, 0, 0, sea)
         self.backend.commit ()
 
-        self.assertTrue (self.backend.exists (0, 0, 0))
+        self.assertTrue (self.backend.exists ((0, 0, 0)))
 
     def test_two_seas_one_tile (self):
-        data= open ('sea.png', 'rb').read ()
-
-        self.backend.store (0, 0, 0, data)
-        self.backend.store (1, 1, 1, data)
+        self.backend.store_raw (0, 0, 0, sea)
+        self.backend.store_raw (1, 1, 1, sea)
         self.backend.commit ()
         self.backend.close ()
 
@@ -54,21 +56,304 @@ class TestMBTiles (unittest.TestCase):
         self.assertEqual (len (tiles), 2)
 
     def test_update (self):
-        data1= open ('data1.png', 'rb').read ()
-        data2= open ('data2.png', 'rb').read ()
-
-        self.backend.store (0, 0, 0, data1)
+        self.backend.store_raw (0, 0, 0, data1)
         self.backend.commit ()
-        self.backend.store (0, 0, 0, data2)
+        self.backend.store_raw (0, 0, 0, data2)
         self.backend.commit ()
         self.backend.close ()
 
         data3= self.db.execute ('SELECT tile_data FROM tiles;').fetchall ()
         self.assertEqual (data3[0][0], data2)
 
+    def test_batch (self):
+        self.backend.close ()
+        self.backend= map_utils.MBTilesBackend ('TestMBTiles.mbt', [10, 20, 30, 40], batch_size=3)
+
+        for y in range (3):
+            self.backend.store_raw (2, 0, y, sea)
+            self.backend.commit ()
+
+            # nothing is written until the batch is full
+            count= self.db.execute ('SELECT count(*) FROM map;').fetchall ()[0][0]
+            self.assertEqual (count, 0 if y < 2 else 3)
+
+        self.backend.store_raw (2, 1, 0, data1)
+        self.backend.close ()
+
+        # close() writes what's left
+        count= self.db.execute ('SELECT count(*) FROM map;').fetchall ()[0][0]
+        self.assertEqual (count, 4)
+
+    def test_writer (self):
+        self.backend.close ()
+
+        writer= map_utils.MBTilesWriter ('TestMBTiles.mbt', [10, 20, 30, 40], batch_size=100)
+        writer.start ()
+        self.backend= map_utils.MBTilesBackend ('TestMBTiles.mbt', [10, 20, 30, 40], writer=writer)
+
+        for y in range (10):
+            self.backend.store_raw (4, 0, y, sea)
+            generation= self.backend.commit ()
+
+        self.backend.close ()
+        writer.stop ()
+
+        count= self.db.execute ('SELECT count(*) FROM map;').fetchall ()[0][0]
+        self.assertEqual (count, 10)
+        self.assertEqual (self.backend.durable (), generation)
+
+    def test_newer_than (self):
+        before= datetime.datetime.now () - datetime.timedelta (days=1)
+        after= datetime.datetime.now () + datetime.timedelta (days=1)
+
+        self.backend.store_raw (3, 0, 0, sea)
+        self.backend.commit ()
+
+        self.assertTrue (self.backend.newer_than ((3, 0, 0), before, False))
+        self.assertFalse (self.backend.newer_than ((3, 0, 0), after, False))
+        self.assertTrue (self.backend.newer_than ((3, 0, 1), before, True))
+
+        metatile= map_utils.MetaTile (3, 0, 0, 2, 256)
+        self.assertFalse (self.backend.all_newer_than (metatile, before, False))
+        self.assertTrue (self.backend.all_newer_than (metatile, before, True))
+        self.assertFalse (self.backend.all_newer_than (metatile, after, True))
+
+    def test_migration (self):
+        self.backend.close ()
+        # an old file, without timestamps
+        self.db.execute ('DROP INDEX map_rendered_at;')
+        self.db.execute ('ALTER TABLE map DROP COLUMN rendered_at;')
+        self.db.execute ("INSERT INTO map VALUES (3, 0, 0, 'foo');")
+        self.db.connection.commit ()
+
+        self.backend= map_utils.MBTilesBackend ('TestMBTiles.mbt', [10, 20, 30, 40])
+        before= datetime.datetime.now () - datetime.timedelta (days=1)
+
+        # old tiles are old
+        self.assertFalse (self.backend.newer_than ((3, 0, 0), before, False))
+
+    def test_migrate_tile_ids (self):
+        self.backend.close ()
+        # an old file, with md5 hexdigests as tile_ids
+        self.db.execute ("DELETE FROM metadata WHERE name = 'tile_id_format';")
+        self.db.connection.commit ()
+
+        self.backend= map_utils.MBTilesBackend ('TestMBTiles.mbt', [10, 20, 30, 40])
+        self.backend.store_raw (0, 0, 0, sea)
+        self.backend.store_raw (1, 1, 1, sea)
+        self.backend.store_raw (1, 0, 0, data1)
+        self.backend.flush ()
+        self.assertEqual (len (self.db.execute ('SELECT tile_id FROM images;').fetchall ()[0][0]), 32)
+
+        # a half migrated file, without the view
+        self.db.execute ('DROP VIEW tiles;')
+        self.db.connection.commit ()
+
+        self.backend.migrate_tile_ids ()
+
+        ids= self.db.execute ('SELECT tile_id FROM images;').fetchall ()
+        self.assertEqual (len (ids), 2)
+        self.assertEqual (len (ids[0][0]), 16)
+
+        data= self.db.execute ('SELECT tile_data FROM tiles ORDER BY zoom_level, tile_column;').fetchall ()
+        self.assertEqual (data, [ (sea, ), (data1, ), (sea, ) ])
+
+    def tearDown (self):
+        self.backend.close ()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists ('TestMBTiles.mbt' + suffix):
+                os.unlink ('TestMBTiles.mbt' + suffix)
+
+class TestPMTiles (unittest.TestCase):
+
+    def setUp (self):
+        self.backend= map_utils.PMTilesBackend ('TestPMTiles.pmtiles', [10, 20, 30, 40])
+
+    def test_tile_ids (self):
+        # from the spec
+        ids= [ map_utils.pmtiles_tile_id (*tile)
+               for tile in ((0, 0, 0), (1, 0, 0), (1, 0, 1), (1, 1, 1), (1, 1, 0), (2, 0, 0)) ]
+        self.assertEqual (ids, [ 0, 1, 2, 3, 4, 5 ])
+
+    def test_roundtrip (self):
+        # enough tiles to need leaf directories
+        expected= {}
+        for x in range (256):
+            for y in range (256):
+                data= sea if (x + y) % 3 == 0 else b'%d/%d' % (x, y)
+                self.backend.store_raw (8, x, y, data)
+                expected[(8, x, y)]= data
+
+        self.backend.store_raw (8, 1, 1, data1)
+        expected[(8, 1, 1)]= data1
+        # stored long ago, so it's not among the recent contents anymore
+        self.backend.store_raw (8, 2, 2, b'0/1')
+        expected[(8, 2, 2)]= b'0/1'
+        self.backend.close ()
+
+        for suffix in ('.data', '.entries', '.contents'):
+            self.assertFalse (os.path.exists ('TestPMTiles.pmtiles' + suffix))
+
+        reader= map_utils.PMTilesBackend ('TestPMTiles.pmtiles', None, ro=True)
+        for (z, x, y), data in expected.items ():
+            tile= map_utils.Tile (z, x, y)
+            self.assertTrue (reader.fetch (tile))
+            self.assertEqual (tile.data, data)
+
+        self.assertFalse (reader.exists ((7, 0, 0)))
+        reader.close ()
+
+    def tearDown (self):
+        self.backend.close ()
+        if os.path.exists ('TestPMTiles.pmtiles'):
+            os.unlink ('TestPMTiles.pmtiles')
+
+class TestDiskBackend (unittest.TestCase):
+
+    def setUp (self):
+        self.backend= map_utils.DiskBackend ('TestDiskBackend', write_threads=2)
+
+    def test_write_behind (self):
+        for y in range (16):
+            tile= map_utils.Tile (4, 3, y)
+            tile.data= sea if y % 2 else data1
+            self.backend.store (tile)
+
+        self.backend.commit ()
+        self.backend.flush ()
+
+        self.assertEqual (len (os.listdir ('TestDiskBackend/4/3')), 16)
+
+        tile= map_utils.Tile (4, 3, 2)
+        self.assertTrue (self.backend.fetch (tile))
+        self.assertEqual (tile.data, data1)
+
+    def test_durable (self):
+        tile= map_utils.Tile (4, 3, 0)
+        tile.data= data1
+        self.backend.store (tile)
+        first= self.backend.commit ()
+
+        # the first batch is waited for in the next commit()
+        tile= map_utils.Tile (4, 3, 1)
+        tile.data= data2
+        self.backend.store (tile)
+        second= self.backend.commit ()
+        self.assertEqual (self.backend.durable (), first)
+
+        self.backend.close ()
+        self.assertGreaterEqual (self.backend.durable (), second)
+
+    def test_skip_unchanged (self):
+        for data in (data1, data1, data2):
+            backend= map_utils.DiskBackend ('TestDiskBackend', skip_unchanged=True,
+                                            manifest='TestDiskBackend/manifest')
+            tile= map_utils.Tile (4, 3, 2)
+            tile.data= data
+            backend.store (tile)
+            backend.close ()
+
+        # the second time it's not written
+        with open ('TestDiskBackend/manifest') as f:
+            self.assertEqual (f.read (), '4/3/2\n4/3/2\n')
+
+        self.assertTrue (self.backend.fetch (tile))
+        self.assertEqual (tile.data, data2)
+
+    def test_overwrite_link (self):
+        # the blobs are in another dir, so the backend can't know there are links
+        linker= map_utils.DiskBackend ('TestDiskBackend', blob_dir='TestDiskBackend/other')
+        for y in (1, 2):
+            tile= map_utils.Tile (4, 3, y)
+            tile.data= sea
+            linker.link (tile)
+        linker.close ()
+
+        tile= map_utils.Tile (4, 3, 1)
+        tile.data= data1
+        self.backend.store (tile)
+        self.backend.commit ()
+        self.backend.flush ()
+
+        # the other tile linked to the same blob is still sea
+        tile= map_utils.Tile (4, 3, 2)
+        self.assertTrue (self.backend.fetch (tile))
+        self.assertEqual (tile.data, sea)
+
+    def store_metatile (self, metatile, missing=0):
+        for tile in metatile.tiles[missing:]:
+            tile.data= data1
+            self.backend.store (tile)
+
+        self.backend.commit ()
+        self.backend.flush ()
+
+        # the dirs are scanned only once, so check with another one
+        return map_utils.DiskBackend ('TestDiskBackend')
+
+    def test_partial_metatile (self):
+        metatile= map_utils.MetaTile (4, 2, 2, 2, 256)
+        before= datetime.datetime.now () - datetime.timedelta (days=1)
+        checker= self.store_metatile (metatile, missing=1)
+
+        self.assertFalse (checker.all_exist (metatile))
+        self.assertFalse (checker.all_newer_than (metatile, before, False))
+        self.assertTrue (checker.all_newer_than (metatile, before, True))
+
+    def test_full_metatile (self):
+        metatile= map_utils.MetaTile (4, 2, 2, 2, 256)
+        before= datetime.datetime.now () - datetime.timedelta (days=1)
+        checker= self.store_metatile (metatile)
+
+        self.assertTrue (checker.all_exist (metatile))
+        self.assertTrue (checker.all_newer_than (metatile, before, False))
+
+    def test_old_metatile (self):
+        metatile= map_utils.MetaTile (4, 2, 2, 2, 256)
+        before= datetime.datetime.now () - datetime.timedelta (days=1)
+        checker= self.store_metatile (metatile)
+
+        old= (before - datetime.timedelta (days=1)).timestamp ()
+        for tile in metatile.tiles:
+            os.utime (self.backend.tile_uri (tile), (old, old))
+
+        self.assertTrue (checker.all_exist (metatile))
+        self.assertFalse (checker.all_newer_than (metatile, before, False))
+        self.assertFalse (checker.all_newer_than (metatile, before, True))
+
+    def tearDown (self):
+        self.backend.close ()
+        shutil.rmtree ('TestDiskBackend', ignore_errors=True)
+
+class TestModTile (unittest.TestCase):
+
+    def setUp (self):
+        self.backend= map_utils.ModTileBackend ('TestModTile')
+
+    def test_meta (self):
+        for x in range (8):
+            for y in range (8):
+                tile= map_utils.Tile (10, 8 + x, 16 + y)
+                tile.data= sea if x == y else b'%d/%d' % (x, y)
+                self.backend.store (tile)
+
+        self.backend.commit ()
+
+        # all in one file, and mod_tile's path
+        self.assertEqual (self.backend.tile_uri ((10, 13, 21)), 'TestModTile/10/0/0/0/1/128.meta')
+        self.assertEqual (os.listdir ('TestModTile/10/0/0/0/1'), [ '128.meta' ])
+
+        tile= map_utils.Tile (10, 9, 17)
+        self.assertTrue (self.backend.fetch (tile))
+        self.assertEqual (tile.data, sea)
+
+        tile= map_utils.Tile (10, 15, 16)
+        self.assertTrue (self.backend.fetch (tile))
+        self.assertEqual (tile.data, b'7/0')
+
     def tearDown (self):
         self.backend.close ()
-        os.unlink ('TestMBTiles.mbt')
+        shutil.rmtree ('TestModTile', ignore_errors=True)
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
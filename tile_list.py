@@ -2,6 +2,8 @@
 
 import sys
 
+import numpy
+
 import map_utils
 
 bbox= [ float (x) for x in sys.argv[1].split (',') ]
@@ -16,20 +18,22 @@ gprj = map_utils.GoogleProjection(maxZoom+1)
 ll0 = (bbox[0],bbox[3])
 ll1 = (bbox[2],bbox[1])
 
-image_size = 256.0
+image_size = 256
 
-for z in range(minZoom, maxZoom + 1):
-    px0 = gprj.lon_lat2pixel(ll0, z)
-    px1 = gprj.lon_lat2pixel(ll1, z)
+# project the bbox for all the ZLs in one go
+zooms = numpy.arange(minZoom, maxZoom + 1)
+px0s = gprj.lon_lat2pixels([ ll0 ] * len(zooms), zooms).tolist()
+px1s = gprj.lon_lat2pixels([ ll1 ] * len(zooms), zooms).tolist()
 
-    for x in range(int(px0[0] / image_size),
-                   int(px1[0] / image_size) + 1):
+for z, px0, px1 in zip(zooms.tolist(), px0s, px1s):
+    for x in range(int(px0[0] // image_size),
+                   int(px1[0] // image_size) + 1):
         # Validate x co-ordinate
         if (x < 0) or (x >= 2**z):
             continue
 
-        for y in range(int(px0[1] / image_size),
-                       int(px1[1] / image_size) + 1):
+        for y in range(int(px0[1] // image_size),
+                       int(px1[1] // image_size) + 1):
             # Validate x co-ordinate
             if (y < 0) or (y >= 2**z):
                 continue
@@ -74,6 +74,9 @@ def main():
         if mbt_exts.match(ext) is not None:
             atlas[basename] = map_utils.MBTilesBackend(map, None, ro=True)
 
+        elif ext == '.pmtiles':
+            atlas[basename] = map_utils.PMTilesBackend(map, None, ro=True)
+
         elif stat.S_ISDIR(os.stat(map).st_mode):
             atlas[basename] = map_utils.DiskBackend(map)
 
@@ -1,6 +1,8 @@
 from math import pi, cos, sin, log, exp, atan
+from logging import debug
 from typing import List, Tuple, Dict, Optional, Any, Union
 
+import numpy
 from shapely.geometry import Polygon
 
 
@@ -45,6 +47,12 @@ class GoogleProjection:
             # the world doubles in size on each zoom level
             world_size *= 2
 
+        # same values, for the batch versions
+        self.pixels_per_degree_array = numpy.array(self.pixels_per_degree)
+        self.pixels_per_radian_array = numpy.array(self.pixels_per_radian)
+        self.center_pixel_array = numpy.array([ center for center, _ in self.center_pixel ],
+                                              dtype=numpy.int64)
+
 
     # it's LonLat! (lon, lat)
     def lon_lat2pixel(self, lon_lat:Tuple[float, float], zoom:int) -> Tuple[int, int]:
@@ -73,11 +81,74 @@ class GoogleProjection:
 
         return (lon, lat)
 
+
+    def lon_lat2pixels(self, lon_lats, zooms) -> numpy.ndarray:
+        """
+        Batch version of lon_lat2pixel(). lon_lats is anything numpy can convert
+        into an array of shape (n, 2) and zooms is either a single ZL or n of them.
+        Returns an int array of shape (n, 2).
+        """
+        lon_lats = numpy.asarray(lon_lats, dtype=float).reshape(-1, 2)
+        lon = lon_lats[:, 0]
+        lat = lon_lats[:, 1]
+        zooms = numpy.asarray(zooms)
+        center = self.center_pixel_array[zooms]
+
+        # numpy.rint() also rounds half to even, like round()
+        x = center + numpy.rint(lon * self.pixels_per_degree_array[zooms]).astype(numpy.int64)
+
+        f = numpy.clip(numpy.sin(DEG_TO_RAD * lat), -0.9999, 0.9999)
+        y = center + numpy.rint(0.5 * numpy.log((1 + f) / (1 - f)) *
+                                -self.pixels_per_radian_array[zooms]).astype(numpy.int64)
+
+        return numpy.stack((x, y), axis=-1)
+
+
+    def pixels2lon_lats(self, pxs, zooms) -> numpy.ndarray:
+        """
+        Batch version of pixel2lon_lat(). pxs is anything numpy can convert into
+        an array of shape (n, 2) and zooms is either a single ZL or n of them.
+        Returns a float array of shape (n, 2).
+        """
+        pxs = numpy.asarray(pxs).reshape(-1, 2)
+        zooms = numpy.asarray(zooms)
+        center = self.center_pixel_array[zooms]
+
+        lon = (pxs[:, 0] - center) / self.pixels_per_degree_array[zooms]
+
+        angle = (pxs[:, 1] - center) / -self.pixels_per_radian_array[zooms]
+        lat = RAD_TO_DEG * (2 * numpy.arctan(numpy.exp(angle)) - 0.5 * pi)
+
+        return numpy.stack((lon, lat), axis=-1)
+
 # enough ZLs for a lifetime
 tileproj = GoogleProjection(30)
 
 
+def lon_lat_box(corners, z:int):
+    """Converts the pixel corners ((x0, y0), (x1, y1)) of ZL z into the LongLat
+    coords ((long0, lat0), (long1, lat1))."""
+    # coords are LongLat, and Lat grows upwards, so when calling these functions,
+    # we have to swap the lat's
+    long0, lat1 = tileproj.pixel2lon_lat(corners[0], z)
+    long1, lat0 = tileproj.pixel2lon_lat(corners[1], z)
+
+    return ( (long0, lat0), (long1, lat1) )
+
+
+def box_polygon(coords) -> Polygon:
+    """Returns the Polygon for the LongLat coords ((long0, lat0), (long1, lat1))."""
+    polygon_points = [ (coords[i][0], coords[j][1])
+                       for i, j in ((0, 0), (1, 0), (1, 1), (0, 1), (0, 0)) ]
+
+    return Polygon(polygon_points)
+
+
 class Tile:
+    # there can be millions of these, so keep them slim: no __dict__,
+    # and coords and polygon are computed only if needed
+    __slots__ = ('z', 'x', 'y', 'size', 'meta_index', 'data', 'is_empty', '_coords', '_polygon')
+
     # def __init__(self, z:int, x:int, y:int, metatile:Optional[MetaTile]=None) -> None:
     def __init__(self, z:int, x:int, y:int, metatile=None) -> None:
         # NOTE: there are 3 sets of coordinates and their vertical component grow in different directions
@@ -89,38 +160,64 @@ class Tile:
 
         # self.meta_index:Optional[Tuple[int, int]] = None
         self.meta_index = None
-        self.meta_pixel_coords = None
         if metatile is not None:
             self.meta_index = (x - metatile.x, y - metatile.y)
-            self.meta_pixel_coords = ()
             self.size = metatile.tile_size
         else:
             # TODO: no support for hi res tiles
             self.size = 256
 
+        self._coords = None
+        self._polygon = None
+
+        self.data: Optional[bytes] = None
+        self.is_empty = None  # Optional[bool]
+
+
+    @property
+    def pixel_pos(self):
         # pixel_pos is based on (z,),x,y; it's relative to the world at this ZL and also grows downwards
-        self.pixel_pos = (self.x * self.size, self.y * self.size)
+        return (self.x * self.size, self.y * self.size)
 
+
+    @property
+    def corners(self):
         # corners are another way to express pixel_pos; same direction
         # ((x0, y0), (x1, y1))
-        self.corners = ( self.pixel_pos,
-                         (self.pixel_pos[0] + self.size,
-                          self.pixel_pos[1] + self.size) )
+        x, y = self.pixel_pos
+        return ( (x, y), (x + self.size, y + self.size) )
 
-        # but coords are LongLat, and Lat grows upwards, so wehn calling these functions,
-        # we have to swap the lat's
-        long0, lat1 = tileproj.pixel2lon_lat(self.corners[0], self.z)
-        long1, lat0 = tileproj.pixel2lon_lat(self.corners[1], self.z)
-        self.coords = ( (long0, lat0), (long1, lat1) )
 
-        polygon_points = [ (self.coords[i][0], self.coords[j][1])
-                           for i, j in ((0, 0), (1, 0), (1, 1), (0, 1), (0, 0)) ]
+    @property
+    def meta_pixel_coords(self):
+        """The position of the tile in its metatile's image, in pixels."""
+        if self.meta_index is None:
+            return None
 
-        self.polygon = Polygon(polygon_points)
+        i, j = self.meta_index
+        return (i * self.size, j * self.size)
 
-        self.image_size = (self.size, self.size)
-        self.data: Optional[bytes] = None
-        self.is_empty = None  # Optional[bool]
+
+    @property
+    def image_size(self):
+        return (self.size, self.size)
+
+
+    @property
+    def coords(self):
+        # but coords are LongLat, and Lat grows upwards
+        if self._coords is None:
+            self._coords = lon_lat_box(self.corners, self.z)
+
+        return self._coords
+
+
+    @property
+    def polygon(self) -> Polygon:
+        if self._polygon is None:
+            self._polygon = box_polygon(self.coords)
+
+        return self._polygon
 
 
     def __eq__(self, other):
@@ -142,6 +239,52 @@ class Tile:
         yield self.y
 
 
+class MetaTileTiles:
+    """
+    The tiles of a MetaTile. It's a sequence of Tiles, but they're created when
+    accessed, so a MetaTile only holds its range of tiles. The order is column
+    first, like in [ (i, j) for i in range(size) for j in range(size) ].
+
+    Because of that, changes to a Tile are not kept in the sequence.
+    """
+    __slots__ = ('metatile', )
+
+    def __init__(self, metatile) -> None:
+        self.metatile = metatile
+
+
+    def __len__(self) -> int:
+        return self.metatile.size**2
+
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [ self[i] for i in range(*index.indices(len(self))) ]
+
+        if index < 0:
+            index += len(self)
+
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+
+        metatile = self.metatile
+        i, j = divmod(index, metatile.size)
+
+        return Tile(metatile.z, metatile.x + i, metatile.y + j, metatile)
+
+
+    def __iter__(self):
+        metatile = self.metatile
+
+        for i in range(metatile.size):
+            for j in range(metatile.size):
+                yield Tile(metatile.z, metatile.x + i, metatile.y + j, metatile)
+
+
+    def __repr__(self) -> str:
+        return "MetaTileTiles(%r)" % (self.metatile, )
+
+
 class PixelTile:
     """It's a (meta) tile with arbitrary pixel bounds."""
     def __init__(self, z, center_x, center_y, size):
@@ -169,15 +312,8 @@ class PixelTile:
                          (self.pixel_pos[0] + self.image_size[0],
                           self.pixel_pos[1] + self.image_size[1]) )
 
-        # we have to swap the lat's
-        long0, lat1 = tileproj.pixel2lon_lat(self.corners[0], self.z)
-        long1, lat0 = tileproj.pixel2lon_lat(self.corners[1], self.z)
-        self.coords = ( (long0, lat0), (long1, lat1) )
-
-        polygon_points = [ (self.coords[i][0], self.coords[j][1])
-                           for i, j in ((0, 0), (1, 0), (1, 1), (0, 1), (0, 0)) ]
-
-        self.polygon = Polygon(polygon_points)
+        self.coords = lon_lat_box(self.corners, self.z)
+        self.polygon = box_polygon(self.coords)
 
         # times
         self.render_time = 0
@@ -221,6 +357,11 @@ class PixelTile:
 
 # Children = List[MetaTile]
 class MetaTile:
+    __slots__ = ('z', 'x', 'y', 'wanted_size', 'size', 'tile_size', 'is_empty', 'render',
+                 '_children', 'tiles', 'im', '_coords', '_polygon',
+                 'render_time', 'serializing_time', 'deserializing_time', 'saving_time',
+                 'durable')
+
     def __init__(self, z:int, x:int, y:int, wanted_size:int, tile_size:int) -> None:
         self.z = z
         self.x = x
@@ -238,36 +379,58 @@ class MetaTile:
         # self._children:Optional[Children] = None
         self._children = None
 
-        self.tiles = [ Tile(self.z, self.x + i, self.y + j, self)
-                       for i in range(self.size) for j in range(self.size) ]
+        self.tiles = MetaTileTiles(self)
 
         self.im: Optional[bytes] = None
 
+        # see coords and polygon
+        self._coords = None
+        self._polygon = None
+
+        # times
+        self.render_time:float = 0
+        self.serializing_time:float = 0
+        self.deserializing_time = 0
+        self.saving_time = 0
+
+        # set by the store: the (z, x, y) of the metatiles whose tiles became durable
+        self.durable:List[Tuple[int, int, int]] = []
+
+
+    @property
+    def pixel_pos(self):
         # (x, y)
-        self.pixel_pos = (self.x * self.tile_size, self.y * self.tile_size)
+        return (self.x * self.tile_size, self.y * self.tile_size)
+
+
+    @property
+    def image_size(self):
         # (w, h)
-        self.image_size = (self.size * self.tile_size, self.size * self.tile_size)
+        return (self.size * self.tile_size, self.size * self.tile_size)
+
 
+    @property
+    def corners(self):
         # ((x0, y0), (x1, y1))
-        self.corners = ( self.pixel_pos,
-                         (self.pixel_pos[0] + self.image_size[0],
-                          self.pixel_pos[1] + self.image_size[1]) )
+        return ( self.pixel_pos,
+                 (self.pixel_pos[0] + self.image_size[0],
+                  self.pixel_pos[1] + self.image_size[1]) )
 
-        # we have to swap the lat's
-        long0, lat1 = tileproj.pixel2lon_lat(self.corners[0], self.z)
-        long1, lat0 = tileproj.pixel2lon_lat(self.corners[1], self.z)
-        self.coords = ( (long0, lat0), (long1, lat1) )
 
-        polygon_points = [ (self.coords[i][0], self.coords[j][1])
-                           for i, j in ((0, 0), (1, 0), (1, 1), (0, 1), (0, 0)) ]
+    @property
+    def coords(self):
+        if self._coords is None:
+            self._coords = lon_lat_box(self.corners, self.z)
 
-        self.polygon = Polygon(polygon_points)
+        return self._coords
 
-        # times
-        self.render_time:float = 0
-        self.serializing_time:float = 0
-        self.deserializing_time = 0
-        self.saving_time = 0
+
+    @property
+    def polygon(self) -> Polygon:
+        if self._polygon is None:
+            self._polygon = box_polygon(self.coords)
+
+        return self._polygon
 
     @staticmethod
     def from_tile(tile: Tile, wanted_size):
@@ -1,28 +1,183 @@
 #! /usr/bin/env python3
 
-import sys
+# imports a slippy map tile dir (Z/X/Y.png) into an MBTiles file.
+# the import is done one X column of tiles at a time, and the finished columns are
+# recorded in the same transactions as their tiles, so it can be interrupted and resumed.
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+import os
 import os.path
+import time
 
 import map_utils
+import utils
+
+from typing import List, Optional, Set, Tuple
+
+# the finished columns; dropped when the import finishes
+PROGRESS_TABLE = 'import_progress'
+WORLD = (-180, -85.05112878, 180, 85.05112878)
+# what the old 'tiles2mbt.py BBOX_NAME' imported from
+LEGACY_TILE_DIR = 'Elevation'
+
+
+def scan_column(path:str) -> List[Tuple[int, str]]:
+    '''Returns the y and path of each tile in a column dir.'''
+    tiles = []
+
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                name, extension = os.path.splitext(entry.name)
+                if extension != '.png':
+                    continue
+
+                try:
+                    tiles.append( (int(name), entry.path) )
+                except ValueError:
+                    pass
+    except FileNotFoundError:
+        pass
+
+    return tiles
+
+
+def read(path:str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def columns(tile_dir:str, z:int, atlas:Optional[map_utils.Atlas]) -> List[int]:
+    xs = []
+
+    try:
+        with os.scandir(os.path.join(tile_dir, str(z))) as entries:
+            for entry in entries:
+                try:
+                    x = int(entry.name)
+                except ValueError:
+                    continue
+
+                if atlas is None or (z, x) in atlas:
+                    xs.append(x)
+    except FileNotFoundError:
+        pass
+
+    return sorted(xs)
+
+
+def finished_columns(backend:map_utils.MBTilesBackend) -> Set[Tuple[int, int]]:
+    backend.session.execute(f'''CREATE TABLE IF NOT EXISTS {PROGRESS_TABLE}(
+        zoom_level   INTEGER NOT NULL,
+        tile_column  INTEGER NOT NULL,
+        PRIMARY KEY (zoom_level, tile_column)
+    );''')
+    backend.session.commit()
+
+    return set(backend.session.execute(f"SELECT zoom_level, tile_column FROM {PROGRESS_TABLE};"))
+
+
+def parse_args():
+    parser = ArgumentParser()
+
+    parser.add_argument('tile_dir', metavar='TILE_DIR',
+                        help='Slippy map tiles, as in TILE_DIR/Z/X/Y.png. For compatibility, if it is '
+                             f"not a dir but a bbox in atlas.ini, it's imported from {LEGACY_TILE_DIR}/.")
+    parser.add_argument('-o', '--output',     dest='output',     default=None,
+                        help='Defaults to [BBOX_NAME or TILE_DIR].mbt.')
+    parser.add_argument('-B', '--bbox-name',  dest='bbox_name',  default=None,
+                        help='Only import the tiles in this bbox from atlas.ini.')
+    parser.add_argument('-n', '--min-zoom',   dest='min_zoom',   default=0, type=int)
+    parser.add_argument('-x', '--max-zoom',   dest='max_zoom',   default=18, type=int)
+    parser.add_argument('-t', '--threads',    dest='threads',    default=4 * utils.NUM_CPUS, type=int,
+                        help='For scanning the dirs and reading the tiles.')
+    parser.add_argument(      '--batch-size', dest='batch_size', default=10000, type=int,
+                        help='How many tiles to write in each transaction.')
+
+    opts = parser.parse_args()
+
+    if opts.bbox_name is None and not os.path.isdir(opts.tile_dir):
+        # the old calling form, tiles2mbt.py BBOX_NAME
+        atlas_config = ConfigParser()
+        atlas_config.read('atlas.ini')
+
+        if atlas_config.has_option('maps', opts.tile_dir):
+            print(f"{opts.tile_dir} is a bbox name, importing from {LEGACY_TILE_DIR}/; "
+                  f"this form is deprecated, use: {parser.prog} -B {opts.tile_dir} {LEGACY_TILE_DIR}")
+            opts.bbox_name = opts.tile_dir
+            opts.tile_dir = LEGACY_TILE_DIR
+
+    if opts.output is None:
+        name = opts.bbox_name or os.path.basename(os.path.normpath(opts.tile_dir))
+        opts.output = f"{name}.mbt"
+
+    return opts
+
+
+def main():
+    opts = parse_args()
+
+    atlas = None
+    bounds = WORLD
+    if opts.bbox_name is not None:
+        atlas = map_utils.Atlas([ opts.bbox_name ])
+        bounds = atlas.maps[opts.bbox_name].bbox
+        # the bbox does not define ZLs further down
+        opts.max_zoom = min(opts.max_zoom, atlas.maxZoom)
+
+    # batch_seconds is not needed, we flush() when the batch is full
+    backend = map_utils.MBTilesBackend(opts.output, bounds, opts.min_zoom, opts.max_zoom,
+                                       batch_size=opts.batch_size, batch_seconds=float('inf'))
+    finished = finished_columns(backend)
+    if len(finished) > 0:
+        print(f"resuming, {len(finished)} columns already imported.")
+
+    tiles = megabytes = 0
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(opts.threads) as executor:
+        for z in range(opts.min_zoom, opts.max_zoom + 1):
+            xs = [ x for x in columns(opts.tile_dir, z, atlas) if (z, x) not in finished ]
+            print(f"ZL {z}: {len(xs)} columns to import.")
+
+            # map() submits everything at once, so go by batches of columns
+            for index in range(0, len(xs), opts.threads):
+                batch = xs[index:index + opts.threads]
+                column_dirs = [ os.path.join(opts.tile_dir, str(z), str(x)) for x in batch ]
+
+                for x, found in zip(batch, executor.map(scan_column, column_dirs)):
+                    if atlas is not None:
+                        found = [ (y, path) for y, path in found if (z, x, y) in atlas ]
+
+                    paths = [ path for _, path in found ]
+                    for (y, _), data in zip(found, executor.map(read, paths)):
+                        backend.store_raw(z, x, y, data)
+                        tiles += 1
+                        megabytes += len(data) / 2**20
+
+                    # in the same transaction as the column's last tiles
+                    backend.session.execute(f'''INSERT OR IGNORE INTO {PROGRESS_TABLE}
+                                                (zoom_level, tile_column) VALUES (?, ?);''', (z, x))
+                    backend.commit()
+
+                elapsed = time.perf_counter() - start
+                print(f"{z}/{batch[-1]}: {tiles} tiles, {megabytes:.1f}MiB; "
+                      f"{tiles / elapsed:.1f} tiles/s, {megabytes / elapsed:.2f}MiB/s")
 
-sector = sys.argv[1]
+    backend.flush()
 
-atlas = map_utils.Atlas([sector])
-map = atlas.maps[sector]
-backend = map_utils.MBTilesBackend(f"{sector}.mbt", map.bbox)
+    # it's complete
+    backend.session.execute(f"DROP TABLE {PROGRESS_TABLE};")
+    backend.session.commit()
+    backend.close()
 
-# backend.init()
+    elapsed = time.perf_counter() - start
+    if elapsed > 0:
+        print(f"{tiles} tiles, {megabytes:.1f}MiB in {elapsed:.1f}s; "
+              f"{tiles / elapsed:.1f} tiles/s, {megabytes / elapsed:.2f}MiB/s")
 
-print('INSERTING TILES')
-for z in range(map.max_z + 1):
-    for x in map.iterate_x(z):
-        for y in map.iterate_y(z):
-            try:
-                data = open(os.path.join('Elevation', str(z), str(x), "%d.png" % y),
-                            'rb').read()
-            except FileNotFoundError:
-                pass
-            else:
-                backend.store_raw(z, x, y, data)
 
-        backend.commit()
+if __name__ == '__main__':
+    main()
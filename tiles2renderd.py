@@ -1,15 +1,11 @@
-#! /usr/bin/python3
-
-import sys
-import os.path
-from PIL import Image
+#! /usr/bin/env python3
 
 # Mod_tile / renderd store the rendered tiles
 # in "meta tiles" in a special hashed directory structure. These combine
 # 8x8 actual tiles into a single metatile file. The metatiles are stored
 # in the following directory structure:
 
-# /[base_dir]/[TileSetName]/[Z]/[xxxxyyyy]/[xxxxyyyy]/[xxxxyyyy]/[xxxxyyyy]/[xxxxyyyy].png
+# /[base_dir]/[TileSetName]/[Z]/[xxxxyyyy]/[xxxxyyyy]/[xxxxyyyy]/[xxxxyyyy]/[xxxxyyyy].meta
 
 # Where base_dir is a configurable base path for all tiles. TileSetName
 # is the name of the style sheet rendered. Z is the zoom level.
@@ -18,72 +14,168 @@ from PIL import Image
 # attempts to cluster 16x16 square of tiles together into a single sub
 # directory for more efficient access patterns.
 
-#for (i=0; i<5; i++) {
-    #hash[i] = ((x & 0x0f) << 4) | (y & 0x0f);
-    #x >>= 4;
-    #y >>= 4;
-#}
-def xyz_to_cache (x, y, z):
-    h = []
+# this converts a slippy map tile dir (Z/X/Y.png) into that. The .meta files
+# have the tiles' PNGs as they are, so nothing is decoded.
+
+from argparse import ArgumentParser
+from collections import defaultdict
+import itertools
+import multiprocessing
+import os
+import os.path
+
+import map_utils
+import utils
+
+from typing import Dict, Iterator, Optional, Tuple
+
+# z, x, y, { meta_offset: path }
+Job = Tuple[int, int, int, Dict[int, str]]
+
+# per worker, see init()
+backend:Optional[map_utils.ModTileBackend] = None
+sea:Optional[bytes] = None
+
+
+def scan(path:str, extension:str='') -> Dict[int, os.DirEntry]:
+    '''Returns the entries in path named as integers plus extension.'''
+    entries = {}
+
+    try:
+        with os.scandir(path) as dir_entries:
+            for entry in dir_entries:
+                name = entry.name
+                if extension != '':
+                    if not name.endswith(extension):
+                        continue
+                    name = name[:-len(extension)]
+
+                try:
+                    entries[int(name)] = entry
+                except ValueError:
+                    pass
+    except FileNotFoundError:
+        pass
+
+    return entries
+
+
+def metatiles(tile_dir:str, z:int, atlas:Optional[map_utils.Atlas]) -> Iterator[Job]:
+    '''Yields the metatiles of ZL z with at least one tile in tile_dir, one
+    column of metatiles at a time, so only those dirs are scanned at once.'''
+    mask = ~(map_utils.METATILE - 1)
+    xs = sorted( x for x in scan(os.path.join(tile_dir, str(z)))
+                 if atlas is None or (z, x) in atlas )
+
+    for meta_x, column in itertools.groupby(xs, key=lambda x: x & mask):
+        # meta_y -> { meta_offset: path }
+        found:Dict[int, Dict[int, str]] = defaultdict(dict)
+
+        for x in column:
+            for y, entry in scan(os.path.join(tile_dir, str(z), str(x)), '.png').items():
+                if atlas is not None and (z, x, y) not in atlas:
+                    continue
+
+                found[y & mask][map_utils.meta_offset(x, y)] = entry.path
+
+        for meta_y in sorted(found.keys()):
+            yield (z, meta_x, meta_y, found[meta_y])
+
+
+def init(output_dir:str, sea_data:Optional[bytes]):
+    global backend, sea
+
+    backend = map_utils.ModTileBackend(output_dir)
+    sea = sea_data
+
+
+def convert(job:Job) -> bool:
+    '''Writes the .meta file for the metatile. Returns False if it was all sea.'''
+    z, x, y, paths = job
+    assert backend is not None
+
+    datas = {}
+    for index, path in paths.items():
+        with open(path, 'rb') as f:
+            datas[index] = f.read()
+
+    if sea is not None:
+        # comparing the PNGs is enough, no need to decode them
+        if all( data == sea for data in datas.values() ):
+            return False
+
+        # mod_tile expects all the tiles, so fill the missing ones with sea
+        size = min(map_utils.METATILE, 2**z)
+        for i in range(size):
+            for j in range(size):
+                datas.setdefault(map_utils.meta_offset(i, j), sea)
+
+    map_utils.write_meta(backend.tile_uri((z, x, y)), z, x, y, datas)
+
+    return True
 
-    for i in range(5):
-        h.append( ((x & 0x0f) << 4) | (y & 0x0f) )
-        x >>= 4
-        y >>= 4
 
-    return h
+def parse_args():
+    parser = ArgumentParser()
 
+    parser.add_argument('tile_dir', metavar='TILE_DIR',
+                        help='Slippy map tiles, as in TILE_DIR/Z/X/Y.png.')
+    parser.add_argument('-o', '--output-dir', dest='output_dir', default=None,
+                        help='Defaults to /var/lib/mod_tile/[TILE_DIR in lowercase].')
+    parser.add_argument('-B', '--bbox-name',  dest='bbox_name',  default=None,
+                        help='Only convert the tiles in this bbox from atlas.ini.')
+    parser.add_argument('-n', '--min-zoom',   dest='min_zoom',   default=0, type=int)
+    parser.add_argument('-x', '--max-zoom',   dest='max_zoom',   default=18, type=int)
+    parser.add_argument('-s', '--sea',        dest='sea',        default='sea.png',
+                        help="Metatiles with only this tile are not written, "
+                             "and it's used for the missing tiles of the rest.")
+    parser.add_argument('-j', '--processes',  dest='processes',  default=utils.NUM_CPUS, type=int)
 
-def generate_meta(tileset, col, row, z):
-    if z in (0, 1, 2):
-        tiles_in_meta = 1 << z
-    else:
-        tiles_in_meta = 8
+    opts = parser.parse_args()
 
-    tiles = []
-    tile_count = 0
+    if opts.output_dir is None:
+        tileset = os.path.basename(os.path.normpath(opts.tile_dir))
+        opts.output_dir = os.path.join('/var/lib/mod_tile', tileset.lower())
 
-    for x in range(col, col + tiles_in_meta):
-        for y in range(row, row + tiles_in_meta):
-            tile_file = os.path.join (tileset, str(z), str(x), "%d.png" % y)
-            if os.path.exists(tile_file):
-                tiles.append(tile_file)
-                tile_count += 1
-            else:
-                tiles.append('sea.png')
+    return opts
 
-    if tile_count>0:
-        # do not generate if it's all sea
-        # TODO: how to handle this on mod_tile?
-        dst = Image.new ('RGB', (256*tiles_in_meta, 256*tiles_in_meta))
 
-        for index, tile in enumerate(tiles):
-            src = Image.open(tile)
+def main():
+    opts = parse_args()
 
-            x = index // tiles_in_meta
-            y = index %  tiles_in_meta
+    atlas = None
+    if opts.bbox_name is not None:
+        atlas = map_utils.Atlas([ opts.bbox_name ])
+        # the bbox does not define ZLs further down
+        opts.max_zoom = min(opts.max_zoom, atlas.maxZoom)
 
+    try:
+        with open(opts.sea, 'rb') as f:
+            sea_data = f.read()
+    except FileNotFoundError:
+        print(f"{opts.sea} not found, not skipping sea metatiles.")
+        sea_data = None
 
-            dst.paste(src, (x*256, y*256))
+    jobs = itertools.chain.from_iterable( metatiles(opts.tile_dir, z, atlas)
+                                          for z in range(opts.min_zoom, opts.max_zoom + 1) )
 
-        crumbs = xyz_to_cache(col, row, z)
-        dst_path = os.path.join('/var/lib/mod_tile', tileset.lower(), str(z),
-                                *[ str (c) for c in crumbs ])+'.png'
+    written = skipped = 0
+    with multiprocessing.Pool(opts.processes, init, (opts.output_dir, sea_data)) as pool:
+        # Pool.imap*() consume their whole input right away, so feed it by batches
+        while True:
+            batch = list(itertools.islice(jobs, 256 * opts.processes))
+            if len(batch) == 0:
+                break
 
-        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
-        print (z, col, row, dst_path)
-        dst.save(dst_path)
+            for done in pool.imap_unordered(convert, batch, chunksize=16):
+                if done:
+                    written += 1
+                else:
+                    skipped += 1
 
+            z, x, y, _ = batch[-1]
+            print(f"{z}/{x}/{y}: {written} metatiles written, {skipped} all sea.")
 
-tileset = sys.argv[1]
-# cache_dir = '/var/cache/mod_tile/%s' % tile_dir.lower()
 
-# TODO: read bboxes
-for z in range(19):
-    if z in (0, 1, 2):
-        mx = 1
-    else:
-        mx = 1 << (z-3)
-    for col in range(mx):
-        for row in range(mx):
-            generate_meta(tileset, col*8, row*8, z)
+if __name__ == '__main__':
+    main()
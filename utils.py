@@ -1,7 +1,13 @@
 import bisect
+from collections import OrderedDict
 import multiprocessing
+from multiprocessing import shared_memory
 import statistics
 
+import numpy
+
+from typing import Tuple, Optional, Iterable
+
 
 try:
     NUM_CPUS = multiprocessing.cpu_count()
@@ -29,6 +35,86 @@ class MedianTracker:
         return statistics.median(self.items)
 
 
+class LRUCache(OrderedDict):
+    '''A dict that only keeps the size most recently used items.'''
+    def __init__(self, size):
+        super().__init__()
+        self.size = size
+
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.move_to_end(key)
+
+        return value
+
+
+    def __contains__(self, key):
+        # so checking for an item also counts as using it
+        try:
+            self.move_to_end(key)
+        except KeyError:
+            return False
+
+        return True
+
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+
+        if len(self) > self.size:
+            # forget the least recently used one
+            self.popitem(last=False)
+
+
+# colors are RGBA packed like mapnik's raw pixels read as little endian uint32s
+TRANSPARENT = 0
+
+
+def parse_color(spec: str) -> int:
+    '''Converts [#]RRGGBB, [#]RRGGBBAA or 'transparent' into a packed color.'''
+    if spec == 'transparent':
+        return TRANSPARENT
+
+    # cut the leading #
+    if spec[0] == '#':
+        spec = spec[1:]
+
+    if len(spec) == 6:
+        spec += 'ff'
+
+    if len(spec) != 8:
+        raise ValueError(f"Bad color {spec!r}.")
+
+    return int.from_bytes(bytes.fromhex(spec), 'little')
+
+
+def uniform_color(pixels: bytes, colors: Iterable[int]) -> Optional[int]:
+    '''Returns the color of the pixels if they're all the same and one of colors,
+    None otherwise. pixels is raw RGBA, like mapnik.Image.tostring() returns.
+    A fully transparent color matches any fully transparent pixels.'''
+    data = numpy.frombuffer(pixels, dtype='<u4')
+    first = int(data[0])
+
+    if first in colors:
+        if (data == first).all():
+            return first
+
+    if first >> 24 == 0 and any( color >> 24 == 0 for color in colors ):
+        if (data >> 24 == 0).all():
+            return TRANSPARENT
+
+    return None
+
+
 def floor(i: int, base: int=1) -> int:
     '''Round i down to the closest multiple of base.'''
     return base * (i // base)
@@ -40,6 +126,75 @@ def pyramid_count(min_zoom, max_zoom):
     return sum([ 4**i for i in range(max_zoom - min_zoom + 1) ])
 
 
+def morton_key(z: int, x: int, y: int) -> int:
+    '''Position of tile (x, y) in the Z-order (Morton) curve. z is not needed,
+    but it's there so it has the same signature as hilbert_key().'''
+    key = 0
+    bit = 0
+
+    while x > 0 or y > 0:
+        key |= (x & 1) << (2 * bit) | (y & 1) << (2 * bit + 1)
+        x >>= 1
+        y >>= 1
+        bit += 1
+
+    return key
+
+
+def hilbert_key(z: int, x: int, y: int) -> int:
+    '''Position of tile (x, y) in the Hilbert curve that covers ZL z.'''
+    # see https://en.wikipedia.org/wiki/Hilbert_curve#Applications_and_mapping_algorithms
+    key = 0
+    s = 2**z // 2
+
+    while s > 0:
+        rx = int(x & s > 0)
+        ry = int(y & s > 0)
+        key += s * s * ((3 * rx) ^ ry)
+
+        # rotate the quadrant so the lower bits follow the curve
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+
+            x, y = y, x
+
+        s //= 2
+
+    return key
+
+
+curves = dict(
+    morton=morton_key,
+    hilbert=hilbert_key,
+)
+
+
+def curve_walk(z: int, x0: int, y0: int, x1: int, y1: int, step: int, key):
+    '''Yields the origins of the step x step blocks that cover the [x0, x1) x [y0, y1)
+    range of tiles of ZL z, in the order given by the key function.
+
+    It descends the quadtree of the ZL skipping the quadrants outside the range,
+    so it's proportional to the amount of blocks, not to the size of the ZL.'''
+    def walk(x, y, size):
+        if x >= x1 or y >= y1 or x + size <= x0 or y + size <= y0:
+            return
+
+        if size == step:
+            yield (x, y)
+            return
+
+        half = size // 2
+        quadrants = [ (x, y), (x + half, y), (x, y + half), (x + half, y + half) ]
+        quadrants.sort(key=lambda quadrant: key(z, *quadrant))
+
+        for quadrant_x, quadrant_y in quadrants:
+            yield from walk(quadrant_x, quadrant_y, half)
+
+    yield from walk(0, 0, 2**z)
+
+
 def time2hms(seconds: float):
     '''Converts time t in seconds into H/M/S.'''
     remaining_seconds = int(seconds)
@@ -63,6 +218,53 @@ def log_grafana(text):
     )
 
 
+class SharedMemoryRing:
+    '''A ring of reusable shared memory slots for passing big buffers between
+    processes. Only the handles go through the queues; the indexes of the free
+    slots are kept in another queue, so put() blocks when all of them are in use.
+
+    It must be created before fork()ing, so the processes inherit the mappings.'''
+
+    def __init__(self, slots:int, slot_size:int):
+        self.slot_size = slot_size
+        self.blocks = [ shared_memory.SharedMemory(create=True, size=slot_size)
+                        for _ in range(slots) ]
+
+        self.free = multiprocessing.Queue()
+        for index in range(slots):
+            self.free.put(index)
+
+
+    def put(self, data) -> Tuple[int, int]:
+        '''Copies data into a free slot and returns its handle.'''
+        if len(data) > self.slot_size:
+            raise ValueError(f"{len(data)} bytes do not fit in a {self.slot_size} bytes slot.")
+
+        index = self.free.get()
+        self.blocks[index].buf[:len(data)] = data
+
+        return (index, len(data))
+
+
+    def view(self, handle:Tuple[int, int]) -> memoryview:
+        '''Returns the data in the slot, without copying it. The view must be
+        release()'d before the ring is close()'d.'''
+        index, length = handle
+
+        return self.blocks[index].buf[:length]
+
+
+    def release(self, handle:Tuple[int, int]):
+        '''Give the slot back so it can be reused.'''
+        self.free.put(handle[0])
+
+
+    def close(self):
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+
+
 class SimpleQueue:
     '''Class based on a list that implements the minimum needed to look like a
     *.Queue. The advantage is that there is no (de)serializing here.'''